@@ -1,30 +1,63 @@
+from __future__ import annotations
+
 import argparse
+import concurrent.futures
+import io
 import os
 import time
+from typing import TYPE_CHECKING, Dict, Iterator, List, Union
 from dotenv import load_dotenv
-from google.api_core.client_options import ClientOptions
-from google.cloud import documentai, storage
+import gcs_staging
+import page_cache
+import profiling
+import text_artifact
+from rate_limiter import DOCUMENT_AI
+
+# Document AI processor and staging bucket used by the API and the workers
+DEFAULT_BUCKET_NAME = "marithon-ocr-bucket-123"
+DEFAULT_LOCATION = "us"
+DEFAULT_PROCESSOR_ID = "44770fd7117288da"
+
+PAGE_SEPARATOR = "\n\n--- Page Break ---\n\n"
+
+# How OCR lines are grouped into visual rows (see reconstruct_document_layout)
+LAYOUT_MODES = ("adaptive", "fixed")
+LAYOUT_MODE = os.getenv("SOF_LAYOUT_MODE", "adaptive")
+
+# How long to wait for one Document AI batch operation (below the job queue's 600 s lease)
+OPERATION_TIMEOUT_SECONDS = 420
+
+# The Google Cloud SDKs take seconds to import, so they are loaded inside the
+# functions that need them; importing this module stays cheap.
+if TYPE_CHECKING:
+    from google.cloud import documentai
 
 def batch_process_documents_with_doc_ai(
     project_id: str,
     location: str,
     processor_id: str,
-    gcs_input_uri: str,
+    gcs_input_uri: Union[str, List[str]],
     gcs_output_uri: str,
     mime_type: str = "application/pdf",
 ):
     """
-    Performs asynchronous OCR on a PDF in GCS using Document AI.
+    Performs asynchronous OCR on one or more PDFs in GCS using Document AI.
+    Returns the ID of the operation whose output should be read; the output for
+    the i-th input lands under <gcs_output_uri>/<operation id>/<i>/.
     """
     print("Starting Document AI batch processing...")
+    from google.api_core.client_options import ClientOptions
+    from google.cloud import documentai
     
     opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
     client = documentai.DocumentProcessorServiceClient(client_options=opts)
 
     name = client.processor_path(project_id, location, processor_id)
 
-    gcs_document = documentai.GcsDocument(gcs_uri=gcs_input_uri, mime_type=mime_type)
-    gcs_documents = documentai.GcsDocuments(documents=[gcs_document])
+    input_uris = [gcs_input_uri] if isinstance(gcs_input_uri, str) else list(gcs_input_uri)
+    gcs_documents = documentai.GcsDocuments(
+        documents=[documentai.GcsDocument(gcs_uri=uri, mime_type=mime_type) for uri in input_uris]
+    )
     input_config = documentai.BatchDocumentsInputConfig(gcs_documents=gcs_documents)
     
     gcs_output_config = documentai.DocumentOutputConfig.GcsOutputConfig(gcs_uri=gcs_output_uri)
@@ -36,139 +69,308 @@ def batch_process_documents_with_doc_ai(
         document_output_config=output_config,
     )
 
-    operation = client.batch_process_documents(request)
-
-    print(f"Waiting for Document AI operation {operation.operation.name} to complete...")
-    operation.result(timeout=420)
+    # Only the submission is paced, retried on 429/5xx and short-circuited while Document AI
+    # is degraded; retrying the wait would start (and bill) another operation for the same files
+    operation = DOCUMENT_AI.call(client.batch_process_documents, request)
+    operation_name = operation.operation.name
+    print(f"Waiting for Document AI operation {operation_name} to complete...")
+    try:
+        with profiling.stage("document_ai.operation"):
+            operation.result(timeout=OPERATION_TIMEOUT_SECONDS)
+    except (TimeoutError, concurrent.futures.TimeoutError):
+        # Stop it rather than leave it writing output after our cleanup
+        try:
+            operation.cancel()
+        except Exception as e:
+            print(f"Warning: could not cancel Document AI operation {operation_name}: {e}")
+        raise RuntimeError(
+            f"Document AI operation {operation_name} did not finish within {OPERATION_TIMEOUT_SECONDS}s; cancelled it"
+        ) from None
     print("Document AI batch processing finished.")
+    # Output lands under <gcs_output_uri>/<operation id>/
+    return operation_name.rsplit("/", 1)[-1]
+
+
+def get_text(text_anchor: documentai.Document.TextAnchor, full_text: str) -> str:
+    """Helper function to extract text from a document element."""
+    if text_anchor.text_segments:
+        start_index = int(text_anchor.text_segments[0].start_index)
+        end_index = int(text_anchor.text_segments[0].end_index)
+        return full_text[start_index:end_index]
+    return ""
 
+def render_visual_line(segments, avg_char_width):
+    """Joins the segments of one visual line, padding with spaces to keep column positions."""
+    segments.sort(key=lambda l: l['x'])
+    reconstructed_line = ""
+    cursor_pos = 0
+    for segment in segments:
+        target_pos = int(segment['x'] / avg_char_width)
+        spaces_to_add = max(0, target_pos - cursor_pos)
+        reconstructed_line += " " * spaces_to_add
+        reconstructed_line += segment['text']
+        cursor_pos = target_pos + len(segment['text'])
+    return reconstructed_line
+
+def page_lines(page, full_text):
+    """Non-empty OCR lines of a page with their text, left x, top and bottom y."""
+    lines = []
+    for line in page.lines:
+        line_text = get_text(line.layout.text_anchor, full_text).strip()
+        if not line_text: continue
+        vertices = line.layout.bounding_poly.vertices
+        y_coords = [v.y for v in vertices]
+        x_coords = [v.x for v in vertices]
+        lines.append({
+            'text': line_text,
+            'x': vertices[0].x,
+            'y': vertices[0].y,
+            'top': min(y_coords),
+            'bottom': max(y_coords),
+            'width': max(x_coords) - min(x_coords),
+        })
+    return lines
+
+def char_width(lines, default=8):
+    """Average character width over the given lines, from their bounding box widths."""
+    total_width = sum(l['width'] for l in lines if l['width'] > 0)
+    total_chars = sum(len(l['text']) for l in lines if l['width'] > 0)
+    return (total_width / total_chars) if total_chars > 0 else default
+
+def group_rows_fixed(lines, y_tolerance=10):
+    """Original grouping: a line joins the current row if its top is within y_tolerance pixels of the row's first line."""
+    rows = []
+    for line_data in sorted(lines, key=lambda l: l['y']):
+        if rows and abs(line_data['y'] - rows[-1][0]['y']) < y_tolerance:
+            rows[-1].append(line_data)
+        else:
+            rows.append([line_data])
+    return rows
+
+def group_rows_adaptive(lines, tolerance_factor=0.5):
+    """
+    Gap-based row detection in O(n log n): lines are sorted by vertical centre and a new
+    row starts when a centre is more than tolerance_factor * the page's median line
+    height away from the running mean centre of the current row. Scales with DPI and
+    font size, and the running mean keeps slightly skewed rows from drifting apart.
+    """
+    heights = sorted(l['bottom'] - l['top'] for l in lines if l['bottom'] > l['top'])
+    median_height = heights[len(heights) // 2] if heights else 10
+    tolerance = max(1.0, median_height * tolerance_factor)
+
+    rows = []
+    row_centre = 0.0
+    for line_data in sorted(lines, key=lambda l: (l['top'] + l['bottom']) / 2):
+        centre = (line_data['top'] + line_data['bottom']) / 2
+        if rows and centre - row_centre <= tolerance:
+            rows[-1].append(line_data)
+            row_centre += (centre - row_centre) / len(rows[-1])
+        else:
+            rows.append([line_data])
+            row_centre = centre
+    return rows
+
+def reconstruct_document_layout(document: documentai.Document, outfile, source_name="document", mode=None):
+    """
+    Writes the text of a Document AI document to an open file, grouping lines
+    into visual rows to preserve left-to-right reading order.
+    mode is "adaptive" (per-page tolerance and character width, the default) or
+    "fixed" (10 px tolerance and one character width for the whole document).
+    """
+    mode = mode or LAYOUT_MODE
+    if mode not in LAYOUT_MODES:
+        raise ValueError(f"Unknown layout mode '{mode}'; choose from {', '.join(LAYOUT_MODES)}")
+    full_text = document.text
+    pages = [page_lines(page, full_text) for page in document.pages]
+
+    if mode == "fixed":
+        avg_char_width = char_width([line for lines in pages for line in lines])
+        print(f"Calculated average character width: {avg_char_width:.2f}")
+
+    print(f"Processing {len(document.pages)} pages from '{source_name}' with {mode} layout reconstruction...")
+    for i, lines_on_page in enumerate(pages):
+        if not lines_on_page: continue
+
+        if mode == "fixed":
+            rows = group_rows_fixed(lines_on_page)
+            page_char_width = avg_char_width
+        else:
+            rows = group_rows_adaptive(lines_on_page)
+            page_char_width = char_width(lines_on_page)
+
+        for row in rows:
+            outfile.write(render_visual_line(row, page_char_width) + "\n")
+
+        if i < len(document.pages) - 1:
+            outfile.write(PAGE_SEPARATOR)
 
 def write_doc_ai_results_to_local_file(bucket_name, gcs_prefix, local_output_file):
     """
     Writes the content of Document AI output files to a local file,
     reconstructing the layout to preserve left-to-right reading order.
+    Shards are downloaded in parallel a few ahead of the one being reconstructed.
     """
     print(f"Consolidating Document AI results into '{local_output_file}'...")
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    from google.cloud import documentai
 
-    blob_list = list(bucket.list_blobs(prefix=gcs_prefix))
-    
-    def get_text(text_anchor: documentai.Document.TextAnchor, full_text: str) -> str:
-        """Helper function to extract text from a document element."""
-        if text_anchor.text_segments:
-            start_index = int(text_anchor.text_segments[0].start_index)
-            end_index = int(text_anchor.text_segments[0].end_index)
-            return full_text[start_index:end_index]
-        return ""
+    blob_list = [blob for blob in gcs_staging.list_blobs(bucket_name, gcs_prefix) if ".json" in blob.name]
 
     with open(local_output_file, "w", encoding="utf-8") as outfile:
-        for blob in blob_list:
-            if ".json" in blob.name:
-                json_string = blob.download_as_bytes()
-                document = documentai.Document.from_json(json_string)
-                
-                full_text = document.text
-                
-                # --- New Logic: Calculate Average Character Width ---
-                total_width = 0
-                total_chars = 0
-                for page in document.pages:
-                    for line in page.lines:
-                        line_text = get_text(line.layout.text_anchor, full_text).strip()
-                        if not line_text: continue
-                        x_coords = [v.x for v in line.layout.bounding_poly.vertices]
-                        line_width = max(x_coords) - min(x_coords)
-                        if line_width > 0:
-                            total_width += line_width
-                            total_chars += len(line_text)
-                
-                avg_char_width = (total_width / total_chars) if total_chars > 0 else 8 # Default fallback
-                print(f"Calculated average character width: {avg_char_width:.2f}")
-
-                print(f"Processing {len(document.pages)} pages from '{blob.name}' with layout reconstruction...")
-                for i, page in enumerate(document.pages):
-                    lines_on_page = []
-                    for line in page.lines:
-                        line_text = get_text(line.layout.text_anchor, full_text).strip()
-                        if not line_text: continue
-                        y_coord = line.layout.bounding_poly.vertices[0].y
-                        x_coord = line.layout.bounding_poly.vertices[0].x
-                        lines_on_page.append({'text': line_text, 'y': y_coord, 'x': x_coord})
-                    
-                    if not lines_on_page: continue
-                    lines_on_page.sort(key=lambda l: l['y'])
-                    
-                    reconstructed_lines = []
-                    current_visual_line = []
-                    y_tolerance = 10 
-
-                    for line_data in lines_on_page:
-                        if not current_visual_line:
-                            current_visual_line.append(line_data)
-                        else:
-                            if abs(line_data['y'] - current_visual_line[0]['y']) < y_tolerance:
-                                current_visual_line.append(line_data)
-                            else:
-                                current_visual_line.sort(key=lambda l: l['x'])
-                                # --- New Logic: Reconstruct line with spacing ---
-                                reconstructed_line = ""
-                                cursor_pos = 0
-                                for segment in current_visual_line:
-                                    target_pos = int(segment['x'] / avg_char_width)
-                                    spaces_to_add = max(0, target_pos - cursor_pos)
-                                    reconstructed_line += " " * spaces_to_add
-                                    reconstructed_line += segment['text']
-                                    cursor_pos = target_pos + len(segment['text'])
-                                reconstructed_lines.append(reconstructed_line)
-                                current_visual_line = [line_data]
-                    
-                    if current_visual_line:
-                        current_visual_line.sort(key=lambda l: l['x'])
-                        reconstructed_line = ""
-                        cursor_pos = 0
-                        for segment in current_visual_line:
-                            target_pos = int(segment['x'] / avg_char_width)
-                            spaces_to_add = max(0, target_pos - cursor_pos)
-                            reconstructed_line += " " * spaces_to_add
-                            reconstructed_line += segment['text']
-                            cursor_pos = target_pos + len(segment['text'])
-                        reconstructed_lines.append(reconstructed_line)
-
-                    for text_line in reconstructed_lines:
-                        outfile.write(text_line + "\n")
-
-                    if i < len(document.pages) - 1:
-                        outfile.write("\n\n--- Page Break ---\n\n")
+        for blob, json_string in zip(blob_list, gcs_staging.iter_downloads(blob_list)):
+            document = documentai.Document.from_json(json_string)
+            reconstruct_document_layout(document, outfile, source_name=blob.name)
+    text_artifact.build_page_index(local_output_file)
 
     print("Successfully wrote Document AI OCR results to local file with left-to-right layout.")
 
+def iter_doc_ai_results_per_input(bucket_name, gcs_prefix, input_count) -> Iterator[str]:
+    """
+    Yields the reconstructed text of each input document of a batch operation, in
+    input order. Shards are downloaded in parallel a few ahead of the one being
+    reconstructed, so only a handful are held in memory.
+    gcs_prefix is the operation's output folder, which has one sub-folder per input.
+    """
+    from google.cloud import documentai
+
+    shards: Dict[int, List] = {}
+    for blob in gcs_staging.list_blobs(bucket_name, gcs_prefix):
+        if ".json" not in blob.name:
+            continue
+        input_index = int(blob.name[len(gcs_prefix):].split("/", 1)[0])
+        shards.setdefault(input_index, []).append(blob)
+    missing = [i for i in range(input_count) if i not in shards]
+    if missing:
+        raise RuntimeError(f"Document AI returned no output for input(s) {missing} under '{gcs_prefix}'")
+
+    ordered = [(i, blob) for i in range(input_count) for blob in sorted(shards[i], key=lambda b: b.name)]
+    downloads = gcs_staging.iter_downloads(blob for _, blob in ordered)
+    out, current = io.StringIO(), 0
+    for (input_index, blob), json_string in zip(ordered, downloads):
+        if input_index != current:
+            yield out.getvalue()
+            out, current = io.StringIO(), input_index
+        document = documentai.Document.from_json(json_string)
+        reconstruct_document_layout(document, out, source_name=blob.name)
+    yield out.getvalue()
+
 def upload_to_gcs(bucket_name, file_path, gcs_filename):
-    """Uploads a file to the given GCS bucket."""
+    """Uploads a file to the given GCS bucket, in resumable chunks when it is large."""
     print(f"Uploading '{os.path.basename(file_path)}' to bucket '{bucket_name}'...")
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(gcs_filename)
-    blob.upload_from_filename(file_path)
+    gcs_uri = gcs_staging.upload_file(bucket_name, file_path, gcs_filename)
+    print("Upload complete.")
+    return gcs_uri
+
+def upload_pages_to_gcs(bucket_name, pages: Dict[str, bytes]) -> List[str]:
+    """Uploads in-memory single-page PDFs (see gcs_staging.upload_many), keyed by object name; returns their URIs in order."""
+    print(f"Uploading {len(pages)} page(s) to bucket '{bucket_name}'...")
+    uris = gcs_staging.upload_many(bucket_name, pages)
     print("Upload complete.")
-    return f"gs://{bucket_name}/{gcs_filename}"
+    return uris
 
-def cleanup_gcs(bucket_name, gcs_prefix, gcs_filename):
-    """Removes the uploaded PDF and the OCR output from GCS."""
+def cleanup_gcs(bucket_name, gcs_prefix, gcs_input_prefix):
+    """Removes the uploaded PDF (or page PDFs under gcs_input_prefix) and the OCR output from GCS, now."""
     print("Cleaning up files from Google Cloud Storage...")
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    
+    deleted = gcs_staging.delete_prefixes(bucket_name, gcs_input_prefix, gcs_prefix)
+    print(f"Cleanup complete ({deleted} object(s) removed).")
+
+def resolve_project_id():
+    """Project ID from Application Default Credentials, falling back to GOOGLE_CLOUD_PROJECT."""
+    try:
+        from google.auth import default
+        creds, project_id = default()
+        if project_id:
+            return project_id
+    except Exception:
+        pass
+    return os.getenv("GOOGLE_CLOUD_PROJECT")
+
+def process_pdf(pdf_path, bucket_name, location, processor_id, output_file, project_id=None):
+    """
+    Runs the full OCR flow for one PDF and writes the layout-reconstructed text to
+    output_file. The PDF is split into pages and only pages missing from the page
+    cache (see page_cache.py) are sent to Document AI; if the PDF cannot be split,
+    the whole document is processed as before.
+    """
+    project_id = project_id or resolve_project_id()
+    if not project_id:
+        raise RuntimeError("Could not determine project ID. Please set GOOGLE_CLOUD_PROJECT in your .env file.")
+
     try:
-        bucket.blob(gcs_filename).delete()
+        with profiling.stage("ocr.split_pages"):
+            pages = page_cache.split_pdf_pages(pdf_path)
     except Exception as e:
-        print(f"Warning: could not delete source PDF. {e}")
+        print(f"Could not split '{pdf_path}' into pages ({e}); running OCR on the whole document.")
+        process_whole_pdf(pdf_path, bucket_name, location, processor_id, output_file, project_id)
+        return
 
-    blobs_to_delete = list(bucket.list_blobs(prefix=gcs_prefix))
-    for blob in blobs_to_delete:
-        blob.delete()
-        
-    print("Cleanup complete.")
+    # Reconstructed text depends on the layout mode as well as the page
+    page_keys = [f"{page_cache.content_hash(page)}-{LAYOUT_MODE}" for page in pages]
+    missing = [i for i, key in enumerate(page_keys) if not page_cache.has_page_text(key)]
+    print(f"{len(pages) - len(missing)} of {len(pages)} page(s) found in the OCR cache.")
+
+    timestamp = int(time.time())
+    run_name = f"{timestamp}-{os.path.basename(pdf_path)}"
+    gcs_input_prefix = f"docai-input/{run_name}/"
+    gcs_output_prefix = f"docai-output/{run_name}/"
+    new_texts = iter(())
+    try:
+        if missing:
+            with profiling.stage("gcs_upload"):
+                gcs_input_uris = upload_pages_to_gcs(
+                    bucket_name, {f"{gcs_input_prefix}page-{i + 1:04d}.pdf": pages[i] for i in missing}
+                )
+            pages = None  # the page PDFs are not needed once uploaded
+            operation_id = batch_process_documents_with_doc_ai(
+                project_id,
+                location,
+                processor_id,
+                gcs_input_uris,
+                f"gs://{bucket_name}/{gcs_output_prefix}"
+            )
+            new_texts = iter_doc_ai_results_per_input(bucket_name, f"{gcs_output_prefix}{operation_id}/", len(missing))
+
+        # Pages are written one at a time, so only one page's text is held in memory
+        missing = set(missing)
+        with text_artifact.PageWriter(output_file) as writer:
+            for i, key in enumerate(page_keys):
+                if i in missing:
+                    text = next(new_texts)
+                    page_cache.store_page_text(key, text)
+                else:
+                    text = page_cache.load_page_text(key)
+                    if text is None:
+                        raise RuntimeError(f"OCR cache entry for page {i + 1} disappeared while writing '{output_file}'")
+                writer.write_page(text, PAGE_SEPARATOR)
+    finally:
+        if missing:
+            # Off the critical path by default (see gcs_staging.cleanup)
+            gcs_staging.cleanup(bucket_name, gcs_input_prefix, gcs_output_prefix)
+    print(f"Wrote OCR text for {len(page_keys)} page(s) to '{output_file}'.")
+
+def process_whole_pdf(pdf_path, bucket_name, location, processor_id, output_file, project_id):
+    """
+    OCR for a PDF that cannot be split: upload to GCS, Document AI batch processing,
+    layout reconstruction into output_file, and GCS cleanup.
+    """
+    timestamp = int(time.time())
+    pdf_filename = os.path.basename(pdf_path)
+    gcs_filename = f"docai-input/{timestamp}-{pdf_filename}"
+    gcs_output_prefix = f"docai-output/{timestamp}-{pdf_filename}/"
+    
+    gcs_input_uri = upload_to_gcs(bucket_name, pdf_path, gcs_filename)
+    gcs_output_uri = f"gs://{bucket_name}/{gcs_output_prefix}"
+
+    try:
+        operation_id = batch_process_documents_with_doc_ai(
+            project_id,
+            location,
+            processor_id,
+            gcs_input_uri,
+            gcs_output_uri
+        )
+        write_doc_ai_results_to_local_file(bucket_name, f"{gcs_output_prefix}{operation_id}/", output_file)
+    finally:
+        gcs_staging.cleanup(bucket_name, gcs_filename, gcs_output_prefix)
 
 def main():
     """Main function to orchestrate the PDF OCR process with Document AI."""
@@ -190,42 +392,13 @@ def main():
     parser.add_argument("output_file", help="The name for the local output text file.")
     args = parser.parse_args()
 
-    try:
-        from google.auth import default
-        creds, project_id = default()
-        if not project_id:
-            project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
-        if not project_id:
-            print("Could not determine project ID. Please set GOOGLE_CLOUD_PROJECT in your .env file.")
-            return
-    except Exception:
-        project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
-        if not project_id:
-            print("Could not determine project ID. Please set GOOGLE_CLOUD_PROJECT in your .env file.")
-            return
-
-
-    timestamp = int(time.time())
-    pdf_filename = os.path.basename(args.pdf_path)
-    gcs_filename = f"docai-input/{timestamp}-{pdf_filename}"
-    gcs_output_prefix = f"docai-output/{timestamp}-{pdf_filename}/"
-    
-    gcs_input_uri = upload_to_gcs(args.bucket_name, args.pdf_path, gcs_filename)
-    gcs_output_uri = f"gs://{args.bucket_name}/{gcs_output_prefix}"
+    project_id = resolve_project_id()
+    if not project_id:
+        print("Could not determine project ID. Please set GOOGLE_CLOUD_PROJECT in your .env file.")
+        return
 
-    try:
-        batch_process_documents_with_doc_ai(
-            project_id,
-            args.location,
-            args.processor_id,
-            gcs_input_uri,
-            gcs_output_uri
-        )
-        write_doc_ai_results_to_local_file(args.bucket_name, gcs_output_prefix, args.output_file)
-    finally:
-        cleanup_gcs(args.bucket_name, gcs_output_prefix, gcs_filename)
+    process_pdf(args.pdf_path, args.bucket_name, args.location, args.processor_id, args.output_file, project_id)
 
 
 if __name__ == "__main__":
     main()
-
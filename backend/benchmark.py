@@ -0,0 +1,1279 @@
+"""
+Benchmark harness for the SOF processing pipeline.
+
+Replays recorded Document AI output and Gemini responses from bench_fixtures/
+so every stage can be measured on its own without calling Google Cloud:
+
+    python benchmark.py run                      # all stages, compared to bench_baseline.json
+    python benchmark.py run --stages layout,json --iterations 50
+    python benchmark.py run --update-baseline    # store the current numbers as the baseline
+    python benchmark.py record "../sample/SOF/(7) MV CAPE ASTER.pdf"
+
+Fixture layout (one directory per sample):
+
+    bench_fixtures/<name>/meta.json         {"sample": "<pdf file name in sample/SOF>"}
+    bench_fixtures/<name>/docai/*.json      raw Document AI output shards
+    bench_fixtures/<name>/ocr.txt           OCR text dump, used to synthesize Document AI
+                                            output when no recorded shards exist
+    bench_fixtures/<name>/gemini/*.txt      raw Gemini responses, one per call in page order
+    bench_fixtures/<name>/labels.json       expected events (see evaluate_parser.py), optional
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+import OCR_Script
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BACKEND_DIR, "bench_fixtures")
+SAMPLE_DIR = os.path.join(os.path.dirname(BACKEND_DIR), "sample", "SOF")
+DEFAULT_BASELINE = os.path.join(BACKEND_DIR, "bench_baseline.json")
+PAGE_BREAK = "--- Page Break ---"
+
+# Metrics where a higher value is a regression, and the ones where a lower value is.
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "peak_mem_kb", "input_chars_per_page", "ready_p50_ms", "ready_p95_ms")
+HIGHER_IS_BETTER = ("throughput", "row_capture", "event_capture", "page_success")
+TIMING_METRICS = ("p50_ms", "p95_ms", "throughput", "ready_p50_ms", "ready_p95_ms")
+# Stages faster than this are dominated by timer noise, so their timings are not compared.
+NOISE_FLOOR_MS = 0.05
+
+
+# --- Fixtures ---
+def synthesize_docai_document(ocr_text: str, char_width: int = 10, line_height: int = 30,
+                               scale: float = 1.0, y_jitter: float = 0.0, seed: int = 0) -> Dict[str, Any]:
+    """
+    Builds a Document AI style JSON document from a layout-reconstructed text dump.
+    Runs of two or more spaces separate OCR lines, and each line gets a bounding box
+    derived from its column and row, so layout reconstruction has realistic input.
+    `scale` multiplies all coordinates (a higher-DPI scan) and `y_jitter` moves each
+    line up or down by up to that fraction of the line height (uneven scanned rows).
+    """
+    rng = random.Random(seed)
+    char_width, line_height = char_width * scale, line_height * scale
+    full_text = ""
+    pages = []
+    for page_number, page_text in enumerate(ocr_text.split(PAGE_BREAK), start=1):
+        lines = []
+        rows = page_text.strip("\n").split("\n")
+        for row, row_text in enumerate(rows):
+            for match in re.finditer(r"\S+(?: \S+)*", row_text):
+                segment = match.group(0)
+                start_index = len(full_text)
+                full_text += segment + "\n"
+                x = int(match.start() * char_width)
+                y = int(row * line_height + rng.uniform(-y_jitter, y_jitter) * line_height)
+                width = int(len(segment) * char_width)
+                height = int(line_height * 0.8)
+                lines.append({
+                    "layout": {
+                        "textAnchor": {"textSegments": [{"startIndex": str(start_index), "endIndex": str(start_index + len(segment))}]},
+                        "boundingPoly": {"vertices": [
+                            {"x": x, "y": y},
+                            {"x": x + width, "y": y},
+                            {"x": x + width, "y": y + height},
+                            {"x": x, "y": y + height},
+                        ]},
+                    }
+                })
+        pages.append({
+            "pageNumber": page_number,
+            "dimension": {"width": int(2480 * scale), "height": int(max(len(rows), 1) * line_height), "unit": "pixels"},
+            "lines": lines,
+        })
+    return {"text": full_text, "pages": pages}
+
+
+def load_fixtures(fixtures_dir: str = FIXTURES_DIR) -> List[Dict[str, Any]]:
+    """Loads every fixture directory into memory."""
+    fixtures = []
+    if not os.path.isdir(fixtures_dir):
+        return fixtures
+
+    for name in sorted(os.listdir(fixtures_dir)):
+        path = os.path.join(fixtures_dir, name)
+        if not os.path.isdir(path):
+            continue
+
+        meta = {}
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+
+        docai = []
+        docai_dir = os.path.join(path, "docai")
+        if os.path.isdir(docai_dir):
+            for shard in sorted(os.listdir(docai_dir)):
+                if shard.endswith(".json"):
+                    with open(os.path.join(docai_dir, shard), "rb") as f:
+                        docai.append(f.read())
+
+        ocr_text = None
+        ocr_path = os.path.join(path, "ocr.txt")
+        if os.path.exists(ocr_path):
+            with open(ocr_path, "r", encoding="utf-8") as f:
+                ocr_text = f.read()
+        if not docai and ocr_text is not None:
+            docai.append(json.dumps(synthesize_docai_document(ocr_text)).encode("utf-8"))
+
+        labels = None
+        labels_path = os.path.join(path, "labels.json")
+        if os.path.exists(labels_path):
+            with open(labels_path, "r", encoding="utf-8") as f:
+                labels = json.load(f).get("events", [])
+
+        gemini = []
+        gemini_dir = os.path.join(path, "gemini")
+        if os.path.isdir(gemini_dir):
+            for response_file in sorted(os.listdir(gemini_dir)):
+                if response_file.endswith(".txt"):
+                    with open(os.path.join(gemini_dir, response_file), "r", encoding="utf-8") as f:
+                        gemini.append(f.read())
+
+        fixtures.append({
+            "name": name,
+            "sample": meta.get("sample"),
+            "filename": meta.get("sample") or f"{name}.pdf",
+            "docai": docai,
+            "gemini": gemini,
+            "ocr_text": ocr_text,
+            "labels": labels,
+        })
+    return fixtures
+
+
+def report_fixture_coverage(fixtures: List[Dict[str, Any]]):
+    """Prints which PDFs in sample/SOF have no recorded fixture yet."""
+    if not os.path.isdir(SAMPLE_DIR):
+        return
+    covered = {f["sample"] for f in fixtures if f["sample"]}
+    samples = sorted(f for f in os.listdir(SAMPLE_DIR) if f.lower().endswith(".pdf"))
+    missing = [s for s in samples if s not in covered]
+    print(f"Fixtures: {len(fixtures)} loaded, {len(samples) - len(missing)}/{len(samples)} samples covered.")
+    if missing:
+        print("Samples without fixtures (capture them with `python benchmark.py record <pdf>`):")
+        for sample in missing:
+            print(f"  - {sample}")
+
+
+def replay_parsed_pages(fixture: Dict[str, Any]) -> List[tuple]:
+    """Turns a fixture's recorded Gemini responses into (page_index, parsed_data) pairs."""
+    from parser_script import extract_json_from_model_response
+    return [(i, extract_json_from_model_response(raw)) for i, raw in enumerate(fixture["gemini"])]
+
+
+def replay_parser_output(fixture: Dict[str, Any]) -> Dict[str, Any]:
+    """Rebuilds the final SOF JSON for a fixture exactly as parser_script.main would."""
+    from parser_script import merge_page_results
+    page_results = replay_parsed_pages(fixture)
+    if len(page_results) == 1 and isinstance(page_results[0][1], dict):
+        return page_results[0][1]
+    return merge_page_results(page_results)
+
+
+def replay_layout(fixture: Dict[str, Any], outfile, mode: Optional[str] = None):
+    """Runs layout reconstruction over a fixture's Document AI shards."""
+    from google.cloud import documentai
+    from OCR_Script import reconstruct_document_layout
+    for shard in fixture["docai"]:
+        document = documentai.Document.from_json(shard)
+        reconstruct_document_layout(document, outfile, source_name=fixture["name"], mode=mode)
+
+
+# --- Measurement ---
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile; returns 0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies: List[float], units: int, elapsed: float, peak_bytes: int, unit: str) -> Dict[str, Any]:
+    """Reduces raw timings (seconds) into the metrics stored in the baseline."""
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "peak_mem_kb": round(peak_bytes / 1024, 1),
+        "throughput": round(units / elapsed, 2) if elapsed > 0 else 0.0,
+        "unit": f"{unit}/sec",
+        "samples": len(latencies),
+    }
+
+
+def measure(workloads: List[Callable[[], int]], iterations: int, unit: str) -> Dict[str, Any]:
+    """
+    Times each workload `iterations` times, then runs the set once more under
+    tracemalloc for the memory peak. Each workload returns the number of units it processed.
+    """
+    latencies = []
+    units = 0
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(iterations):
+            for workload in workloads:
+                t0 = time.perf_counter()
+                units += workload()
+                latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for workload in workloads:
+                workload()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return summarize(latencies, units, elapsed, peak, unit)
+
+
+# --- Stages ---
+def bench_layout(fixtures: List[Dict[str, Any]], iterations: int) -> Optional[Dict[str, Any]]:
+    """Document AI JSON -> layout-reconstructed text."""
+    workloads = []
+    for fixture in fixtures:
+        if not fixture["docai"]:
+            continue
+
+        def run(fixture=fixture):
+            out = io.StringIO()
+            replay_layout(fixture, out)
+            return out.getvalue().count(PAGE_BREAK) + 1
+        workloads.append(run)
+    return measure(workloads, iterations, "pages") if workloads else None
+
+
+# Scan geometries for comparing row grouping: the fixtures as synthesized, and a
+# 3x resolution scan whose lines sit up to 15% of a line height off their row.
+SCAN_PROFILES = {
+    "synthetic": {},
+    "hires_scan": {"scale": 3.0, "y_jitter": 0.15},
+}
+
+
+def _normalize_row(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+def capture_rates(text: str, source_text: str, labels: Optional[List[Dict[str, Any]]]) -> Dict[str, List[int]]:
+    """
+    [captured, total] counts for source rows reproduced as one reconstructed row, and
+    for labeled events whose start time and first two words land on the same row,
+    which is what the parser needs to read an event correctly.
+    """
+    rows = [_normalize_row(line) for line in text.split("\n") if line.strip()]
+    available = {}
+    for row in rows:
+        available[row] = available.get(row, 0) + 1
+    source_rows = [_normalize_row(line) for line in source_text.split("\n") if line.strip() and PAGE_BREAK not in line]
+    rows_captured = 0
+    for row in source_rows:
+        if available.get(row):
+            available[row] -= 1
+            rows_captured += 1
+
+    events_captured = events_total = 0
+    for event in labels or []:
+        anchor = str(event.get("start_time") or event.get("start_date") or "").strip()
+        words = " ".join(_normalize_row(str(event.get("event") or "")).split()[:2])
+        if not anchor or not words:
+            continue
+        events_total += 1
+        if any(anchor in row and words in row for row in rows):
+            events_captured += 1
+    return {"rows": [rows_captured, len(source_rows)], "events": [events_captured, events_total]}
+
+
+def bench_layout_rows(fixtures: List[Dict[str, Any]], iterations: int) -> Optional[Dict[str, Any]]:
+    """
+    Row grouping on a high-resolution, unevenly scanned rendering of each fixture:
+    timing for the configured layout mode, plus row and event capture rates for every
+    mode on every scan profile.
+    """
+    fixtures = [f for f in fixtures if f["ocr_text"]]
+    if not fixtures:
+        return None
+
+    rendered = {
+        profile: [
+            {**f, "docai": [json.dumps(synthesize_docai_document(f["ocr_text"], **options)).encode("utf-8")]}
+            for f in fixtures
+        ]
+        for profile, options in SCAN_PROFILES.items()
+    }
+
+    workloads = []
+    for fixture in rendered["hires_scan"]:
+        def run(fixture=fixture):
+            out = io.StringIO()
+            replay_layout(fixture, out)
+            return out.getvalue().count(PAGE_BREAK) + 1
+        workloads.append(run)
+    metrics = measure(workloads, iterations, "pages")
+
+    rates = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for mode in OCR_Script.LAYOUT_MODES:
+            for profile, profile_fixtures in rendered.items():
+                totals = {"rows": [0, 0], "events": [0, 0]}
+                for fixture in profile_fixtures:
+                    out = io.StringIO()
+                    replay_layout(fixture, out, mode=mode)
+                    for kind, (captured, total) in capture_rates(out.getvalue(), fixture["ocr_text"], fixture["labels"]).items():
+                        totals[kind][0] += captured
+                        totals[kind][1] += total
+                for kind, (captured, total) in totals.items():
+                    rates[f"{kind}.{mode}.{profile}"] = round(captured / total, 4) if total else None
+
+    metrics["row_capture"] = rates[f"rows.{OCR_Script.LAYOUT_MODE}.hires_scan"]
+    metrics["event_capture"] = rates[f"events.{OCR_Script.LAYOUT_MODE}.hires_scan"]
+    for key, value in sorted(rates.items()):
+        metrics[f"capture.{key}"] = value
+    return metrics
+
+
+def bench_json(fixtures: List[Dict[str, Any]], iterations: int) -> Optional[Dict[str, Any]]:
+    """find_balanced_json + extract_json_from_model_response over raw Gemini responses."""
+    from parser_script import extract_json_from_model_response
+    fixtures = [f for f in fixtures if f["gemini"]]
+    workloads = []
+    for fixture in fixtures:
+        for raw in fixture["gemini"]:
+            def run(raw=raw):
+                parsed = extract_json_from_model_response(raw)
+                if isinstance(parsed, dict):
+                    return len(parsed.get("events", []))
+                return len(parsed) if isinstance(parsed, list) else 0
+            workloads.append(run)
+    if not workloads:
+        return None
+    metrics = measure(workloads, iterations, "events")
+    metrics["fixtures"] = len(fixtures)
+    return metrics
+
+
+def bench_merge(fixtures: List[Dict[str, Any]], iterations: int) -> Optional[Dict[str, Any]]:
+    """merge_page_results over already-parsed pages."""
+    from parser_script import merge_page_results
+    workloads = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        parsed_fixtures = [replay_parsed_pages(f) for f in fixtures if f["gemini"]]
+    for page_results in parsed_fixtures:
+        def run(page_results=page_results):
+            return len(merge_page_results(page_results)["events"])
+        workloads.append(run)
+    if not workloads:
+        return None
+    metrics = measure(workloads, iterations, "events")
+    metrics["fixtures"] = len(parsed_fixtures)
+    return metrics
+
+
+def bench_prompt(fixtures: List[Dict[str, Any]], iterations: int) -> Optional[Dict[str, Any]]:
+    """Prompt construction per page, plus the size of what is sent to Gemini for each page."""
+    import prompt_builder
+    from parser_script import get_sof_schema_for_prompt
+
+    system_instruction = prompt_builder.shared_instructions(get_sof_schema_for_prompt())
+    pages = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for fixture in fixtures:
+            if not fixture["docai"]:
+                continue
+            out = io.StringIO()
+            replay_layout(fixture, out)
+            page_texts = [p for p in out.getvalue().split(PAGE_BREAK) if p.strip()]
+            pages.extend((i == 0, text) for i, text in enumerate(page_texts))
+    if not pages:
+        return None
+
+    workloads = []
+    for is_first, text in pages:
+        def run(is_first=is_first, text=text):
+            prompt_builder.build_page_prompt(text, is_first)
+            return 1
+        workloads.append(run)
+    metrics = measure(workloads, iterations, "pages")
+
+    # The system instruction is billed on every call
+    sizes = [len(prompt_builder.build_page_prompt(text, is_first)) + len(system_instruction) for is_first, text in pages]
+    metrics["input_chars_per_page"] = round(sum(sizes) / len(sizes), 1)
+    metrics["raw_text_chars_per_page"] = round(sum(len(text) for _, text in pages) / len(pages), 1)
+    return metrics
+
+
+def _peak_kb(fn: Callable[[], Any]) -> float:
+    """Peak traced Python allocation while fn runs, in KB; output is discarded, not buffered."""
+    tracemalloc.start()
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def _status_kb(field: str) -> Optional[int]:
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return None
+
+
+def _peak_rss_kb(fn: Callable[[], Any]) -> Optional[float]:
+    """
+    Growth of the process's peak resident set while fn runs, in KB. Unlike tracemalloc this
+    counts mmap'ed file pages and C allocations. Memory the allocator kept from earlier
+    runs is reused without counting as growth. Needs Linux, where writing 5 to
+    /proc/self/clear_refs resets the peak (VmHWM); returns None elsewhere.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        start = _status_kb("VmRSS")
+    except OSError:
+        return None
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        fn()
+    return round(max(_status_kb("VmHWM") - start, 0), 1)
+
+
+def bench_parse_memory(fixtures: List[Dict[str, Any]], iterations: int, page_counts=(20, 200)) -> Optional[Dict[str, Any]]:
+    """
+    parse_sof_file over synthetic bundles of 20 and 200 pages built from the fixtures'
+    OCR pages, with Gemini replayed by a fixed parse result. Timing and peak memory are
+    for the largest bundle; peak memory should not grow with the page count. peak_kb_*
+    is traced Python allocation; rss_peak_kb_* is peak RSS growth (Linux only), which
+    also counts the mmap'ed text pages that were touched. The eager_* figures are the old
+    read-everything-then-split approach, for comparison.
+    """
+    import parser_script
+    import text_artifact
+
+    source_pages = [p for f in fixtures if f["ocr_text"] for p in f["ocr_text"].split(PAGE_BREAK) if p.strip()]
+    if not source_pages:
+        return None
+
+    bundles = {}
+    for count in page_counts:
+        path = os.path.abspath(f"bundle_{count}_pages.txt")
+        with text_artifact.PageWriter(path) as writer:
+            for i in range(count):
+                writer.write_page(source_pages[i % len(source_pages)], OCR_Script.PAGE_SEPARATOR)
+        bundles[count] = path
+
+    def replay_generate_parsed(prompt, max_output_tokens):
+        event = [{"event": "Loading", "day": "MON", "start_date": "01.01.2024", "start_time": "0800", "end_time": "1000"}]
+        return {"header": {}, "vessel_info": {}, "events": event} if "First page" in prompt else event
+
+    largest = bundles[max(page_counts)]
+    original_generate = parser_script.generate_parsed
+    parser_script.generate_parsed = replay_generate_parsed
+    try:
+        def run():
+            parser_script.parse_sof_file(largest, "bundle.json")
+            return max(page_counts)
+        metrics = measure([run], iterations, "pages")
+        for count, path in bundles.items():
+            metrics[f"peak_kb_{count}_pages"] = _peak_kb(lambda path=path: parser_script.parse_sof_file(path, "bundle.json"))
+            rss_kb = _peak_rss_kb(lambda path=path: parser_script.parse_sof_file(path, "bundle.json"))
+            if rss_kb is not None:
+                metrics[f"rss_peak_kb_{count}_pages"] = rss_kb
+    finally:
+        parser_script.generate_parsed = original_generate
+
+    def eager_read():
+        with open(largest, "r", encoding="utf-8") as f:
+            return [page for page in f.read().split(PAGE_BREAK)]
+    metrics[f"eager_peak_kb_{max(page_counts)}_pages"] = _peak_kb(eager_read)
+    rss_kb = _peak_rss_kb(eager_read)
+    if rss_kb is not None:
+        metrics[f"eager_rss_peak_kb_{max(page_counts)}_pages"] = rss_kb
+    return metrics
+
+
+# Thread count for the parallel upload comparison; the pipeline uploads sequentially
+# unless SOF_GCS_WORKERS is raised
+PARALLEL_UPLOAD_WORKERS = 8
+
+
+def bench_gcs(fixtures: List[Dict[str, Any]], iterations: int, page_count: int = 24) -> Optional[Dict[str, Any]]:
+    """
+    GCS staging against a local emulator (STORAGE_EMULATOR_HOST): one OCR run's worth
+    of page uploads, listing and cleanup as the pipeline does it, plus sequential and
+    parallel uploads and the one-by-one delete it replaced, for comparison. Skipped
+    without an emulator.
+    """
+    if not os.getenv("STORAGE_EMULATOR_HOST"):
+        return None
+    import gcs_staging
+    import page_cache
+
+    samples = [f["sample"] for f in fixtures if f["sample"]] + sorted(os.listdir(SAMPLE_DIR) if os.path.isdir(SAMPLE_DIR) else [])
+    sample = next((os.path.join(SAMPLE_DIR, s) for s in samples if s.lower().endswith(".pdf")), None)
+    if sample is None:
+        return None
+    pages = page_cache.split_pdf_pages(sample)
+    pages = [pages[i % len(pages)] for i in range(page_count)]
+
+    client = gcs_staging.storage_client()
+    bucket_name = os.getenv("SOF_BENCH_BUCKET", "sof-bench")
+    if client.lookup_bucket(bucket_name) is None:
+        client.create_bucket(bucket_name)
+    bucket = client.bucket(bucket_name)
+
+    def objects(run: str) -> Dict[str, bytes]:
+        return {f"docai-input/{run}/page-{i + 1:04d}.pdf": page for i, page in enumerate(pages)}
+
+    def elapsed_ms(fn: Callable[[], Any]) -> float:
+        t0 = time.perf_counter()
+        fn()
+        return (time.perf_counter() - t0) * 1000
+
+    runs = iter(range(1_000_000))
+
+    def run_pipeline():
+        run = f"bench-{next(runs)}"
+        gcs_staging.upload_many(bucket_name, objects(run))
+        gcs_staging.list_blobs(bucket_name, f"docai-input/{run}/")
+        gcs_staging.cleanup(bucket_name, f"docai-input/{run}/", mode="background")
+        return page_count
+    metrics = measure([run_pipeline], iterations, "pages")
+    gcs_staging.REAPER.drain()
+
+    comparisons = {"sequential_upload_ms": [], "parallel_upload_ms": [], "sequential_delete_ms": [],
+                   "batched_delete_ms": [], "background_cleanup_ms": []}
+    for _ in range(max(1, iterations // 4)):
+        run = f"bench-{next(runs)}"
+        comparisons["sequential_upload_ms"].append(elapsed_ms(lambda: [
+            bucket.blob(name).upload_from_string(data, content_type="application/pdf") for name, data in objects(run).items()
+        ]))
+        comparisons["sequential_delete_ms"].append(elapsed_ms(lambda: [
+            blob.delete() for blob in gcs_staging.list_blobs(bucket_name, f"docai-input/{run}/")
+        ]))
+        comparisons["parallel_upload_ms"].append(elapsed_ms(
+            lambda: gcs_staging.upload_many(bucket_name, objects(run), workers=PARALLEL_UPLOAD_WORKERS)
+        ))
+        comparisons["batched_delete_ms"].append(elapsed_ms(lambda: gcs_staging.delete_prefixes(bucket_name, f"docai-input/{run}/")))
+        gcs_staging.upload_many(bucket_name, objects(run))
+        with contextlib.redirect_stdout(io.StringIO()):
+            comparisons["background_cleanup_ms"].append(elapsed_ms(
+                lambda: gcs_staging.cleanup(bucket_name, f"docai-input/{run}/", mode="background")
+            ))
+            gcs_staging.REAPER.drain()
+    for key, values in comparisons.items():
+        metrics[key] = round(percentile(values, 50), 3)
+    metrics["pages_per_run"] = page_count
+    return metrics
+
+
+# Simulated Gemini latency for the strategy stage: a fixed cost per call plus output
+# generation, which dominates real calls (scaled down so the stage runs in seconds)
+SIMULATED_CALL_S = 0.02
+SIMULATED_EVENT_S = 0.0005
+
+
+def bench_strategy(fixtures: List[Dict[str, Any]], iterations: int) -> Optional[Dict[str, Any]]:
+    """
+    parse_sof_file under the strategy planner against one call per page in sequence
+    (the behaviour before the planner), with Gemini replaced by a simulated call
+    whose latency grows with the events it returns. The fixtures are run as they
+    are and, to cover short multi-page SOFs, with their first page split in two.
+    Reports planning overhead, end-to-end time and calls for both approaches.
+    """
+    import parse_strategy
+    import parser_script
+    import text_artifact
+
+    documents = {}
+    for fixture in fixtures:
+        if not fixture["ocr_text"]:
+            continue
+        pages = fixture["ocr_text"].split(PAGE_BREAK)
+        documents[fixture["name"]] = pages
+        lines = pages[0].split("\n")
+        documents[f"{fixture['name']} (2 pages)"] = ["\n".join(lines[:len(lines) // 2]), "\n".join(lines[len(lines) // 2:])]
+    if not documents:
+        return None
+
+    paths = {}
+    for name, pages in documents.items():
+        path = os.path.abspath(f"strategy_{len(paths)}.txt")
+        with text_artifact.PageWriter(path) as writer:
+            for page in pages:
+                writer.write_page(page, OCR_Script.PAGE_SEPARATOR)
+        paths[name] = path
+
+    calls = []
+
+    def simulated_generate_parsed(prompt, max_output_tokens):
+        rows = sum(1 for line in prompt.split("\n") if parse_strategy.is_table_row(line))
+        calls.append(rows)
+        time.sleep(SIMULATED_CALL_S + rows * SIMULATED_EVENT_S)
+        event = {"event": "Loading", "day": "MON", "start_date": "01.01.2024", "start_time": "0800", "end_time": "1000"}
+        events = [dict(event) for _ in range(rows)]
+        return events if "Continuation page" in prompt else {"header": {}, "vessel_info": {}, "events": events}
+
+    def sequential_per_page(path):
+        page_count = len(text_artifact.load_page_index(path))
+        if page_count == 1:
+            return parser_script.parse_single_page_sof(next(text_artifact.iter_pages(path)))
+        page_results = [(i, parser_script.parse_sof_chunk(page, is_first_page=(i == 0)))
+                        for i, page in enumerate(text_artifact.iter_pages(path)) if page.strip()]
+        return parser_script.merge_page_results(page_results)
+
+    original_generate = parser_script.generate_parsed
+    parser_script.generate_parsed = simulated_generate_parsed
+    try:
+        def plan_all():
+            for path in paths.values():
+                parse_strategy.plan(parse_strategy.profile_document(text_artifact.iter_pages(path), parser_script.estimate_event_count))
+            return len(paths)
+        metrics = measure([plan_all], iterations, "documents")
+
+        comparisons = {"planned": [], "sequential": []}
+        for name, path in paths.items():
+            with contextlib.redirect_stdout(io.StringIO()):
+                for approach, run in (("planned", lambda: parser_script.parse_sof_file(path, "strategy.json")),
+                                      ("sequential", lambda: sequential_per_page(path))):
+                    calls.clear()
+                    t0 = time.perf_counter()
+                    run()
+                    comparisons[approach].append((time.perf_counter() - t0) * 1000)
+                    metrics[f"{approach}_calls:{name}"] = len(calls)
+            profile = parse_strategy.profile_document(text_artifact.iter_pages(path), parser_script.estimate_event_count)
+            metrics[f"strategy:{name}"] = parse_strategy.plan(profile)[0]
+        for approach, values in comparisons.items():
+            metrics[f"{approach}_total_ms"] = round(sum(values), 1)
+    finally:
+        parser_script.generate_parsed = original_generate
+    return metrics
+
+
+def bench_export(fixtures: List[Dict[str, Any]], iterations: int, voyage_counts=(200, 800)) -> Optional[Dict[str, Any]]:
+    """
+    Streaming /api/export rendering of every voyage in a job queue filled with the
+    fixtures' replayed results, as CSV, XLSX and PDF event reports. Timing is for the
+    largest queue; peak memory per format is reported for each queue size and should
+    not grow with the number of voyages.
+    """
+    import export_report
+    from job_queue import JobQueue
+
+    results = [replay_parser_output(f) for f in fixtures if f["gemini"]]
+    results = [r for r in results if isinstance(r, dict) and r.get("events")]
+    if not results:
+        return None
+
+    queues = {}
+    for count in voyage_counts:
+        queue = JobQueue(db_path=os.path.abspath(f"export_{count}.db"), data_dir=os.path.abspath("export_data"))
+        for i in range(count):
+            document = queue.submit_document(f"voyage {i}".encode(), f"voyage_{i}.pdf")
+            queue.store_result(document["doc_hash"], results[i % len(results)])
+        queues[count] = queue
+
+    terms = export_report.LaytimeTerms(allowed_days=3, demurrage_rate=20000, dispatch_rate=10000)
+    rows_per_export = sum(len(results[i % len(results)]["events"]) for i in range(max(voyage_counts)))
+
+    def run_export(queue, export_format):
+        size = 0
+        for chunk in export_report.export(queue.iter_results(), export_format, "events", terms):
+            size += len(chunk)
+        return size
+
+    largest = queues[max(voyage_counts)]
+    workloads = [lambda f=f: run_export(largest, f) and rows_per_export for f in export_report.FORMATS]
+    metrics = measure(workloads, iterations, "rows")
+    metrics["fixtures"] = len(results)
+    metrics["rows_per_export"] = rows_per_export
+    for export_format in export_report.FORMATS:
+        metrics[f"{export_format}_kb"] = round(run_export(largest, export_format) / 1024, 1)
+        for count, queue in queues.items():
+            metrics[f"{export_format}_peak_kb_{count}_voyages"] = _peak_kb(lambda q=queue, f=export_format: run_export(q, f))
+    return metrics
+
+
+class QuotaError(Exception):
+    """A stand-in for Gemini's 429 ResourceExhausted (rate_limiter reads `.code`)."""
+    code = 429
+
+
+def bench_rate_limit(fixtures: List[Dict[str, Any]], iterations: int, pages: int = 16,
+                     quota_errors: int = 2) -> Optional[Dict[str, Any]]:
+    """
+    A burst of parallel page calls (SOF_PARSE_WORKERS at a time) through a fresh Gemini
+    ServiceGuard, each answered with `quota_errors` 429s before it succeeds. Every page
+    should come back: 429s slow the token bucket but must not open the circuit breaker
+    partway through the retries (page_success is the share of pages that did).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import parse_strategy
+    import rate_limiter
+
+    outcomes = {"ok": 0, "lost": 0, "opened": 0}
+
+    def run_burst():
+        guard = rate_limiter.ServiceGuard("Gemini", requests_per_minute=60_000, burst=5,
+                                          base_delay=0.001, max_delay=0.01)
+        attempts: Dict[int, int] = {}
+
+        def page_call(page: int) -> int:
+            attempts[page] = attempts.get(page, 0) + 1
+            if attempts[page] <= quota_errors:
+                raise QuotaError("429 Resource has been exhausted (e.g. check quota)")
+            return page
+
+        def parse_page(page: int) -> bool:
+            try:
+                guard.call(page_call, page)
+                return True
+            except (rate_limiter.CircuitOpenError, rate_limiter.BackendUnavailableError):
+                return False
+
+        with ThreadPoolExecutor(max_workers=parse_strategy.PARSE_WORKERS) as pool:
+            results = list(pool.map(parse_page, range(pages)))
+        outcomes["ok"] += sum(results)
+        outcomes["lost"] += results.count(False)
+        outcomes["opened"] += guard.breaker.state != "closed"
+        return sum(results)
+
+    metrics = measure([run_burst], iterations, "pages")
+    metrics["page_success"] = round(outcomes["ok"] / (outcomes["ok"] + outcomes["lost"]), 4)
+    metrics["pages_lost"] = outcomes["lost"]
+    metrics["breaker_opened"] = outcomes["opened"]
+    return metrics
+
+
+def bench_payload(fixtures: List[Dict[str, Any]], iterations: int, event_count: int = 2000) -> Optional[Dict[str, Any]]:
+    """
+    Result responses for a large timeline built from the fixtures' replayed events:
+    timing is JSON encoding plus compression, as /convert-pdf/ does per response.
+    Sizes are reported uncompressed, gzip, brotli (when installed) and as an events
+    delta against the same timeline with one time amended and one event inserted,
+    with the time to compute the delta and to parse each form.
+    """
+    import result_payloads
+
+    results = [replay_parser_output(f) for f in fixtures if f["gemini"]]
+    events = [event for r in results if isinstance(r, dict) for event in r.get("events") or []]
+    if not events:
+        return None
+
+    timeline = [dict(events[i % len(events)], sequence=i) for i in range(event_count)]
+    amended = [dict(event) for event in timeline]
+    amended[event_count // 2]["start_time"] = "23:59"
+    amended.insert(event_count // 4, dict(events[0], sequence=-1))
+    content = {"message": "PDF successfully converted to JSON", "filename": "timeline.pdf", "data": {"events": timeline}}
+
+    def encode(accept_encoding):
+        body = json.dumps(content, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        return result_payloads.encode(body, accept_encoding)[0]
+
+    metrics = measure([lambda: encode("gzip") and 1], iterations, "responses")
+    metrics["fixtures"] = sum(1 for r in results if isinstance(r, dict) and r.get("events"))
+    full = json.dumps(content, separators=(",", ":"), ensure_ascii=False)
+    metrics["events"] = event_count
+    metrics["full_kb"] = round(len(full.encode("utf-8")) / 1024, 1)
+    metrics["gzip_kb"] = round(len(encode("gzip")) / 1024, 1)
+    if result_payloads.brotli is not None:
+        metrics["br_kb"] = round(len(encode("br")) / 1024, 1)
+
+    t0 = time.perf_counter()
+    delta = result_payloads.delta_if_smaller('W/"base"', timeline, amended)
+    metrics["delta_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    delta_body = json.dumps({"message": content["message"], "data": {}, "events_delta": delta}, separators=(",", ":"))
+    metrics["delta_kb"] = round(len(delta_body.encode("utf-8")) / 1024, 2)
+    metrics["delta_exact"] = result_payloads.apply_delta(timeline, delta["ops"]) == amended
+    for form, body in (("full", full), ("delta", delta_body)):
+        t0 = time.perf_counter()
+        json.loads(body)
+        metrics[f"{form}_parse_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    return metrics
+
+
+TIME_TO_AMEND = re.compile(r"\b1\d[.:]?[0-5]0\b")
+
+
+def bench_dedup(fixtures: List[Dict[str, Any]], iterations: int, index_size: int = 10000) -> Optional[Dict[str, Any]]:
+    """
+    Near-duplicate lookup against an index of the fixtures plus `index_size` unrelated
+    documents, for three re-uploads of each fixture: re-laid-out text (as from a digital
+    copy), 1% of characters misread (as from a scan) and one time amended. Timing is per
+    lookup; fingerprinting time is reported per page. Only the re-laid-out copies should
+    reuse a result, and every variant should find its original.
+    """
+    import near_duplicates
+
+    documents = {f["name"]: f["ocr_text"].split(PAGE_BREAK) for f in fixtures if f["ocr_text"]}
+    if not documents:
+        return None
+
+    rng = random.Random(0)
+
+    def relayout(pages):
+        return [re.sub(r" {2,}", lambda m: " " * rng.randint(2, 6), page).lower() for page in pages]
+
+    def misread(pages):
+        return ["".join(rng.choice("O0Il1S5") if c.isalnum() and rng.random() < 0.01 else c for c in page) for page in pages]
+
+    def amend(pages):
+        # The first page with a time on it; cover pages of some samples have none
+        i = next((i for i, page in enumerate(pages) if TIME_TO_AMEND.search(page)), 0)
+        return pages[:i] + [TIME_TO_AMEND.sub("23.59", pages[i], count=1)] + pages[i + 1:]
+
+    index = near_duplicates.NearDuplicateIndex()
+    page_count = sum(len(pages) for pages in documents.values())
+    t0 = time.perf_counter()
+    for name, pages in documents.items():
+        index.add(name, near_duplicates.fingerprint_pages(pages))
+    fingerprint_ms = (time.perf_counter() - t0) * 1000 / page_count
+
+    words = " ".join(" ".join(pages) for pages in documents.values()).split()
+    for i in range(index_size):
+        index.add(f"unrelated-{i}", near_duplicates.fingerprint_pages([" ".join(rng.sample(words, min(300, len(words))))]))
+
+    variants = {"relayout": relayout, "misread": misread, "amended": amend}
+    queries = [(name, kind, near_duplicates.fingerprint_pages(make(pages)))
+               for name, pages in documents.items() for kind, make in variants.items()]
+    metrics = measure([lambda fp=fp: index.match(fp) and 1 for _, _, fp in queries], iterations, "lookups")
+    metrics["index_size"] = index_size + len(documents)
+    metrics["fingerprint_ms_per_page"] = round(fingerprint_ms, 3)
+    for kind in variants:
+        matches = [(name, index.match(fp)) for name, k, fp in queries if k == kind]
+        metrics[f"{kind}_found"] = sum(1 for name, match in matches if match and match.doc_hash == name)
+        metrics[f"{kind}_reused"] = sum(1 for _, match in matches if match and match.reusable)
+        metrics[f"{kind}_min_similarity"] = min((match.similarity if match else 0.0) for _, match in matches)
+    return metrics
+
+
+def install_pipeline_replay(main_module, fixtures: List[Dict[str, Any]]):
+    """
+    Replaces the OCR and parser stages used by main.py with in-process replays of
+    the fixtures, so the API can be load-tested without Google Cloud.
+    Returns a function that restores the real stages.
+    """
+    by_filename = {f["filename"]: f for f in fixtures}
+    original_stages = (main_module.run_ocr_stage, main_module.run_parser_stage)
+
+    def replay_ocr_stage(pdf_path, output_txt):
+        fixture = by_filename[os.path.basename(pdf_path)]
+        with open(output_txt, "w", encoding="utf-8") as outfile:
+            replay_layout(fixture, outfile)
+        # The parser stage only receives the text file, so remember which fixture produced it
+        with open(output_txt + ".fixture", "w", encoding="utf-8") as marker:
+            marker.write(fixture["filename"])
+
+    def replay_parser_stage(input_txt, output_json):
+        with open(input_txt + ".fixture", "r", encoding="utf-8") as marker:
+            fixture = by_filename[marker.read()]
+        # Same read + split the parser does before calling Gemini
+        with open(input_txt, "r", encoding="utf-8") as f:
+            f.read().split(PAGE_BREAK)
+        final_json = replay_parser_output(fixture)
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(final_json, f, indent=2)
+        return final_json
+
+    main_module.run_ocr_stage = replay_ocr_stage
+    main_module.run_parser_stage = replay_parser_stage
+
+    def restore():
+        main_module.run_ocr_stage, main_module.run_parser_stage = original_stages
+    return restore
+
+
+def bench_api(fixtures: List[Dict[str, Any]], iterations: int, concurrency: int) -> Optional[Dict[str, Any]]:
+    """End-to-end POST /convert-pdf/ throughput under concurrent load, with replayed stages."""
+    import httpx
+    import main
+
+    fixtures = [f for f in fixtures if f["docai"] and f["gemini"]]
+    if not fixtures:
+        return None
+
+    uploads = []
+    for fixture in fixtures:
+        pdf_bytes = b"%PDF-1.4\n%benchmark placeholder\n"
+        if fixture["sample"] and os.path.exists(os.path.join(SAMPLE_DIR, fixture["sample"])):
+            with open(os.path.join(SAMPLE_DIR, fixture["sample"]), "rb") as f:
+                pdf_bytes = f.read()
+        uploads.append((fixture["filename"], pdf_bytes))
+
+    async def run_load():
+        latencies = []
+        events = 0
+        semaphore = asyncio.Semaphore(concurrency)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            async def one(filename, pdf_bytes):
+                nonlocal events
+                async with semaphore:
+                    t0 = time.perf_counter()
+                    response = await client.post("/convert-pdf/", files={"pdf": (filename, pdf_bytes, "application/pdf")})
+                    latencies.append(time.perf_counter() - t0)
+                    response.raise_for_status()
+                    events += len(response.json()["data"].get("events", []))
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(*upload) for _ in range(iterations) for upload in uploads))
+            return latencies, events, time.perf_counter() - started
+
+    restore = install_pipeline_replay(main, fixtures)
+    # Every request re-uploads the same PDFs, which would otherwise return stored results
+    dedup_enabled, main.near_duplicates.ENABLED = main.near_duplicates.ENABLED, False
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Steady-state throughput only; start-up is measured by the cold_start stage
+            main.ensure_warm_up_started()
+            main.warm_up_done.wait()
+            latencies, events, elapsed = asyncio.run(run_load())
+            tracemalloc.start()
+            try:
+                asyncio.run(run_load())
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+    finally:
+        restore()
+        main.near_duplicates.ENABLED = dedup_enabled
+
+    metrics = summarize(latencies, events, elapsed, peak, "events")
+    metrics["fixtures"] = len(fixtures)
+    metrics["concurrency"] = concurrency
+    return metrics
+
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_status(url: str, deadline: float) -> Optional[float]:
+    """Polls url until it answers 200; returns the time it did, or None on timeout."""
+    import urllib.error
+    import urllib.request
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def bench_cold_start(iterations: int, timeout: float = 60.0) -> Optional[Dict[str, Any]]:
+    """
+    Spawns the API server from scratch and times the first successful /health
+    (liveness) and /ready (SDKs loaded) responses.
+    """
+    import resource
+
+    env = dict(os.environ)
+    # Readiness needs a Gemini key; the value is never used to call the API here
+    env.setdefault("GOOGLE_API_KEY", "benchmark-placeholder")
+    live_times, ready_times = [], []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        port = _free_port()
+        t0 = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            deadline = time.time() + timeout
+            live_at = _wait_for_status(f"http://127.0.0.1:{port}/health", deadline)
+            ready_at = _wait_for_status(f"http://127.0.0.1:{port}/ready", deadline)
+        finally:
+            server.terminate()
+            server.wait()
+        if live_at is None or ready_at is None:
+            print(f"  server did not become {'live' if live_at is None else 'ready'} within {timeout}s")
+            return None
+        live_times.append(live_at - t0)
+        ready_times.append(ready_at - t0)
+    elapsed = time.perf_counter() - started
+
+    peak_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    metrics = summarize(live_times, len(live_times), elapsed, peak_kb * 1024, "starts")
+    metrics["ready_p50_ms"] = round(percentile(ready_times, 50) * 1000, 3)
+    metrics["ready_p95_ms"] = round(percentile(ready_times, 95) * 1000, 3)
+    return metrics
+
+
+STAGES = {
+    "layout": lambda fixtures, args: bench_layout(fixtures, args.iterations),
+    "layout_rows": lambda fixtures, args: bench_layout_rows(fixtures, args.iterations),
+    "json": lambda fixtures, args: bench_json(fixtures, args.iterations),
+    "merge": lambda fixtures, args: bench_merge(fixtures, args.iterations),
+    "prompt": lambda fixtures, args: bench_prompt(fixtures, args.iterations),
+    "parse_memory": lambda fixtures, args: bench_parse_memory(fixtures, max(1, args.iterations // 5)),
+    "strategy": lambda fixtures, args: bench_strategy(fixtures, max(1, args.iterations // 5)),
+    "dedup": lambda fixtures, args: bench_dedup(fixtures, args.iterations),
+    "export": lambda fixtures, args: bench_export(fixtures, max(1, args.iterations // 5)),
+    "payload": lambda fixtures, args: bench_payload(fixtures, args.iterations),
+    "rate_limit": lambda fixtures, args: bench_rate_limit(fixtures, max(1, args.iterations // 5)),
+    "api": lambda fixtures, args: bench_api(fixtures, max(1, args.iterations // 5), args.concurrency),
+    "cold_start": lambda fixtures, args: bench_cold_start(min(args.iterations, 5)),
+    "gcs": lambda fixtures, args: bench_gcs(fixtures, max(1, args.iterations // 2)),
+}
+
+
+# --- Baseline Comparison ---
+def compare_to_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Returns one message per metric that regressed by more than `tolerance` (a fraction)."""
+    regressions = []
+    for stage, metrics in results.items():
+        base = baseline.get(stage)
+        if not base:
+            continue
+        timing_is_noise = base.get("p50_ms", 0) < NOISE_FLOOR_MS
+        for key in LOWER_IS_BETTER:
+            if timing_is_noise and key in TIMING_METRICS:
+                continue
+            if base.get(key) and metrics.get(key, 0) > base[key] * (1 + tolerance):
+                regressions.append(f"{stage}.{key}: {metrics[key]} vs baseline {base[key]}")
+        for key in HIGHER_IS_BETTER:
+            if timing_is_noise and key in TIMING_METRICS:
+                continue
+            if base.get(key) and metrics.get(key, 0) < base[key] * (1 - tolerance):
+                regressions.append(f"{stage}.{key}: {metrics[key]} vs baseline {base[key]}")
+    return regressions
+
+
+def print_results(results: Dict[str, Any], baseline: Dict[str, Any]):
+    """Prints a table of the current numbers next to the baseline."""
+    print(f"\n{'stage':<12}{'p50 ms':>12}{'p95 ms':>12}{'peak KB':>12}{'throughput':>16}  unit")
+    for stage, metrics in results.items():
+        print(f"{stage:<12}{metrics['p50_ms']:>12}{metrics['p95_ms']:>12}{metrics['peak_mem_kb']:>12}"
+              f"{metrics['throughput']:>16}  {metrics['unit']}")
+        for key, value in metrics.items():
+            if key not in ("p50_ms", "p95_ms", "peak_mem_kb", "throughput", "unit", "samples"):
+                print(f"{'':<12}{key} = {value}")
+        base = baseline.get(stage)
+        if base:
+            print(f"{'  baseline':<12}{base.get('p50_ms', '-'):>12}{base.get('p95_ms', '-'):>12}"
+                  f"{base.get('peak_mem_kb', '-'):>12}{base.get('throughput', '-'):>16}")
+
+
+def run_benchmarks(args) -> int:
+    fixtures = load_fixtures(args.fixtures)
+    report_fixture_coverage(fixtures)
+    if not fixtures:
+        print("Error: no fixtures found. Record some with `python benchmark.py record <pdf>`.")
+        return 1
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        print(f"Error: unknown stage(s): {', '.join(unknown)}. Choose from {', '.join(STAGES)}.")
+        return 1
+
+    # The parser writes debug files into the working directory and main.py creates temp_* dirs there
+    work_dir = tempfile.mkdtemp(prefix="sof-bench-")
+    original_cwd = os.getcwd()
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(work_dir)
+    results = {}
+    try:
+        for stage in stages:
+            print(f"Running stage '{stage}'...")
+            metrics = STAGES[stage](fixtures, args)
+            if metrics is None:
+                print("  skipped: no fixtures with the data this stage needs")
+                continue
+            if "fixtures" in metrics and metrics["fixtures"] < len(fixtures):
+                print(f"  ran on {metrics['fixtures']} of {len(fixtures)} fixtures; the others have no recorded Gemini responses")
+            results[stage] = metrics
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("stages", {})
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"stages": results}, f, indent=2)
+
+    if args.update_baseline or not baseline:
+        merged = dict(baseline)
+        merged.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "stages": merged}, f, indent=2)
+        print(f"\nBaseline written to '{args.baseline}'.")
+        return 0
+
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\nREGRESSIONS (more than {args.tolerance:.0%} worse than baseline):")
+        for message in regressions:
+            print(f"  - {message}")
+        return 1
+    print("\nNo regressions against baseline.")
+    return 0
+
+
+# --- Recording ---
+def record_text_layer_fixture(args) -> int:
+    """
+    Stores a PDF's embedded text layer, laid out in columns, as a fixture's ocr.txt without
+    calling Google. Only digital PDFs have a text layer; scans still need `record`.
+    Replay synthesizes Document AI lines from it, and stages that need Gemini responses skip it.
+    """
+    from pypdf import PdfReader
+
+    pdf_filename = os.path.basename(args.pdf_path)
+    pages = [page.extract_text(extraction_mode="layout") or "" for page in PdfReader(args.pdf_path).pages]
+    if not any(page.strip() for page in pages):
+        print(f"Error: {pdf_filename} has no text layer; record it with Document AI instead.")
+        return 1
+
+    name = args.name or os.path.splitext(pdf_filename)[0]
+    fixture_dir = os.path.join(args.fixtures, name)
+    os.makedirs(fixture_dir, exist_ok=True)
+    with open(os.path.join(fixture_dir, "ocr.txt"), "w", encoding="utf-8") as f:
+        f.write(OCR_Script.PAGE_SEPARATOR.join(page.strip("\n") for page in pages))
+    with open(os.path.join(fixture_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"sample": pdf_filename, "source": "text_layer"}, f, indent=2)
+
+    print(f"Recorded fixture '{name}' from the text layer: {len(pages)} page(s).")
+    return 0
+
+
+def record_fixture(args) -> int:
+    """Runs the real Document AI + Gemini pipeline on a PDF and stores the raw outputs as a fixture."""
+    if args.text_layer:
+        return record_text_layer_fixture(args)
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    import parser_script
+    from google.cloud import storage
+
+    project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
+    if not project_id or not os.getenv("GOOGLE_API_KEY"):
+        print("Error: GOOGLE_CLOUD_PROJECT and GOOGLE_API_KEY must be set to record fixtures.")
+        return 1
+    parser_script.configure_gemini(os.getenv("GOOGLE_API_KEY"))
+
+    pdf_filename = os.path.basename(args.pdf_path)
+    name = args.name or os.path.splitext(pdf_filename)[0]
+    fixture_dir = os.path.join(args.fixtures, name)
+    docai_dir = os.path.join(fixture_dir, "docai")
+    gemini_dir = os.path.join(fixture_dir, "gemini")
+    os.makedirs(docai_dir, exist_ok=True)
+    os.makedirs(gemini_dir, exist_ok=True)
+
+    timestamp = int(time.time())
+    gcs_filename = f"docai-input/{timestamp}-{pdf_filename}"
+    gcs_output_prefix = f"docai-output/{timestamp}-{pdf_filename}/"
+    gcs_input_uri = OCR_Script.upload_to_gcs(args.bucket_name, args.pdf_path, gcs_filename)
+    try:
+        operation_id = OCR_Script.batch_process_documents_with_doc_ai(
+            project_id, args.location, args.processor_id,
+            gcs_input_uri, f"gs://{args.bucket_name}/{gcs_output_prefix}"
+        )
+        bucket = storage.Client().bucket(args.bucket_name)
+        for shard_number, blob in enumerate(bucket.list_blobs(prefix=f"{gcs_output_prefix}{operation_id}/")):
+            if ".json" in blob.name:
+                with open(os.path.join(docai_dir, f"shard_{shard_number:03d}.json"), "wb") as f:
+                    f.write(blob.download_as_bytes())
+    finally:
+        OCR_Script.cleanup_gcs(args.bucket_name, gcs_output_prefix, gcs_filename)
+
+    fixture = next(f for f in load_fixtures(args.fixtures) if f["name"] == name)
+    out = io.StringIO()
+    replay_layout(fixture, out)
+    sof_text = out.getvalue()
+
+    # Capture every raw Gemini response in call order; cached pages would make no calls
+    import page_cache
+    page_cache.ENABLED = False
+    responses = []
+    original_generate = parser_script.generate_model_text
+
+    def recording_generate(prompt, max_output_tokens):
+        text = original_generate(prompt, max_output_tokens)
+        responses.append(text)
+        return text
+
+    parser_script.generate_model_text = recording_generate
+    try:
+        if PAGE_BREAK not in sof_text:
+            parser_script.parse_single_page_sof(sof_text)
+        else:
+            for i, page_text in enumerate(sof_text.split(PAGE_BREAK)):
+                if page_text.strip():
+                    parser_script.parse_sof_chunk(page_text, is_first_page=(i == 0))
+    finally:
+        parser_script.generate_model_text = original_generate
+
+    for i, text in enumerate(responses, start=1):
+        with open(os.path.join(gemini_dir, f"page_{i:03d}.txt"), "w", encoding="utf-8") as f:
+            f.write(text)
+    with open(os.path.join(fixture_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"sample": pdf_filename}, f, indent=2)
+
+    print(f"Recorded fixture '{name}': {len(fixture['docai'])} Document AI shard(s), {len(responses)} Gemini response(s).")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SOF pipeline against recorded fixtures.")
+    parser.add_argument("--fixtures", default=FIXTURES_DIR, help="Directory holding the recorded fixtures.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and compare against the baseline.")
+    run_parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated stages to run.")
+    run_parser.add_argument("--iterations", type=int, default=20, help="Repetitions per fixture.")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="Concurrent requests for the api stage.")
+    run_parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file.")
+    run_parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before failing (0.25 = 25%%).")
+    run_parser.add_argument("--update-baseline", action="store_true", help="Store these results as the new baseline.")
+    run_parser.add_argument("--output", help="Also write the results to this JSON file.")
+
+    record_parser = subparsers.add_parser("record", help="Record Document AI and Gemini outputs for a PDF.")
+    record_parser.add_argument("pdf_path", help="The local path to the PDF file.")
+    record_parser.add_argument("--name", help="Fixture name (defaults to the PDF file name).")
+    record_parser.add_argument("--bucket-name", default=OCR_Script.DEFAULT_BUCKET_NAME)
+    record_parser.add_argument("--location", default=OCR_Script.DEFAULT_LOCATION)
+    record_parser.add_argument("--processor-id", default=OCR_Script.DEFAULT_PROCESSOR_ID)
+    record_parser.add_argument("--text-layer", action="store_true",
+                               help="Store the PDF's embedded text as OCR text, without Document AI or Gemini.")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        sys.exit(run_benchmarks(args))
+    sys.exit(record_fixture(args))
+
+
+if __name__ == "__main__":
+    main()
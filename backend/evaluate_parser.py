@@ -0,0 +1,335 @@
+"""
+Offline accuracy and cost evaluation for parser configurations.
+
+Runs each parser variant over the labeled fixtures in bench_fixtures/ (any fixture
+with a labels.json) and reports event recall/precision, Gemini token usage, number
+of calls and wall time, then picks the fastest variant that meets the accuracy bar:
+
+    python evaluate_parser.py run
+    python evaluate_parser.py run --variants current,tight_budget --min-recall 0.95
+    python evaluate_parser.py label "<fixture>"   # bootstrap labels.json for review
+
+labels.json holds the expected output ({"events": [...]}) in the same schema the
+parser produces. Labels bootstrapped from a model response are marked
+"reviewed": false until someone has checked them against the PDF. Only reviewed labels
+count towards recall/precision; unreviewed ones are reported separately as agreement
+with that earlier model output, and are used to pick a variant only when no fixture has
+reviewed labels.
+
+Reviewed labels list one event per timed row of the document's events list, time sheet
+and delay tables, with dates, times and wording as written (dates carried down from the
+row above). Rows without a time, hatch/crane/barge tables and remarks are left out. OCR
+misreads are corrected only where the row's duration or neighbours pin the value;
+anything still illegible is left out and described in an optional "notes" field.
+"""
+import argparse
+import contextlib
+import difflib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmark import FIXTURES_DIR, PAGE_BREAK, load_fixtures, replay_layout, replay_parser_output
+from parse_strategy import MAX_OUTPUT_TOKENS
+
+# Parser configurations to compare. "pages_per_call": 0 sends the whole document in one call;
+# a "strategy" runs parse_sof_file with that parse_strategy setting ("auto" is the planner).
+VARIANTS = {
+    "current": {
+        "description": "One call per page, whole-document call for single pages (before the planner)",
+        "pages_per_call": 1, "base_tokens": 4096, "tokens_per_event": 50, "max_tokens": MAX_OUTPUT_TOKENS, "chunk_tokens": MAX_OUTPUT_TOKENS,
+    },
+    "tight_budget": {
+        "description": "Per-page calls with half the output token budget",
+        "pages_per_call": 1, "base_tokens": 2048, "tokens_per_event": 40, "max_tokens": MAX_OUTPUT_TOKENS // 2, "chunk_tokens": MAX_OUTPUT_TOKENS // 2,
+    },
+    "two_pages_per_call": {
+        "description": "Pairs of pages per call",
+        "pages_per_call": 2, "base_tokens": 4096, "tokens_per_event": 50, "max_tokens": MAX_OUTPUT_TOKENS, "chunk_tokens": MAX_OUTPUT_TOKENS,
+    },
+    "uncompacted_text": {
+        "description": "Per-page calls with the OCR column padding left in place",
+        "pages_per_call": 1, "base_tokens": 4096, "tokens_per_event": 50, "max_tokens": MAX_OUTPUT_TOKENS, "chunk_tokens": MAX_OUTPUT_TOKENS,
+        "compact_text": False,
+    },
+    "whole_document": {
+        "description": "One call for the whole document regardless of page count",
+        "pages_per_call": 0, "base_tokens": 4096, "tokens_per_event": 60, "max_tokens": MAX_OUTPUT_TOKENS, "chunk_tokens": MAX_OUTPUT_TOKENS,
+    },
+    "planned": {
+        "description": "Production behaviour: the parse strategy planner picks one call or page-parallel calls",
+        "strategy": "auto",
+    },
+    "rules": {
+        "description": "Rule-based extraction only, no model calls",
+        "strategy": "rules",
+    },
+}
+
+# gemini-1.5-flash list prices in USD per 1M tokens (prompts up to 128K)
+DEFAULT_INPUT_PRICE = 0.075
+DEFAULT_OUTPUT_PRICE = 0.30
+
+
+# --- Event Matching ---
+def _digits(value: Any) -> str:
+    return re.sub(r"\D", "", str(value or ""))
+
+
+def _normalize_text(value: Any) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", str(value or "").lower()).strip()
+
+
+def events_match(expected: Dict[str, Any], predicted: Dict[str, Any], text_threshold: float = 0.6) -> bool:
+    """Two events match when date and start time agree digit-for-digit and the descriptions are similar."""
+    if _digits(expected.get("start_date")) != _digits(predicted.get("start_date")):
+        return False
+    if _digits(expected.get("start_time")) != _digits(predicted.get("start_time")):
+        return False
+    ratio = difflib.SequenceMatcher(None, _normalize_text(expected.get("event")), _normalize_text(predicted.get("event"))).ratio()
+    return ratio >= text_threshold
+
+
+def score_events(expected: List[Dict[str, Any]], predicted: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Greedy one-to-one matching; returns true positives and the size of each side."""
+    unmatched = list(predicted)
+    true_positives = 0
+    for expected_event in expected:
+        for j, predicted_event in enumerate(unmatched):
+            if isinstance(predicted_event, dict) and events_match(expected_event, predicted_event):
+                true_positives += 1
+                del unmatched[j]
+                break
+    return {"true_positives": true_positives, "expected": len(expected), "predicted": len(predicted)}
+
+
+# --- Variant Execution ---
+def run_variant(sof_text: str, variant: Dict[str, Any]) -> Dict[str, Any]:
+    """Parses one document with a variant's settings, restoring the module settings afterwards."""
+    import parse_strategy
+    import prompt_builder
+
+    settings = (prompt_builder.COMPACT_TEXT, parse_strategy.STRATEGY)
+    prompt_builder.COMPACT_TEXT = variant.get("compact_text", True)
+    try:
+        return _run_variant(sof_text, variant)
+    finally:
+        prompt_builder.COMPACT_TEXT, parse_strategy.STRATEGY = settings
+
+
+def _run_variant(sof_text: str, variant: Dict[str, Any]) -> Dict[str, Any]:
+    import parse_strategy
+    import parser_script
+
+    if "strategy" in variant:
+        parse_strategy.STRATEGY = variant["strategy"]
+        with open("document.txt", "w", encoding="utf-8") as f:
+            f.write(sof_text)
+        return parser_script.parse_sof_file("document.txt", "document.json") or {"events": []}
+
+    pages = sof_text.split(PAGE_BREAK)
+    pages_per_call = variant["pages_per_call"]
+
+    if pages_per_call == 0 or len(pages) == 1:
+        budget = parser_script.single_page_token_budget(
+            parser_script.estimate_event_count(sof_text),
+            base_tokens=variant["base_tokens"],
+            tokens_per_event=variant["tokens_per_event"],
+            max_tokens=variant["max_tokens"],
+        )
+        parsed = parser_script.parse_single_page_sof(sof_text, max_tokens=budget)
+        return parsed if isinstance(parsed, dict) else {"events": []}
+
+    page_results = []
+    for start in range(0, len(pages), pages_per_call):
+        chunk = PAGE_BREAK.join(pages[start:start + pages_per_call])
+        if not chunk.strip():
+            continue
+        parsed = parser_script.parse_sof_chunk(chunk, is_first_page=(start == 0), max_output_tokens=variant["chunk_tokens"])
+        page_results.append((start, parsed))
+    return parser_script.merge_page_results(page_results)
+
+
+def document_text(fixtures_dir: str, fixture: Dict[str, Any]) -> str:
+    """The layout-reconstructed OCR text the parser would receive for a fixture."""
+    ocr_path = os.path.join(fixtures_dir, fixture["name"], "ocr.txt")
+    if os.path.exists(ocr_path):
+        with open(ocr_path, "r", encoding="utf-8") as f:
+            return f.read()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+        replay_layout(fixture, out)
+    return out.getvalue()
+
+
+def ratios(totals: Dict[str, int]) -> tuple:
+    """(recall, precision) of summed scores, None when there was nothing to score."""
+    if not totals["expected"] and not totals["predicted"]:
+        return None, None
+    recall = round(totals["true_positives"] / totals["expected"], 4) if totals["expected"] else 0.0
+    precision = round(totals["true_positives"] / totals["predicted"], 4) if totals["predicted"] else 0.0
+    return recall, precision
+
+
+def _cell(value: Optional[float]) -> str:
+    return "-" if value is None else str(value)
+
+
+def load_labels(fixtures_dir: str, name: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(fixtures_dir, name, "labels.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def evaluate(args) -> int:
+    from dotenv import load_dotenv
+    import page_cache
+    import parser_script
+
+    # Every variant must pay for its own calls
+    page_cache.ENABLED = False
+    load_dotenv()
+
+    names = [v.strip() for v in args.variants.split(",") if v.strip()]
+    unknown = [v for v in names if v not in VARIANTS]
+    if unknown:
+        print(f"Error: unknown variant(s): {', '.join(unknown)}. Choose from {', '.join(VARIANTS)}.")
+        return 1
+
+    # Rule-based variants make no calls and can be evaluated without a key
+    if any(VARIANTS[name].get("strategy") != "rules" for name in names):
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            print("Error: Google API key not found. Please create a .env file and add: GOOGLE_API_KEY='your_key_here'")
+            return 1
+        parser_script.configure_gemini(api_key)
+
+    labeled = []
+    for fixture in load_fixtures(args.fixtures):
+        labels = load_labels(args.fixtures, fixture["name"])
+        if labels is None:
+            continue
+        reviewed = bool(labels.get("reviewed", False))
+        if not reviewed:
+            print(f"Warning: labels for '{fixture['name']}' have not been reviewed yet; scoring them as agreement only.")
+        labeled.append((fixture, document_text(args.fixtures, fixture), labels.get("events", []), reviewed))
+    if not labeled:
+        print("Error: no labeled fixtures found. Bootstrap one with `python evaluate_parser.py label <fixture>`.")
+        return 1
+
+    # The parser writes debug files into the working directory
+    work_dir = tempfile.mkdtemp(prefix="sof-eval-")
+    original_cwd = os.getcwd()
+    os.chdir(work_dir)
+    report = {}
+    try:
+        for name in names:
+            print(f"Evaluating variant '{name}' on {len(labeled)} document(s)...")
+            parser_script.reset_usage()
+            # Reviewed labels measure accuracy; unreviewed ones only agreement with earlier model output
+            totals = {kind: {"true_positives": 0, "expected": 0, "predicted": 0} for kind in (True, False)}
+            started = time.perf_counter()
+            for fixture, sof_text, expected, reviewed in labeled:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = run_variant(sof_text, VARIANTS[name])
+                scores = score_events(expected, result.get("events", []))
+                for key in scores:
+                    totals[reviewed][key] += scores[key]
+            wall_time = time.perf_counter() - started
+
+            usage = dict(parser_script.usage_totals)
+            accuracy, agreement = ratios(totals[True]), ratios(totals[False])
+            report[name] = {
+                "recall": accuracy[0],
+                "precision": accuracy[1],
+                "agreement_recall": agreement[0],
+                "agreement_precision": agreement[1],
+                "calls": usage["calls"],
+                "prompt_tokens": usage["prompt_tokens"],
+                "output_tokens": usage["output_tokens"],
+                "cost_usd": round((usage["prompt_tokens"] * args.input_price + usage["output_tokens"] * args.output_price) / 1e6, 5),
+                "wall_time_s": round(wall_time, 2),
+            }
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n{'variant':<22}{'recall':>8}{'prec.':>8}{'agr.rec':>9}{'agr.prec':>9}{'calls':>7}{'in tok':>10}"
+          f"{'out tok':>10}{'cost $':>10}{'wall s':>9}")
+    for name, row in report.items():
+        print(f"{name:<22}{_cell(row['recall']):>8}{_cell(row['precision']):>8}{_cell(row['agreement_recall']):>9}"
+              f"{_cell(row['agreement_precision']):>9}{row['calls']:>7}{row['prompt_tokens']:>10}"
+              f"{row['output_tokens']:>10}{row['cost_usd']:>10}{row['wall_time_s']:>9}")
+
+    # Select on accuracy; only without any reviewed labels fall back to agreement, and say so
+    basis = "" if any(reviewed for *_, reviewed in labeled) else "agreement_"
+    if basis:
+        print("\nNo fixture has reviewed labels: selecting on agreement with unreviewed labels, not accuracy.")
+    passing = [n for n, row in report.items()
+               if (row[f"{basis}recall"] or 0) >= args.min_recall and (row[f"{basis}precision"] or 0) >= args.min_precision]
+    if passing:
+        best = min(passing, key=lambda n: report[n]["wall_time_s"])
+        print(f"\nFastest variant meeting {basis}recall >= {args.min_recall} and {basis}precision >= {args.min_precision}: '{best}'")
+    else:
+        best = None
+        print(f"\nNo variant met {basis}recall >= {args.min_recall} and {basis}precision >= {args.min_precision}.")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"variants": report, "selected": best}, f, indent=2)
+    return 0 if best else 1
+
+
+def bootstrap_labels(args) -> int:
+    """Writes labels.json for a fixture from its recorded Gemini output, for manual review."""
+    fixture = next((f for f in load_fixtures(args.fixtures) if f["name"] == args.fixture), None)
+    if fixture is None or not fixture["gemini"]:
+        print(f"Error: fixture '{args.fixture}' not found or has no recorded Gemini responses.")
+        return 1
+
+    path = os.path.join(args.fixtures, args.fixture, "labels.json")
+    if os.path.exists(path) and not args.force:
+        print(f"Error: '{path}' already exists. Use --force to overwrite it.")
+        return 1
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        parsed = replay_parser_output(fixture)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"reviewed": False, "events": parsed.get("events", [])}, f, indent=2)
+    print(f"Wrote {len(parsed.get('events', []))} events to '{path}'. Check them against the PDF and set \"reviewed\": true.")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate parser variants for accuracy, token usage and speed.")
+    parser.add_argument("--fixtures", default=FIXTURES_DIR, help="Directory holding the recorded fixtures.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Evaluate parser variants against the labeled fixtures.")
+    run_parser.add_argument("--variants", default=",".join(VARIANTS), help="Comma-separated variants to evaluate.")
+    run_parser.add_argument("--min-recall", type=float, default=0.9)
+    run_parser.add_argument("--min-precision", type=float, default=0.9)
+    run_parser.add_argument("--input-price", type=float, default=DEFAULT_INPUT_PRICE, help="USD per 1M prompt tokens.")
+    run_parser.add_argument("--output-price", type=float, default=DEFAULT_OUTPUT_PRICE, help="USD per 1M output tokens.")
+    run_parser.add_argument("--output", help="Also write the report to this JSON file.")
+
+    label_parser = subparsers.add_parser("label", help="Bootstrap labels.json from a fixture's recorded responses.")
+    label_parser.add_argument("fixture", help="Fixture directory name.")
+    label_parser.add_argument("--force", action="store_true", help="Overwrite existing labels.")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        sys.exit(evaluate(args))
+    sys.exit(bootstrap_labels(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""
+Server-side export of extracted events and laytime summaries.
+
+Renders finished documents from the job queue as CSV, XLSX or PDF for one voyage
+(a doc_hash) or every voyage processed in a date range. Documents are read in
+small batches (JobQueue.iter_results) and each format is written incrementally, so
+an export of a year of SOFs streams out at a steady memory footprint instead of
+being assembled in the browser from localStorage.
+
+Laytime follows the results page (docs/assets/js/extraction-results.js): each
+event uses end time minus start time, wrapping past midnight; used laytime is the
+running total; remaining is the allowed laytime minus that total; a negative
+balance is charged at the demurrage rate per day and a positive one credited at
+the dispatch rate per day.
+
+XLSX and PDF are written directly (a minimal SpreadsheetML package and a PDF with
+the standard Helvetica font), so exporting needs no extra dependencies.
+"""
+import csv
+import io
+import re
+import time
+import zipfile
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "pdf": ("application/pdf", "pdf"),
+}
+REPORTS = ("events", "summary")
+
+COLUMNS = {
+    "events": [
+        "Voyage", "Vessel", "Port", "Event", "Day", "Date", "Start", "End",
+        "Duration (hrs)", "Used (hrs)", "Remaining (hrs)",
+    ],
+    "summary": [
+        "Voyage", "Vessel", "Port", "Processed", "Events", "First Date", "Last Date",
+        "Allowed (hrs)", "Used (hrs)", "Remaining (hrs)", "Demurrage", "Dispatch",
+    ],
+}
+# Relative PDF column widths; text longer than its column is cut with "..."
+PDF_WIDTHS = {
+    "events": [13, 10, 9, 28, 5, 7, 5, 5, 8, 8, 9],
+    "summary": [14, 11, 10, 11, 5, 8, 8, 8, 8, 9, 8, 8],
+}
+
+TIME_OF_DAY = re.compile(r"^(\d{1,2})[.:]?(\d{2})$")
+PORT_FIELDS = ("port_of_loading_cargo", "port_of_discharge", "port")
+
+
+@dataclass
+class LaytimeTerms:
+    """Charter party terms from the export request: allowed laytime and daily rates."""
+    allowed_days: float = 0.0
+    demurrage_rate: float = 0.0
+    dispatch_rate: float = 0.0
+
+    @property
+    def allowed_hours(self) -> float:
+        return self.allowed_days * 24
+
+
+def minutes_of_day(value: Any) -> Optional[int]:
+    """'2005', '20.05' or '20:05' as minutes past midnight (24.00 is the end of the day); None otherwise."""
+    match = TIME_OF_DAY.match(str(value or "").strip())
+    if not match:
+        return None
+    hours, minutes = int(match.group(1)), int(match.group(2))
+    if minutes > 59 or hours * 60 + minutes > 24 * 60:
+        return None
+    return hours * 60 + minutes
+
+
+def event_hours(event: Dict[str, Any]) -> float:
+    """Laytime used by one event; 0 when either time is missing or unreadable."""
+    start = minutes_of_day(event.get("start_time"))
+    end = minutes_of_day(event.get("end_time"))
+    if start is None or end is None:
+        return 0.0
+    difference = end - start
+    if difference < 0:
+        difference += 24 * 60  # ends the next day
+    return difference / 60
+
+
+def _voyage_details(document: Dict[str, Any]) -> Tuple[str, str, str, List[Dict[str, Any]]]:
+    data = document.get("result") or {}
+    vessel_info = data.get("vessel_info") or {}
+    port = next((vessel_info[field] for field in PORT_FIELDS if vessel_info.get(field)), "")
+    return document["filename"], vessel_info.get("name_of_vessel", ""), port, data.get("events") or []
+
+
+def voyage_rows(document: Dict[str, Any], report: str, terms: LaytimeTerms) -> Iterator[List[Any]]:
+    """Rows for one voyage: one per event, or its single laytime summary row."""
+    voyage, vessel, port, events = _voyage_details(document)
+    used = 0.0
+    for event in events:
+        hours = event_hours(event)
+        used += hours
+        if report == "events":
+            yield [
+                voyage, vessel, port, event.get("event", ""), event.get("day", ""), event.get("start_date", ""),
+                event.get("start_time", ""), event.get("end_time", ""),
+                round(hours, 2), round(used, 2), round(terms.allowed_hours - used, 2),
+            ]
+    if report == "summary":
+        remaining = terms.allowed_hours - used
+        dates = [event.get("start_date") for event in events if event.get("start_date")]
+        yield [
+            voyage, vessel, port, time.strftime("%Y-%m-%d %H:%M", time.gmtime(document["updated_at"])), len(events),
+            dates[0] if dates else "", dates[-1] if dates else "",
+            round(terms.allowed_hours, 2), round(used, 2), round(remaining, 2),
+            round(max(-remaining, 0) / 24 * terms.demurrage_rate, 2),
+            round(max(remaining, 0) / 24 * terms.dispatch_rate, 2),
+        ]
+
+
+def report_rows(documents: Iterable[Dict[str, Any]], report: str, terms: LaytimeTerms) -> Iterator[List[List[Any]]]:
+    """Rows grouped per voyage, so writers flush once per document."""
+    for document in documents:
+        rows = list(voyage_rows(document, report, terms))
+        if rows:
+            yield rows
+
+
+# --- CSV ---
+def write_csv(batches: Iterable[List[List[Any]]], report: str) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")  # lets Excel detect UTF-8
+    writer.writerow(COLUMNS[report])
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+# --- XLSX ---
+class _ChunkSink:
+    """Write-only file object that hands back whatever was written since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/styles.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+        '<borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf/></cellStyleXfs>'
+        '<cellXfs count="2"><xf/><xf fontId="1" applyFont="1"/></cellXfs>'
+        '</styleSheet>'
+    ),
+}
+
+
+def _xlsx_row(values: List[Any], style: str = "") -> str:
+    cells = []
+    for value in values:
+        if isinstance(value, (int, float)):
+            cells.append(f"<c{style}><v>{value}</v></c>")
+        else:
+            cells.append(f'<c{style} t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>')
+    return "<row>" + "".join(cells) + "</row>"
+
+
+def write_xlsx(batches: Iterable[List[List[Any]]], report: str) -> Iterator[bytes]:
+    sink = _ChunkSink()
+    # An unseekable target makes zipfile write sizes in data descriptors, so entries stream as written
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as package:
+        for name, xml in XLSX_PARTS.items():
+            package.writestr(name, xml)
+        package.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{report.capitalize()}" sheetId="1" r:id="rId1"/></sheets></workbook>',
+        )
+        with package.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(_xlsx_row(COLUMNS[report], ' s="1"').encode("utf-8"))
+            for rows in batches:
+                sheet.write("".join(_xlsx_row(row) for row in rows).encode("utf-8"))
+                yield sink.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield sink.drain()
+
+
+# --- PDF ---
+PAGE_WIDTH, PAGE_HEIGHT = 842, 595  # A4 landscape, in points
+MARGIN = 28
+FONT_SIZE = 7
+LINE_HEIGHT = 10
+CHAR_WIDTH = 0.5 * FONT_SIZE  # average Helvetica advance; enough to keep columns apart
+
+
+def _pdf_text(value: Any, max_chars: int) -> str:
+    text = f"{value:.2f}" if isinstance(value, float) else str(value)
+    if len(text) > max_chars:
+        text = text[:max(max_chars - 3, 1)] + "..."
+    text = text.encode("latin-1", "replace").decode("latin-1")
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+class _PdfStream:
+    """Writes numbered PDF objects in order, remembering their offsets for the xref table."""
+
+    def __init__(self):
+        self.offset = 0
+        self.offsets = {}
+
+    def header(self) -> bytes:
+        return self._emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def object(self, number: int, body: bytes) -> bytes:
+        self.offsets[number] = self.offset
+        return self._emit(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    def trailer(self, root: int) -> bytes:
+        count = max(self.offsets) + 1
+        xref = [b"xref\n0 %d\n0000000000 65535 f \n" % count]
+        xref += [b"%010d 00000 n \n" % self.offsets[number] for number in range(1, count)]
+        start = self.offset
+        return self._emit(b"".join(xref) + b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (count, root, start))
+
+    def _emit(self, data: bytes) -> bytes:
+        self.offset += len(data)
+        return data
+
+
+def _pdf_page_content(title: str, header: List[str], rows: List[List[Any]], widths: List[float]) -> bytes:
+    scale = (PAGE_WIDTH - 2 * MARGIN) / sum(widths)
+    x_positions, x = [], MARGIN
+    for width in widths:
+        x_positions.append(x)
+        x += width * scale
+    max_chars = [max(int(width * scale / CHAR_WIDTH) - 1, 1) for width in widths]
+
+    lines = [f"BT /F1 10 Tf {MARGIN} {PAGE_HEIGHT - MARGIN} Td ({_pdf_text(title, 150)}) Tj ET"]
+    y = PAGE_HEIGHT - MARGIN - 2 * LINE_HEIGHT
+    for index, row in enumerate([header] + rows):
+        font = "/F2" if index == 0 else "/F1"
+        for value, x, limit in zip(row, x_positions, max_chars):
+            lines.append(f"BT {font} {FONT_SIZE} Tf {x:.1f} {y} Td ({_pdf_text(value, limit)}) Tj ET")
+        y -= LINE_HEIGHT
+    return "\n".join(lines).encode("latin-1")
+
+
+def write_pdf(batches: Iterable[List[List[Any]]], report: str, title: str = "") -> Iterator[bytes]:
+    rows_per_page = (PAGE_HEIGHT - 2 * MARGIN) // LINE_HEIGHT - 3
+    title = title or f"Laytime {report}"
+    pdf = _PdfStream()
+    # 1: catalog, 2: page tree, 3-4: fonts; pages are written from 5 on, and the page
+    # tree and catalog last, once the page list is known
+    yield pdf.header()
+    yield pdf.object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+    yield pdf.object(4, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>")
+
+    pages = []
+    pending = []
+
+    def flush_page(page_rows):
+        content = zlib.compress(_pdf_page_content(
+            f"{title} - page {len(pages) + 1}", COLUMNS[report], page_rows, PDF_WIDTHS[report]
+        ))
+        content_number = 5 + 2 * len(pages)
+        page_number = content_number + 1
+        pages.append(page_number)
+        return pdf.object(
+            content_number, b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(content) + content + b"\nendstream"
+        ) + pdf.object(
+            page_number,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> >>" % (PAGE_WIDTH, PAGE_HEIGHT, content_number),
+        )
+
+    for rows in batches:
+        pending.extend(rows)
+        while len(pending) >= rows_per_page:
+            yield flush_page(pending[:rows_per_page])
+            pending = pending[rows_per_page:]
+    if pending or not pages:
+        yield flush_page(pending)
+
+    kids = b" ".join(b"%d 0 R" % number for number in pages)
+    yield pdf.object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(pages)))
+    yield pdf.object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    yield pdf.trailer(root=1)
+
+
+WRITERS = {"csv": write_csv, "xlsx": write_xlsx, "pdf": write_pdf}
+
+
+def export(documents: Iterable[Dict[str, Any]], export_format: str, report: str, terms: LaytimeTerms) -> Iterator[bytes]:
+    """Streams the report for the given documents in the requested format."""
+    if export_format not in WRITERS:
+        raise ValueError(f"Unknown export format '{export_format}'")
+    if report not in REPORTS:
+        raise ValueError(f"Unknown report '{report}'")
+    for chunk in WRITERS[export_format](report_rows(documents, report, terms), report):
+        if chunk:
+            yield chunk
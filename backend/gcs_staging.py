@@ -0,0 +1,213 @@
+"""
+GCS staging for Document AI: prefetched downloads, batched deletes, and cleanup off
+the request path.
+
+Document AI batch processing reads its input from and writes its output to GCS, so
+every OCR run stages objects there. Here:
+  - uploads run one after another unless SOF_GCS_WORKERS is above 1: against the
+    GCS emulator parallel page uploads were about 3x slower (1064 ms vs 365 ms for
+    24 pages), and no benchmark against real GCS has shown a gain yet. Large files
+    use chunked resumable uploads that survive a dropped connection;
+  - output shards are downloaded a few ahead of the one being read, on a shared
+    thread pool of SOF_GCS_WORKERS threads;
+  - deletes are sent as batch requests of up to 100 objects;
+  - cleanup is handed to a background reaper thread (SOF_GCS_CLEANUP=background,
+    the default), run inline (sync), or left to the bucket's lifecycle policy
+    (lifecycle). Install the policy once as a backstop for anything a crashed
+    process leaves behind:
+
+        python gcs_staging.py lifecycle marithon-ocr-bucket-123 --age-days 1
+
+Set STORAGE_EMULATOR_HOST (e.g. http://localhost:9023) to run against a local GCS
+emulator with anonymous credentials; the benchmark's gcs stage uses this.
+"""
+import argparse
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+STAGING_PREFIXES = ("docai-input/", "docai-output/")
+MAX_WORKERS = int(os.getenv("SOF_GCS_WORKERS", "1"))
+CLEANUP_MODE = os.getenv("SOF_GCS_CLEANUP", "background")
+CLEANUP_MODES = ("background", "sync", "lifecycle")
+# Files above this size are uploaded in resumable chunks (a multiple of 256 KB)
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+DELETE_BATCH_SIZE = 100  # the most calls one GCS batch request accepts
+
+_client = None
+_client_lock = threading.Lock()
+_executor = None
+
+
+def storage_client():
+    """Process-wide storage client; anonymous against STORAGE_EMULATOR_HOST."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            from google.cloud import storage
+            if os.getenv("STORAGE_EMULATOR_HOST"):
+                from google.auth.credentials import AnonymousCredentials
+                _client = storage.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT", "emulator"),
+                                         credentials=AnonymousCredentials())
+            else:
+                _client = storage.Client()
+        return _client
+
+
+def executor() -> ThreadPoolExecutor:
+    global _executor
+    with _client_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="gcs")
+        return _executor
+
+
+# --- Uploads ---
+def upload_file(bucket_name: str, file_path: str, gcs_filename: str) -> str:
+    """Uploads a local file, in resumable chunks when it is large; returns its gs:// URI."""
+    bucket = storage_client().bucket(bucket_name)
+    chunk_size = RESUMABLE_CHUNK_SIZE if os.path.getsize(file_path) > RESUMABLE_CHUNK_SIZE else None
+    bucket.blob(gcs_filename, chunk_size=chunk_size).upload_from_filename(file_path)
+    return f"gs://{bucket_name}/{gcs_filename}"
+
+
+def upload_many(bucket_name: str, objects: Dict[str, bytes], content_type: str = "application/pdf",
+                workers: Optional[int] = None) -> List[str]:
+    """
+    Uploads in-memory objects, on `workers` threads (default SOF_GCS_WORKERS) or
+    one after another when that is 1; returns their gs:// URIs in the order given.
+    """
+    bucket = storage_client().bucket(bucket_name)
+
+    def upload(item: Tuple[str, bytes]) -> str:
+        gcs_filename, data = item
+        bucket.blob(gcs_filename).upload_from_string(data, content_type=content_type)
+        return f"gs://{bucket_name}/{gcs_filename}"
+
+    workers = workers or MAX_WORKERS
+    if workers <= 1:
+        return [upload(item) for item in objects.items()]
+    if workers == MAX_WORKERS:
+        return list(executor().map(upload, objects.items()))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gcs-upload") as pool:
+        return list(pool.map(upload, objects.items()))
+
+
+# --- Listing and downloads ---
+def list_blobs(bucket_name: str, prefix: str) -> list:
+    return list(storage_client().list_blobs(bucket_name, prefix=prefix))
+
+
+def iter_downloads(blobs: Iterable, window: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Yields the content of each blob in order while downloading up to `window` of
+    the following blobs in the background, so at most `window` are held in memory.
+    """
+    window = window or MAX_WORKERS
+    pending = []
+    for blob in blobs:
+        pending.append(executor().submit(blob.download_as_bytes))
+        if len(pending) > window:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+# --- Cleanup ---
+def delete_prefixes(bucket_name: str, *prefixes: str) -> int:
+    """Deletes every object under the prefixes with batched requests; returns how many were deleted."""
+    client = storage_client()
+    blobs = [blob for prefix in prefixes for blob in client.list_blobs(bucket_name, prefix=prefix)]
+    for start in range(0, len(blobs), DELETE_BATCH_SIZE):
+        # Objects already gone (e.g. removed by the lifecycle rule) are not an error
+        with client.batch(raise_exception=False):
+            for blob in blobs[start:start + DELETE_BATCH_SIZE]:
+                blob.delete()
+    return len(blobs)
+
+
+class Reaper:
+    """Background thread that deletes staged objects after the request has returned."""
+
+    def __init__(self):
+        self.jobs: "queue.Queue[Tuple[str, Tuple[str, ...]]]" = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def schedule(self, bucket_name: str, *prefixes: str):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="gcs-reaper", daemon=True)
+                self.thread.start()
+        self.jobs.put((bucket_name, prefixes))
+
+    def _run(self):
+        while True:
+            bucket_name, prefixes = self.jobs.get()
+            try:
+                deleted = delete_prefixes(bucket_name, *prefixes)
+                print(f"GCS reaper removed {deleted} staged object(s) under {', '.join(prefixes)}")
+            except Exception as e:
+                # The bucket lifecycle policy removes anything left behind
+                print(f"Warning: GCS reaper could not clean up {', '.join(prefixes)}: {e}")
+            finally:
+                self.jobs.task_done()
+
+    def drain(self, timeout: float = 30.0) -> bool:
+        """Waits for scheduled cleanups, e.g. at shutdown; returns False if some are still pending."""
+        done = threading.Event()
+        threading.Thread(target=lambda: (self.jobs.join(), done.set()), daemon=True).start()
+        return done.wait(timeout)
+
+
+REAPER = Reaper()
+
+
+def cleanup(bucket_name: str, *prefixes: str, mode: Optional[str] = None):
+    """Removes staged objects according to SOF_GCS_CLEANUP."""
+    mode = mode or CLEANUP_MODE
+    if mode == "background":
+        REAPER.schedule(bucket_name, *prefixes)
+    elif mode == "sync":
+        delete_prefixes(bucket_name, *prefixes)
+    elif mode != "lifecycle":
+        raise ValueError(f"Unknown cleanup mode '{mode}'; choose from {', '.join(CLEANUP_MODES)}")
+
+
+def install_lifecycle_policy(bucket_name: str, age_days: int = 1):
+    """Adds a rule deleting staged objects older than age_days, unless an equivalent rule exists."""
+    bucket = storage_client().get_bucket(bucket_name)
+    for rule in bucket.lifecycle_rules:
+        condition = rule.get("condition", {})
+        if (rule.get("action", {}).get("type") == "Delete" and condition.get("age") == age_days
+                and sorted(condition.get("matchesPrefix", [])) == sorted(STAGING_PREFIXES)):
+            print(f"Bucket '{bucket_name}' already deletes staged objects after {age_days} day(s).")
+            return
+    bucket.add_lifecycle_delete_rule(age=age_days, matches_prefix=list(STAGING_PREFIXES))
+    bucket.patch()
+    print(f"Bucket '{bucket_name}' now deletes objects under {', '.join(STAGING_PREFIXES)} after {age_days} day(s).")
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Manage the Document AI staging bucket.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    lifecycle_parser = subparsers.add_parser("lifecycle", help="Install the lifecycle rule for staged objects.")
+    lifecycle_parser.add_argument("bucket_name")
+    lifecycle_parser.add_argument("--age-days", type=int, default=1)
+    purge_parser = subparsers.add_parser("purge", help="Delete every staged object now.")
+    purge_parser.add_argument("bucket_name")
+    args = parser.parse_args()
+
+    if args.command == "lifecycle":
+        install_lifecycle_policy(args.bucket_name, args.age_days)
+    else:
+        print(f"Deleted {delete_prefixes(args.bucket_name, *STAGING_PREFIXES)} staged object(s).")
+
+
+if __name__ == "__main__":
+    main()
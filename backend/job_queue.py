@@ -0,0 +1,364 @@
+"""
+Shared work queue for running the OCR and parse stages on separate workers.
+
+API nodes store the uploaded PDF under SOF_DATA_DIR and enqueue an "ocr" job; OCR
+workers turn it into reconstructed text and enqueue a "parse" job; parse workers
+store the final SOF JSON. Every stage is keyed by the SHA-256 of the PDF, so
+uploading the same document twice reuses the existing work.
+
+Delivery is at-least-once: a claimed job is leased for a fixed time and handed to
+another worker if the lease runs out before the job is completed, so stage
+handlers must be idempotent (see worker.py).
+
+The queue is a SQLite database in WAL mode, which supports any number of API and
+worker processes on ONE host: WAL keeps its index in shared memory, so the database
+must not live on a network filesystem (NFS, SMB, most cloud volumes) shared between
+machines, where locking is unreliable and the database can be corrupted. Workers on
+several machines need a server-backed queue instead. SOF_QUEUE_DB and SOF_DATA_DIR
+choose where it and the artifacts live.
+
+Completing, failing or releasing a job only succeeds while the caller still holds its
+lease; once a lease has expired and another worker has claimed the job, the original
+worker's outcome is discarded (the methods return False).
+"""
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+DATA_DIR = os.getenv("SOF_DATA_DIR", "sof_data")
+QUEUE_DB = os.getenv("SOF_QUEUE_DB", os.path.join(DATA_DIR, "queue.db"))
+
+STAGES = ("ocr", "parse")
+DEFAULT_LEASE_SECONDS = 600  # longer than the 420 s Document AI operation timeout
+DEFAULT_MAX_ATTEMPTS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_hash TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage TEXT NOT NULL,
+    doc_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_expires REAL,
+    worker_id TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (stage, doc_hash)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (stage, status, available_at);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc_hash TEXT NOT NULL UNIQUE,
+    content_hash TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    voyage_keys TEXT NOT NULL,
+    duplicate_of TEXT,
+    similarity REAL,
+    reused INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_done ON documents (status, updated_at, doc_hash);
+"""
+
+
+def document_hash(pdf_bytes: bytes) -> str:
+    """Idempotency key for a document: SHA-256 of the PDF bytes."""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def artifact_path(kind: str, doc_hash: str, data_dir: str = DATA_DIR) -> str:
+    """Location of a stage artifact ('pdf' or 'text') for a document."""
+    extension = {"pdf": ".pdf", "text": ".txt"}[kind]
+    directory = os.path.join(data_dir, kind)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, doc_hash + extension)
+
+
+def write_artifact_atomically(path: str, data: bytes):
+    """Writes via a temp file and rename so readers never see a partial artifact."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class JobQueue:
+    """SQLite-backed job queue shared by the API and the stage workers."""
+
+    def __init__(self, db_path: str = QUEUE_DB, data_dir: str = DATA_DIR):
+        self.db_path = db_path
+        self.data_dir = data_dir
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Autocommit connection, closed on exit."""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            yield conn
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Write transaction taken up front, so concurrent claimers serialize instead of deadlocking."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    # --- Producers ---
+    def submit_document(self, pdf_bytes: bytes, filename: str) -> Dict[str, Any]:
+        """
+        Stores a PDF and enqueues its OCR job. Re-submitting a document that is
+        queued, in progress or done returns the existing record; a failed
+        document is queued again.
+        """
+        doc_hash = document_hash(pdf_bytes)
+        pdf_path = artifact_path("pdf", doc_hash, self.data_dir)
+        if not os.path.exists(pdf_path):
+            write_artifact_atomically(pdf_path, pdf_bytes)
+
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT status FROM documents WHERE doc_hash = ?", (doc_hash,)).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO documents (doc_hash, filename, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+                    (doc_hash, filename, now, now),
+                )
+                self._enqueue(conn, "ocr", doc_hash, now)
+            elif row["status"] == "failed":
+                conn.execute(
+                    "UPDATE documents SET status = 'queued', error = NULL, updated_at = ? WHERE doc_hash = ?",
+                    (now, doc_hash),
+                )
+                conn.execute("DELETE FROM jobs WHERE doc_hash = ?", (doc_hash,))
+                self._enqueue(conn, "ocr", doc_hash, now)
+        return self.get_document(doc_hash)
+
+    def enqueue(self, stage: str, doc_hash: str):
+        """Enqueues a stage for a document; a no-op if that stage was already enqueued."""
+        with self._connect() as conn:
+            self._enqueue(conn, stage, doc_hash, time.time())
+
+    def _enqueue(self, conn: sqlite3.Connection, stage: str, doc_hash: str, now: float):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage '{stage}'")
+        conn.execute(
+            "INSERT OR IGNORE INTO jobs (stage, doc_hash, status, available_at, created_at, updated_at) "
+            "VALUES (?, ?, 'queued', ?, ?, ?)",
+            (stage, doc_hash, now, now, now),
+        )
+
+    # --- Consumers ---
+    def claim(self, stage: str, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> Optional[Dict[str, Any]]:
+        """
+        Leases the oldest runnable job for a stage: a queued job whose back-off has
+        passed, or a leased job whose worker let the lease expire.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE stage = ? AND ("
+                "  (status = 'queued' AND available_at <= ?) OR (status = 'leased' AND lease_expires <= ?)"
+                ") ORDER BY available_at, id LIMIT 1",
+                (stage, now, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_expires = ?, worker_id = ?, updated_at = ? "
+                "WHERE id = ?",
+                (now + lease_seconds, worker_id, now, row["id"]),
+            )
+            conn.execute(
+                "UPDATE documents SET status = ?, updated_at = ? WHERE doc_hash = ? AND status != 'done'",
+                ("ocr" if stage == "ocr" else "parsing", now, row["doc_hash"]),
+            )
+        job = dict(row)
+        job["attempts"] += 1
+        job["worker_id"] = worker_id
+        return job
+
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        """Extends a lease; returns False if the job is no longer held by this worker."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND worker_id = ? AND status = 'leased'",
+                (time.time() + lease_seconds, time.time(), job_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job: Dict[str, Any]) -> bool:
+        """Marks a job done; returns False if the job is no longer held by the worker that claimed it."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'done', lease_expires = NULL, updated_at = ? "
+                "WHERE id = ? AND worker_id = ? AND status = 'leased'",
+                (time.time(), job["id"], job["worker_id"]),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, job: Dict[str, Any], error: str, retry_delay: float = 30, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> bool:
+        """
+        Returns a job to the queue after retry_delay, or fails the document once attempts run out.
+        Returns False (and changes nothing) if the job is no longer held by the worker that claimed it.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            if job["attempts"] < max_attempts:
+                cursor = conn.execute(
+                    "UPDATE jobs SET status = 'queued', available_at = ?, lease_expires = NULL, error = ?, updated_at = ? "
+                    "WHERE id = ? AND worker_id = ? AND status = 'leased'",
+                    (now + retry_delay, error, now, job["id"], job["worker_id"]),
+                )
+                return cursor.rowcount == 1
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ? AND worker_id = ? AND status = 'leased'",
+                (error, now, job["id"], job["worker_id"]),
+            )
+            if cursor.rowcount != 1:
+                return False
+            conn.execute(
+                "UPDATE documents SET status = 'failed', error = ?, updated_at = ? WHERE doc_hash = ?",
+                (f"{job['stage']} stage failed: {error}", now, job["doc_hash"]),
+            )
+            return True
+
+    def release(self, job: Dict[str, Any], delay: float, reason: str) -> bool:
+        """
+        Puts a job back without counting the attempt, for work that never reached the
+        backend (e.g. its circuit breaker was open). Returns False if the lease was lost.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), available_at = ?, "
+                "lease_expires = NULL, error = ?, updated_at = ? WHERE id = ? AND worker_id = ? AND status = 'leased'",
+                (now + delay, reason, now, job["id"], job["worker_id"]),
+            )
+            return cursor.rowcount == 1
+
+    # --- Results ---
+    def store_result(self, doc_hash: str, result: Dict[str, Any]):
+        """Saves the parsed SOF JSON and marks the document done."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE documents SET status = 'done', result = ?, error = NULL, updated_at = ? WHERE doc_hash = ?",
+                (json.dumps(result), time.time(), doc_hash),
+            )
+
+    def record_result(self, doc_hash: str, filename: str, result: Dict[str, Any]):
+        """Stores a result produced outside the queue (e.g. by /convert-pdf/) as a done document."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO documents (doc_hash, filename, status, result, created_at, updated_at) VALUES (?, ?, 'done', ?, ?, ?) "
+                "ON CONFLICT (doc_hash) DO UPDATE SET status = 'done', result = excluded.result, error = NULL, "
+                "updated_at = excluded.updated_at",
+                (doc_hash, filename, json.dumps(result), now, now),
+            )
+
+    def get_document(self, doc_hash: str) -> Optional[Dict[str, Any]]:
+        """Status (and result, once done) of a document."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM documents WHERE doc_hash = ?", (doc_hash,)).fetchone()
+        if row is None:
+            return None
+        document = dict(row)
+        document["result"] = json.loads(document["result"]) if document["result"] else None
+        return document
+
+    def iter_results(
+        self,
+        doc_hash: Optional[str] = None,
+        processed_since: Optional[float] = None,
+        processed_until: Optional[float] = None,
+        batch_size: int = 100,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Done documents in the order they were processed, one document or those whose
+        result was stored in [processed_since, processed_until) (updated_at, not the
+        voyage's own dates). Reads in keyset-paginated batches on short-lived connections,
+        so a long export holds neither the whole result set nor a read transaction.
+        """
+        if doc_hash is not None:
+            document = self.get_document(doc_hash)
+            if document is not None and document["status"] == "done":
+                yield document
+            return
+
+        cursor = (processed_since if processed_since is not None else float("-inf"), "")
+        while True:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT * FROM documents WHERE status = 'done' AND (updated_at, doc_hash) > (?, ?) AND updated_at < ? "
+                    "ORDER BY updated_at, doc_hash LIMIT ?",
+                    (cursor[0], cursor[1], processed_until if processed_until is not None else float("inf"), batch_size),
+                ).fetchall()
+            for row in rows:
+                document = dict(row)
+                document["result"] = json.loads(document["result"]) if document["result"] else None
+                yield document
+            if len(rows) < batch_size:
+                return
+            cursor = (rows[-1]["updated_at"], rows[-1]["doc_hash"])
+
+    # --- Near-duplicate fingerprints (see near_duplicates.py) ---
+    def store_fingerprint(self, doc_hash: str, fingerprint: Dict[str, Any]):
+        """Saves a document's fingerprint and the earlier document it matched, replacing any older one."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO fingerprints "
+                "(doc_hash, content_hash, signature, voyage_keys, duplicate_of, similarity, reused, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    doc_hash, fingerprint["content_hash"], fingerprint["signature"], json.dumps(fingerprint["voyage_keys"]),
+                    fingerprint.get("duplicate_of"), fingerprint.get("similarity"), int(fingerprint.get("reused", False)),
+                    time.time(),
+                ),
+            )
+
+    def fingerprints_after(self, last_id: int) -> List[Dict[str, Any]]:
+        """Fingerprints stored since last_id, oldest first, for refreshing an in-memory index."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM fingerprints WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+        return [dict(row, voyage_keys=json.loads(row["voyage_keys"])) for row in rows]
+
+    def get_fingerprint(self, doc_hash: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM fingerprints WHERE doc_hash = ?", (doc_hash,)).fetchone()
+        return None if row is None else dict(row, voyage_keys=json.loads(row["voyage_keys"]))
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Job counts per stage and status, for monitoring and autoscaling."""
+        counts = {stage: {} for stage in STAGES}
+        with self._connect() as conn:
+            for row in conn.execute("SELECT stage, status, COUNT(*) AS n FROM jobs GROUP BY stage, status"):
+                counts[row["stage"]][row["status"]] = row["n"]
+        return counts
@@ -1,15 +1,20 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-import subprocess
+from starlette.concurrency import run_in_threadpool
+from dotenv import load_dotenv
 import os
 import tempfile
 import shutil
+import threading
+import time
 import uuid
-from pathlib import Path
-import json
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from rate_limiter import BackendUnavailableError, CircuitOpenError
+import near_duplicates
+import profiling
+import result_payloads
 
 app = FastAPI(title="PDF OCR & JSON Converter API", version="1.0.0")
 
@@ -20,6 +25,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let the dashboard read result ETags and profiling breakdowns
+    expose_headers=["ETag", "Server-Timing"],
 )
 
 # FIXED: Mount static files with correct path - go up one directory to access docs
@@ -39,20 +46,143 @@ os.environ["GOOGLE_CLOUD_PROJECT"] = google_project
 # Store the latest extraction results
 latest_extraction_results = None
 
+# Liveness (/health) answers as soon as the app is bound; readiness (/ready) waits for
+# the Google SDKs, which take seconds to import, to be loaded by a background thread.
+startup_state = {"started_at": time.time(), "ready": False, "ready_at": None, "error": None}
+warm_up_done = threading.Event()
+
+def warm_up():
+    """Imports the OCR and parser stages with their SDKs and configures Gemini."""
+    try:
+        load_dotenv()
+        import OCR_Script
+        import parser_script
+        from google.cloud import documentai, storage
+        import google.generativeai
+
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if api_key:
+            parser_script.configure_gemini(api_key)
+        else:
+            startup_state["error"] = "GOOGLE_API_KEY is not set"
+    except Exception as e:
+        startup_state["error"] = f"Warm-up failed: {e}"
+    finally:
+        startup_state["ready"] = startup_state["error"] is None
+        startup_state["ready_at"] = time.time()
+        warm_up_done.set()
+        print(f"Warm-up finished in {startup_state['ready_at'] - startup_state['started_at']:.2f}s "
+              f"(ready={startup_state['ready']})")
+
+warm_up_lock = threading.Lock()
+warm_up_thread = None
+
+def ensure_warm_up_started():
+    """Starts the warm-up thread once per process."""
+    global warm_up_thread
+    with warm_up_lock:
+        if warm_up_thread is None:
+            warm_up_thread = threading.Thread(target=warm_up, name="sdk-warm-up", daemon=True)
+            warm_up_thread.start()
+
+@app.on_event("startup")
+async def start_warm_up():
+    ensure_warm_up_started()
+
+@app.on_event("shutdown")
+async def finish_gcs_cleanup():
+    # Staged Document AI objects are deleted in the background; give pending deletes a chance to finish
+    import gcs_staging
+    await run_in_threadpool(gcs_staging.REAPER.drain, 10.0)
+
+def run_ocr_stage(pdf_path, output_txt):
+    """Runs Document AI OCR in-process, writing the reconstructed text to output_txt."""
+    import OCR_Script
+    OCR_Script.process_pdf(pdf_path, OCR_Script.DEFAULT_BUCKET_NAME, OCR_Script.DEFAULT_LOCATION,
+                           OCR_Script.DEFAULT_PROCESSOR_ID, output_txt)
+
+def run_parser_stage(input_txt, output_json):
+    """Runs the Gemini parser in-process; returns the SOF JSON or None."""
+    import parser_script
+    return parser_script.parse_sof_file(input_txt, output_json)
+
+def hash_pdf(pdf_path):
+    """Hash of an uploaded PDF; its documents row key in the job queue."""
+    from job_queue import document_hash
+    with open(pdf_path, "rb") as f:
+        return document_hash(f.read())
+
+def stored_result(doc_hash):
+    """The result already stored for a PDF with this hash, if any."""
+    document = get_job_queue().get_document(doc_hash)
+    return document["result"] if document and document["status"] == "done" else None
+
+def find_earlier_result(doc_hash, output_txt):
+    """Fingerprints the OCR text and returns its closest earlier document, with that result when it can be reused."""
+    fingerprint, match = near_duplicates.check(get_job_queue(), doc_hash, output_txt)
+    return fingerprint, match, near_duplicates.reusable_result(get_job_queue(), match)
+
+def record_conversion(doc_hash, filename, result):
+    """Stores a conversion as a done document, so exports and repeat uploads find it."""
+    get_job_queue().record_result(doc_hash, filename, result)
+
+def register_conversion(doc_hash, fingerprint, match, result, reused):
+    """Adds a conversion to the near-duplicate index; describes the earlier document it matched."""
+    queue = get_job_queue()
+    near_duplicates.register(queue, doc_hash, fingerprint, match, result, reused=reused)
+    return near_duplicates.describe(queue, doc_hash, result)
+
+def service_unavailable(e):
+    """503 for a Google backend that is rate limiting us or down, so clients retry later."""
+    retry_after = e.retry_after if isinstance(e, CircuitOpenError) else 60
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(retry_after) + 1)})
+
+def find_event_delta(if_none_match, doc_hash, events):
+    """events as a delta against a stored result the client names in If-None-Match, if that is smaller"""
+    for base_tag, base_hash in result_payloads.base_documents(if_none_match):
+        if base_hash == doc_hash:
+            continue
+        base = get_job_queue().get_document(base_hash)
+        if base is None or base["status"] != "done" or not base["result"]:
+            continue
+        return result_payloads.delta_if_smaller(base_tag, base["result"].get("events") or [], events)
+    return None
+
+async def send_result(request: Request, content, data, doc_hash=None, headers=None):
+    """
+    Sends an extraction result with its ETag, compressed, or 304 if the client has it already.
+    With X-SOF-Delta: 1 the events may be sent as a delta against the client's cached result.
+    """
+    tag = result_payloads.etag(doc_hash, data)
+    if_none_match = request.headers.get("if-none-match")
+    if request.headers.get(result_payloads.DELTA_HEADER) == "1" and if_none_match and not result_payloads.matches(if_none_match, tag):
+        try:
+            delta = await run_in_threadpool(find_event_delta, if_none_match, doc_hash, data.get("events") or [])
+        except Exception as e:
+            print(f"Warning: could not compute an events delta: {e}")
+            delta = None
+        if delta is not None:
+            if "events" in content:
+                content = {key: value for key, value in content.items() if key != "events"}
+            else:
+                content = dict(content, data={key: value for key, value in content["data"].items() if key != "events"})
+            content["events_delta"] = delta
+    return result_payloads.respond(request, content, tag, headers)
+
 @app.get("/")
 async def root():
     return {"message": "PDF OCR & JSON Converter API", "status": "running"}
 
 @app.post("/extract")
-async def extract_pdf(pdf: UploadFile = File(..., alias="pdf")):
+async def extract_pdf(request: Request, pdf: UploadFile = File(..., alias="pdf")):
     """
     Extract data from PDF using OCR and parsing (compatibility endpoint)
     """
-    return await convert_pdf_to_json(pdf)
+    return await convert_pdf_to_json(pdf, request)
 
 # NEW ENDPOINT: For dashboard button integration
 @app.post("/api/extract-events")
-async def extract_events_and_timeline():
+async def extract_events_and_timeline(request: Request):
     """
     Endpoint for dashboard 'Extract Events and Laytime' button
     Uses the most recent PDF processing results or processes a default file
@@ -62,15 +192,17 @@ async def extract_events_and_timeline():
     try:
         # Option 1: Use cached results if available
         if latest_extraction_results:
-            return {
+            data = latest_extraction_results.get("data", {})
+            return await send_result(request, {
                 "success": True,
                 "message": "Events extracted successfully",
-                "events": latest_extraction_results.get("data", {}).get("events", []),
-                "vessel_info": latest_extraction_results.get("data", {}).get("vessel_info", {}),
-                "total_events": len(latest_extraction_results.get("data", {}).get("events", [])),
+                "events": data.get("events", []),
+                "vessel_info": data.get("vessel_info", {}),
+                "total_events": len(data.get("events", [])),
                 "extraction_timestamp": datetime.now().isoformat(),
-                "filename": latest_extraction_results.get("filename", "Unknown")
-            }
+                "filename": latest_extraction_results.get("filename", "Unknown"),
+                "doc_hash": latest_extraction_results.get("doc_hash")
+            }, data, latest_extraction_results.get("doc_hash"))
         
         # Option 2: Process a default/sample file if no recent results
         sample_dir = os.path.join(os.path.dirname(__file__), "..", "sample")
@@ -111,19 +243,23 @@ async def extract_events_and_timeline():
                 }
             ]
             
-            return {
-                "success": True,
-                "message": "Sample events extracted successfully",
+            mock_data = {
                 "events": mock_events,
                 "vessel_info": {
                     "vessel_name": "Sample Vessel",
                     "imo": "1234567",
                     "voyage": "V001"
-                },
+                }
+            }
+            
+            return await send_result(request, {
+                "success": True,
+                "message": "Sample events extracted successfully",
+                **mock_data,
                 "total_events": len(mock_events),
                 "extraction_timestamp": datetime.now().isoformat(),
                 "filename": "sample_data"
-            }
+            }, mock_data)
         
         # Process the first available sample file
         sample_file = sample_files[0]
@@ -148,15 +284,17 @@ async def extract_events_and_timeline():
         # Store results for future requests
         latest_extraction_results = result
         
-        return {
+        data = result.get("data", {})
+        return await send_result(request, {
             "success": True,
             "message": "Events extracted successfully from sample file",
-            "events": result.get("data", {}).get("events", []),
-            "vessel_info": result.get("data", {}).get("vessel_info", {}),
-            "total_events": len(result.get("data", {}).get("events", [])),
+            "events": data.get("events", []),
+            "vessel_info": data.get("vessel_info", {}),
+            "total_events": len(data.get("events", [])),
             "extraction_timestamp": datetime.now().isoformat(),
-            "filename": sample_file
-        }
+            "filename": sample_file,
+            "doc_hash": result.get("doc_hash")
+        }, data, result.get("doc_hash"))
         
     except Exception as e:
         print(f"Error in extract_events_and_timeline: {str(e)}")
@@ -172,10 +310,25 @@ async def extract_events_and_timeline():
         )
 
 @app.post("/convert-pdf/")
-async def convert_pdf_to_json(pdf_file: UploadFile = File(..., alias="pdf")):
+async def convert_pdf_to_json(pdf_file: UploadFile = File(..., alias="pdf"), request: Request = None):
     """
-    Convert PDF to JSON using OCR and parsing
+    Convert PDF to JSON using OCR and parsing.
+    With an X-SOF-Profile: 1 header (or when sampled), the response includes a stage breakdown.
+    The result carries an ETag; If-None-Match and X-SOF-Delta work as for /api/extract-events.
     """
+    header = request.headers.get(profiling.HEADER) if request is not None else None
+    with profiling.profile(f"convert-{pdf_file.filename}", profiling.requested(header)) as current:
+        response_data = await convert_pdf(pdf_file)
+    headers = {}
+    if current is not None:
+        response_data = dict(response_data, profile=current.summary())
+        headers["Server-Timing"] = current.server_timing()
+    if request is None:
+        return response_data
+    return await send_result(request, response_data, response_data["data"], response_data.get("doc_hash"), headers)
+
+async def convert_pdf(pdf_file):
+    """OCR, duplicate check and parsing for one uploaded PDF"""
     global latest_extraction_results
     
     if not pdf_file.filename.lower().endswith('.pdf'):
@@ -188,58 +341,85 @@ async def convert_pdf_to_json(pdf_file: UploadFile = File(..., alias="pdf")):
     try:
         # Save uploaded PDF to working directory
         pdf_path = os.path.join(work_dir, pdf_file.filename)
-        with open(pdf_path, "wb") as buffer:
+        with profiling.stage("upload"), open(pdf_path, "wb") as buffer:
             shutil.copyfileobj(pdf_file.file, buffer)
         
         # Generate unique output filenames
         output_txt = os.path.join(work_dir, "output.txt")
         output_json = os.path.join(work_dir, "sof_data.json")
         
+        # Results are stored under the PDF's hash; the same PDF uploaded again returns
+        # its stored result without OCR or parsing
+        doc_hash = await run_in_threadpool(profiling.in_stage("upload", hash_pdf), pdf_path)
+        if near_duplicates.ENABLED:
+            try:
+                json_data = await run_in_threadpool(profiling.in_stage("dedup", stored_result), doc_hash)
+            except Exception as e:
+                print(f"Warning: duplicate check failed: {e}")
+                json_data = None
+            if json_data is not None:
+                print(f"Same PDF as stored document {doc_hash[:12]}, returning its result")
+                latest_extraction_results = {
+                    "message": "PDF successfully converted to JSON",
+                    "filename": pdf_file.filename,
+                    "data": json_data,
+                    "doc_hash": doc_hash,
+                }
+                return latest_extraction_results
+
         print(f"Processing PDF: {pdf_path}")
         
-        # Step 1: Run OCR Script
+        # The first request after a cold start waits for the SDK warm-up instead of importing concurrently
+        ensure_warm_up_started()
+        with profiling.stage("warm_up_wait"):
+            await run_in_threadpool(warm_up_done.wait)
+
+        # Step 1: Run OCR
         print("Step 1: Running OCR conversion...")
-        ocr_cmd = [
-            "python", "OCR_Script.py",
-            pdf_path,
-            "marithon-ocr-bucket-123",
-            "us",
-            "44770fd7117288da",
-            output_txt
-        ]
-        
-        result = subprocess.run(ocr_cmd, capture_output=True, text=True, cwd=os.getcwd())
-        
-        if result.returncode != 0:
-            print(f"OCR Error: {result.stderr}")
-            raise HTTPException(status_code=500, detail=f"OCR conversion failed: {result.stderr}")
+        try:
+            await run_in_threadpool(profiling.in_stage("ocr", run_ocr_stage), pdf_path, output_txt)
+        except (CircuitOpenError, BackendUnavailableError) as e:
+            print(f"OCR backend unavailable: {e}")
+            raise service_unavailable(e)
+        except Exception as e:
+            print(f"OCR Error: {e}")
+            raise HTTPException(status_code=500, detail=f"OCR conversion failed: {e}")
         
         print("OCR conversion completed successfully")
         
-        # Step 2: Run Parser Script
-        print("Step 2: Running JSON conversion...")
-        parser_cmd = [
-            "python", "parser_script.py",
-            output_txt,
-            output_json
-        ]
+        # A scanned, signed or re-exported copy of a document seen before reuses its result
+        fingerprint = match = json_data = None
+        if near_duplicates.ENABLED:
+            try:
+                fingerprint, match, json_data = await run_in_threadpool(
+                    profiling.in_stage("dedup", find_earlier_result), doc_hash, output_txt
+                )
+            except Exception as e:
+                print(f"Warning: near-duplicate check failed: {e}")
+        reused = json_data is not None
         
-        result = subprocess.run(parser_cmd, capture_output=True, text=True, cwd=os.getcwd())
-        
-        if result.returncode != 0:
-            print(f"Parser Error: {result.stderr}")
-            raise HTTPException(status_code=500, detail=f"JSON conversion failed: {result.stderr}")
+        # Step 2: Run Parser
+        print("Step 2: Running JSON conversion...")
+        try:
+            if reused:
+                print(f"Same text as stored document {match.doc_hash[:12]}, reusing its result")
+            else:
+                json_data = await run_in_threadpool(profiling.in_stage("parse", run_parser_stage), output_txt, output_json)
+        except (CircuitOpenError, BackendUnavailableError) as e:
+            print(f"Parser backend unavailable: {e}")
+            raise service_unavailable(e)
+        except Exception as e:
+            print(f"Parser Error: {e}")
+            raise HTTPException(status_code=500, detail=f"JSON conversion failed: {e}")
         
         print("JSON conversion completed successfully")
         
-        # Read the generated JSON before cleanup
-        try:
-            with open(output_json, 'r', encoding='utf-8') as f:
-                json_data = json.load(f)
-        except Exception as e:
-            print(f"Error reading JSON file: {e}")
-            # Try to parse the output from the parser script
-            json_data = parse_parser_output(result.stdout)
+        if json_data is None:
+            print("Parser produced no structured data")
+            json_data = {
+                "vessel_info": {},
+                "events": []
+            }
         
         # Prepare the response data
         response_data = {
@@ -247,12 +427,30 @@ async def convert_pdf_to_json(pdf_file: UploadFile = File(..., alias="pdf")):
             "filename": pdf_file.filename,
             "data": json_data
         }
+        if json_data.get("events"):
+            # Recorded whether or not duplicate detection is on, so /api/export can find it
+            response_data["doc_hash"] = doc_hash
+            try:
+                await run_in_threadpool(profiling.in_stage("store", record_conversion), doc_hash, pdf_file.filename, json_data)
+            except Exception as e:
+                print(f"Warning: could not store the result for exports: {e}")
+            if fingerprint is not None:
+                try:
+                    near_duplicate = await run_in_threadpool(
+                        profiling.in_stage("dedup", register_conversion), doc_hash, fingerprint, match, json_data, reused
+                    )
+                    if near_duplicate is not None:
+                        response_data["near_duplicate"] = near_duplicate
+                except Exception as e:
+                    print(f"Warning: could not record the result for duplicate checks: {e}")
         
         # Store results for dashboard use
         latest_extraction_results = response_data
         
         return response_data
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
@@ -265,34 +463,124 @@ async def convert_pdf_to_json(pdf_file: UploadFile = File(..., alias="pdf")):
         except Exception as e:
             print(f"Warning: Could not clean up {work_dir}: {e}")
 
-def parse_parser_output(stdout):
-    """Parse the output from parser script to extract JSON data"""
+# Queue-backed processing: API nodes only enqueue, OCR and parse workers (worker.py) do the work
+job_queue = None
+
+def get_job_queue():
+    """Opens the shared job queue on first use."""
+    global job_queue
+    if job_queue is None:
+        from job_queue import JobQueue
+        job_queue = JobQueue()
+    return job_queue
+
+@app.post("/jobs", status_code=202)
+async def submit_job(pdf_file: UploadFile = File(..., alias="pdf")):
+    """
+    Queue a PDF for OCR and parsing by the workers.
+    Submitting the same PDF again returns the existing job instead of reprocessing it.
+    """
+    if not pdf_file.filename.lower().endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="File must be a PDF")
+    
+    pdf_bytes = await pdf_file.read()
+    document = await run_in_threadpool(get_job_queue().submit_document, pdf_bytes, pdf_file.filename)
+    return {
+        "doc_hash": document["doc_hash"],
+        "status": document["status"],
+        "status_url": f"/jobs/{document['doc_hash']}"
+    }
+
+@app.get("/jobs/{doc_hash}")
+async def get_job(doc_hash: str, request: Request):
+    """Status of a queued document, with the extracted data once it is done"""
+    document = await run_in_threadpool(get_job_queue().get_document, doc_hash)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Unknown document")
+    
+    response_data = {
+        "doc_hash": doc_hash,
+        "filename": document["filename"],
+        "status": document["status"],
+        "error": document["error"]
+    }
+    if document["status"] == "done":
+        response_data["message"] = "PDF successfully converted to JSON"
+        response_data["data"] = document["result"]
+        near_duplicate = await run_in_threadpool(near_duplicates.describe, get_job_queue(), doc_hash, document["result"])
+        if near_duplicate is not None:
+            response_data["near_duplicate"] = near_duplicate
+        return await send_result(request, response_data, document["result"], doc_hash)
+    return response_data
+
+@app.get("/jobs")
+async def get_queue_stats():
+    """Job counts per stage and status"""
+    return await run_in_threadpool(get_job_queue().stats)
+
+@app.get("/api/export")
+async def export_results(
+    format: str = "csv",
+    report: str = "events",
+    doc_hash: str = None,
+    processed_from: str = None,
+    processed_to: str = None,
+    allowed_laytime_days: float = 0.0,
+    demurrage_rate: float = 0.0,
+    dispatch_rate: float = 0.0,
+):
+    """
+    Stream events or laytime summaries as CSV, XLSX or PDF for one voyage (doc_hash)
+    or every voyage whose SOF was processed between processed_from and processed_to
+    (YYYY-MM-DD, UTC, inclusive). These are processing dates, not voyage or event dates.
+    """
+    import export_report
+
+    if format not in export_report.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(export_report.FORMATS)}")
+    if report not in export_report.REPORTS:
+        raise HTTPException(status_code=400, detail=f"report must be one of {', '.join(export_report.REPORTS)}")
     try:
-        # Look for JSON-like content in the output
-        lines = stdout.split('\n')
-        for line in lines:
-            line = line.strip()
-            if line.startswith('{') and line.endswith('}'):
-                return json.loads(line)
-            elif line.startswith('[') and line.endswith(']'):
-                return json.loads(line)
-        
-        # If no JSON found, return a default structure
-        return {
-            "vessel_info": {},
-            "events": []
-        }
-    except Exception as e:
-        print(f"Error parsing parser output: {e}")
-        return {
-            "vessel_info": {},
-            "events": []
-        }
+        since = datetime.fromisoformat(processed_from).replace(tzinfo=timezone.utc).timestamp() if processed_from else None
+        until = (datetime.fromisoformat(processed_to) + timedelta(days=1)).replace(tzinfo=timezone.utc).timestamp() if processed_to else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="processed_from and processed_to must be dates like 2024-01-31")
+
+    queue = get_job_queue()
+    if doc_hash is not None:
+        document = await run_in_threadpool(queue.get_document, doc_hash)
+        if document is None or document["status"] != "done":
+            raise HTTPException(status_code=404, detail="No finished document with that hash")
+
+    terms = export_report.LaytimeTerms(allowed_laytime_days, demurrage_rate, dispatch_rate)
+    documents = queue.iter_results(doc_hash=doc_hash, processed_since=since, processed_until=until)
+    media_type, extension = export_report.FORMATS[format]
+    scope = doc_hash[:12] if doc_hash else f"processed-{processed_from or 'start'}_{processed_to or 'now'}"
+    # A plain generator: Starlette pulls it from the threadpool, one voyage at a time
+    return StreamingResponse(
+        export_report.export(documents, format, report, terms),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="sof-{report}-{scope}.{extension}"'},
+    )
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    return {"status": "healthy", "environment": "ready"}
+    """Liveness check; answers immediately, even while the SDKs are still loading"""
+    return {"status": "healthy", "environment": "ready" if startup_state["ready"] else "warming_up"}
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness check; 503 until the OCR and parser stages can serve requests"""
+    body = {
+        "ready": startup_state["ready"],
+        "error": startup_state["error"],
+        "uptime_seconds": round(time.time() - startup_state["started_at"], 3),
+    }
+    if startup_state["ready_at"] is not None:
+        body["warm_up_seconds"] = round(startup_state["ready_at"] - startup_state["started_at"], 3)
+    if not startup_state["ready"]:
+        return JSONResponse(status_code=503, content=body)
+    return body
 
 # FIXED: Serve HTML files directly from docs directory
 @app.get("/dashboard")
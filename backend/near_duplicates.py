@@ -0,0 +1,325 @@
+"""
+Duplicate and near-duplicate detection across uploaded SOFs.
+
+The same voyage's SOF often arrives several times: scanned and signed, digital, and
+amended. Before a document is parsed, its OCR text is fingerprinted and matched
+against every document processed so far:
+
+- identical text (after normalizing case, punctuation and layout) reuses the earlier
+  result, so the document skips the parse stage;
+- similar text (an estimated Jaccard similarity of word 3-shingles of at least
+  SOF_DEDUP_SIMILARITY) or the same vessel / port / date key is parsed as usual and
+  reported with a diff of its events against the earlier document.
+
+The text fingerprint is a 64-value one-permutation MinHash, indexed by locality-
+sensitive hashing in 16 bands of 4 values, so a lookup reads a few dict buckets rather
+than comparing against every stored document. Voyage keys come from vessel_info: the
+vessel and port the rules extractor finds on the first page with the first date in the
+text before parsing, and the parsed vessel_info with the first event date afterwards.
+
+Fingerprints are stored in the job queue database. Each process keeps the index in
+memory and picks up other processes' documents at most every SOF_DEDUP_REFRESH_SECONDS.
+SOF_DEDUP_REUSE_SIMILARITY below 1 also reuses the results of near-duplicates at or
+above that similarity; an amended time on one line barely moves the similarity, so
+only lower it for sources that differ by OCR noise alone. SOF_DEDUP=0 disables the index.
+"""
+import hashlib
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import parse_strategy
+import text_artifact
+
+ENABLED = os.getenv("SOF_DEDUP", "1") != "0"
+SIMILARITY = float(os.getenv("SOF_DEDUP_SIMILARITY", "0.6"))
+REUSE_SIMILARITY = float(os.getenv("SOF_DEDUP_REUSE_SIMILARITY", "1.0"))
+REFRESH_SECONDS = float(os.getenv("SOF_DEDUP_REFRESH_SECONDS", "1"))
+
+NUM_HASHES = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_HASHES // BANDS
+SHINGLE_WORDS = 3
+BIN_BITS = 6  # top bits of a shingle hash pick one of the 64 bins
+VALUE_MASK = (1 << (32 - BIN_BITS)) - 1
+EMPTY_BIN = 0xFFFFFFFF
+SIGNATURE_FORMAT = f"<{NUM_HASHES}I"
+
+TOKEN = re.compile(r"[A-Z0-9]+")
+VESSEL_PREFIX = re.compile(r"^(?:M ?[VT]|SS) ")  # "MV", "M/V", "M.V." and "M.T." name the same vessel
+PORT_FIELDS = ("port_of_loading_cargo", "port_of_discharge", "port")
+
+
+@dataclass
+class Fingerprint:
+    content_hash: str
+    signature: Tuple[int, ...]
+    voyage_keys: List[str] = field(default_factory=list)
+
+    def as_row(self) -> Dict[str, Any]:
+        return {
+            "content_hash": self.content_hash,
+            "signature": struct.pack(SIGNATURE_FORMAT, *self.signature),
+            "voyage_keys": self.voyage_keys,
+        }
+
+
+@dataclass
+class Match:
+    doc_hash: str
+    similarity: float
+    identical_text: bool = False
+    same_voyage: bool = False
+
+    @property
+    def reusable(self) -> bool:
+        """Whether the earlier result can stand in for parsing this document."""
+        return self.identical_text or (REUSE_SIMILARITY < 1 and self.similarity >= REUSE_SIMILARITY)
+
+
+def _normalize(text: Any) -> List[str]:
+    return TOKEN.findall(str(text or "").upper())
+
+
+def voyage_key(vessel_info: Dict[str, Any], date: Any) -> Optional[str]:
+    """'VESSEL|PORT|DATE' with spelling differences normalized away; None without a vessel and a date."""
+    vessel = VESSEL_PREFIX.sub("", " ".join(_normalize(vessel_info.get("name_of_vessel"))))
+    date = " ".join(_normalize(date))
+    if not vessel or not date:
+        return None
+    port = next((vessel_info[f] for f in PORT_FIELDS if vessel_info.get(f)), "")
+    return "|".join((vessel, " ".join(_normalize(port)), date))
+
+
+def result_voyage_key(result: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Voyage key from a parsed result: its vessel_info and the date of the first event."""
+    if not result:
+        return None
+    dates = [e.get("start_date") for e in result.get("events") or [] if isinstance(e, dict) and e.get("start_date")]
+    return voyage_key(result.get("vessel_info") or {}, dates[0] if dates else None)
+
+
+def minhash(shingle_hashes: Iterable[int]) -> Tuple[int, ...]:
+    """
+    One-permutation MinHash: each 32-bit shingle hash lands in one of 64 bins by its
+    top bits and each bin keeps its smallest value. Empty bins borrow the next filled
+    bin's value, offset by the distance, so short texts still compare fairly.
+    """
+    bins = [EMPTY_BIN] * NUM_HASHES
+    shift = 32 - BIN_BITS
+    for h in shingle_hashes:
+        index = h >> shift
+        value = h & VALUE_MASK
+        if value < bins[index]:
+            bins[index] = value
+    if all(value == EMPTY_BIN for value in bins):
+        return tuple(bins)
+    densified = list(bins)
+    for i, value in enumerate(bins):
+        if value == EMPTY_BIN:
+            distance = 1
+            while bins[(i + distance) % NUM_HASHES] == EMPTY_BIN:
+                distance += 1
+            densified[i] = bins[(i + distance) % NUM_HASHES] | (distance << shift)
+    return tuple(densified)
+
+
+def fingerprint_pages(pages: Iterable[str]) -> Fingerprint:
+    """Fingerprint of OCR text given page by page."""
+    content = hashlib.sha256()
+    hashes = []
+    vessel_info, first_date = {}, None
+    for index, page in enumerate(pages):
+        if index == 0:
+            vessel_info = parse_strategy.extract_vessel_info(page)
+        if first_date is None:
+            date = parse_strategy.DATE_PATTERN.search(page)
+            first_date = date.group(0) if date else None
+        words = _normalize(page)
+        content.update("".join(word + " " for word in words).encode("utf-8"))  # page breaks do not count
+        for i in range(max(len(words) - SHINGLE_WORDS + 1, 1 if words else 0)):
+            shingle = " ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8")
+            hashes.append((zlib.crc32(shingle) * 0x9E3779B1) & 0xFFFFFFFF)  # spread the bits the bins are read from
+    key = voyage_key(vessel_info, first_date)
+    return Fingerprint(content.hexdigest(), minhash(hashes), [key] if key else [])
+
+
+def fingerprint_file(text_path: str) -> Fingerprint:
+    return fingerprint_pages(text_artifact.iter_pages(text_path))
+
+
+def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures."""
+    return sum(x == y for x, y in zip(a, b)) / NUM_HASHES
+
+
+class NearDuplicateIndex:
+    """In-memory LSH index over the fingerprints stored in a job queue."""
+
+    def __init__(self, queue=None):
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.documents: Dict[str, Fingerprint] = {}
+        self.content: Dict[str, set] = defaultdict(set)
+        self.bands: List[Dict[Tuple[int, ...], set]] = [defaultdict(set) for _ in range(BANDS)]
+        self.keys: Dict[str, set] = defaultdict(set)
+        self.last_id = 0
+        self.refreshed_at = 0.0
+
+    def _bands(self, signature: Tuple[int, ...]):
+        return [tuple(signature[b * ROWS_PER_BAND:(b + 1) * ROWS_PER_BAND]) for b in range(BANDS)]
+
+    def add(self, doc_hash: str, fingerprint: Fingerprint):
+        with self.lock:
+            self._remove(doc_hash)
+            self.documents[doc_hash] = fingerprint
+            self.content[fingerprint.content_hash].add(doc_hash)
+            for band, key in zip(self.bands, self._bands(fingerprint.signature)):
+                band[key].add(doc_hash)
+            for key in fingerprint.voyage_keys:
+                self.keys[key].add(doc_hash)
+
+    def _remove(self, doc_hash: str):
+        previous = self.documents.pop(doc_hash, None)
+        if previous is None:
+            return
+        self.content[previous.content_hash].discard(doc_hash)
+        for band, key in zip(self.bands, self._bands(previous.signature)):
+            band[key].discard(doc_hash)
+        for key in previous.voyage_keys:
+            self.keys[key].discard(doc_hash)
+
+    def refresh(self, force: bool = False):
+        """Loads fingerprints other processes stored since the last refresh."""
+        if self.queue is None or (not force and time.monotonic() - self.refreshed_at < REFRESH_SECONDS):
+            return
+        self.refreshed_at = time.monotonic()
+        for row in self.queue.fingerprints_after(self.last_id):
+            signature = struct.unpack(SIGNATURE_FORMAT, row["signature"])
+            self.add(row["doc_hash"], Fingerprint(row["content_hash"], signature, row["voyage_keys"]))
+            self.last_id = max(self.last_id, row["id"])
+
+    def match(self, fingerprint: Fingerprint, exclude: Optional[str] = None) -> Optional[Match]:
+        """Best earlier document with the same text, similar text or the same voyage key."""
+        self.refresh()
+        with self.lock:
+            same_text = sorted(self.content.get(fingerprint.content_hash, set()) - {exclude})
+            if same_text:
+                return Match(same_text[0], 1.0, identical_text=True)
+
+            candidates = set()
+            for band, key in zip(self.bands, self._bands(fingerprint.signature)):
+                candidates.update(band.get(key, ()))
+            same_voyage = set()
+            for key in fingerprint.voyage_keys:
+                same_voyage.update(self.keys.get(key, ()))
+            candidates |= same_voyage
+            candidates.discard(exclude)
+
+            best = None
+            for doc_hash in candidates:
+                score = similarity(fingerprint.signature, self.documents[doc_hash].signature)
+                if score < SIMILARITY and doc_hash not in same_voyage:
+                    continue
+                if best is None or (score, doc_hash in same_voyage) > (best.similarity, best.same_voyage):
+                    best = Match(doc_hash, score, same_voyage=doc_hash in same_voyage)
+            return best
+
+
+_indexes: Dict[str, NearDuplicateIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def index_for(queue) -> NearDuplicateIndex:
+    """The process-wide index for a job queue, loaded on first use."""
+    with _indexes_lock:
+        index = _indexes.get(queue.db_path)
+        if index is None:
+            index = _indexes[queue.db_path] = NearDuplicateIndex(queue)
+            index.refresh(force=True)
+        return index
+
+
+def check(queue, doc_hash: str, text_path: str) -> Tuple[Fingerprint, Optional[Match]]:
+    """Fingerprints a document's OCR text and finds its closest earlier document."""
+    fingerprint = fingerprint_file(text_path)
+    return fingerprint, index_for(queue).match(fingerprint, exclude=doc_hash)
+
+
+def reusable_result(queue, match: Optional[Match]) -> Optional[Dict[str, Any]]:
+    """The earlier document's result when the match allows skipping the parse."""
+    if match is None or not match.reusable:
+        return None
+    document = queue.get_document(match.doc_hash)
+    if document is None or document["status"] != "done":
+        return None
+    return document["result"]
+
+
+def register(queue, doc_hash: str, fingerprint: Fingerprint, match: Optional[Match],
+             result: Optional[Dict[str, Any]], reused: bool = False) -> Optional[Match]:
+    """
+    Adds a finished document to the index. Its parsed vessel_info becomes another
+    voyage key, which may now find the earlier version of the voyage to diff against.
+    """
+    key = result_voyage_key(result)
+    if key and key not in fingerprint.voyage_keys:
+        fingerprint.voyage_keys.append(key)
+        if match is None:
+            match = index_for(queue).match(fingerprint, exclude=doc_hash)
+    row = fingerprint.as_row()
+    if match is not None:
+        row.update(duplicate_of=match.doc_hash, similarity=match.similarity, reused=reused)
+    queue.store_fingerprint(doc_hash, row)
+    index_for(queue).add(doc_hash, fingerprint)
+    return match
+
+
+def _event_key(event: Dict[str, Any]) -> Tuple[str, ...]:
+    return tuple(" ".join(_normalize(event.get(f))) for f in ("event", "start_date", "start_time", "end_time"))
+
+
+def diff_events(old_events: List[Dict[str, Any]], new_events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Events only in the new or only in the earlier document, compared on description, date and times."""
+    old_keys = defaultdict(int)
+    for event in old_events:
+        old_keys[_event_key(event)] += 1
+    added, unchanged = [], 0
+    for event in new_events:
+        key = _event_key(event)
+        if old_keys[key] > 0:
+            old_keys[key] -= 1
+            unchanged += 1
+        else:
+            added.append(event)
+    removed = []
+    for event in old_events:
+        key = _event_key(event)
+        if old_keys[key] > 0:
+            old_keys[key] -= 1
+            removed.append(event)
+    return {"unchanged": unchanged, "added": added, "removed": removed}
+
+
+def describe(queue, doc_hash: str, result: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """The earlier document a result matched, whether it was reused, and how the events differ."""
+    stored = queue.get_fingerprint(doc_hash)
+    if stored is None or not stored["duplicate_of"]:
+        return None
+    earlier = queue.get_document(stored["duplicate_of"])
+    if earlier is None:
+        return None
+    earlier_events = (earlier["result"] or {}).get("events") or []
+    return {
+        "doc_hash": earlier["doc_hash"],
+        "filename": earlier["filename"],
+        "similarity": round(stored["similarity"], 3),
+        "reused": bool(stored["reused"]),
+        "diff": diff_events(earlier_events, (result or {}).get("events") or []),
+    }
@@ -0,0 +1,101 @@
+"""
+Per-page caches for the OCR and parse stages.
+
+A corrected or re-uploaded SOF usually differs from an earlier upload in a page or
+two. The OCR stage splits the PDF into single-page PDFs and keys the reconstructed
+text of each page by the SHA-256 of that page, so only new or changed pages are
+sent to Document AI. The parse stage keys each parsed page by the SHA-256 of the
+full prompt (page text, instructions and model), so unchanged pages are not sent
+to Gemini again.
+
+Entries are small files under SOF_PAGE_CACHE_DIR (default SOF_DATA_DIR/page_cache),
+written atomically so any number of API nodes and workers can share the directory.
+Set SOF_PAGE_CACHE=0 to disable both caches.
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+from typing import Any, List, Optional
+
+ENABLED = os.getenv("SOF_PAGE_CACHE", "1") != "0"
+CACHE_DIR = os.getenv("SOF_PAGE_CACHE_DIR", os.path.join(os.getenv("SOF_DATA_DIR", "sof_data"), "page_cache"))
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def split_pdf_pages(pdf_path: str) -> List[bytes]:
+    """
+    Splits a PDF into single-page PDFs. The output is deterministic, so an unchanged
+    page hashes the same in every upload of the document.
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    pages = []
+    for page in PdfReader(pdf_path).pages:
+        writer = PdfWriter()
+        writer.add_page(page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        pages.append(buffer.getvalue())
+    return pages
+
+
+def _entry_path(kind: str, key: str, cache_dir: Optional[str]) -> str:
+    extension = {"ocr": ".txt", "parse": ".json"}[kind]
+    directory = os.path.join(cache_dir or CACHE_DIR, kind, key[:2])
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, key + extension)
+
+
+def _write_atomically(path: str, text: str):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# --- OCR pages ---
+def has_page_text(page_hash: str, cache_dir: Optional[str] = None) -> bool:
+    return ENABLED and os.path.exists(_entry_path("ocr", page_hash, cache_dir))
+
+
+def load_page_text(page_hash: str, cache_dir: Optional[str] = None) -> Optional[str]:
+    """Reconstructed text of a page seen before, or None."""
+    if not ENABLED:
+        return None
+    path = _entry_path("ocr", page_hash, cache_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def store_page_text(page_hash: str, text: str, cache_dir: Optional[str] = None):
+    if ENABLED:
+        _write_atomically(_entry_path("ocr", page_hash, cache_dir), text)
+
+
+# --- Parsed pages ---
+def prompt_key(model_name: str, system_instruction: str, prompt: str, max_output_tokens: int) -> str:
+    """Cache key for a parse call: anything that changes the model's input changes the key."""
+    return content_hash(json.dumps([model_name, system_instruction, prompt, max_output_tokens]).encode("utf-8"))
+
+
+def load_parsed(key: str, cache_dir: Optional[str] = None) -> Optional[Any]:
+    """Parsed JSON stored for a prompt, or None."""
+    if not ENABLED:
+        return None
+    path = _entry_path("parse", key, cache_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def store_parsed(key: str, parsed: Any, cache_dir: Optional[str] = None):
+    if ENABLED:
+        _write_atomically(_entry_path("parse", key, cache_dir), json.dumps(parsed, ensure_ascii=False))
@@ -0,0 +1,411 @@
+"""
+Choosing how to parse an SOF: one whole-document call, page-parallel calls, or
+rule-based extraction.
+
+parse_sof_file used to send a single page as one call and anything longer as one
+call per page, in sequence. A two-page SOF with fifteen events paid for two calls
+back to back, while a dense single page could run past the output limit. The
+planner profiles the OCR text first, reading it one page at a time, and picks a strategy:
+
+  - rules: the events table is regular enough that every time-bearing row reads
+    as an event without a model (date, times and a description). Rules only find
+    the events, the vessel name and the port; the header, master, cargo and
+    quantities stay empty, so auto mode picks them only with SOF_PARSE_RULES=1;
+  - whole_document: the document is short and its events fit comfortably in one
+    response, so one call beats several;
+  - page_parallel: anything larger. Pages are sent concurrently (SOF_PARSE_WORKERS),
+    and a page with more rows than one response can hold is split at row boundaries.
+
+With SOF_PARSE_SLO_SECONDS set, the fallback strategy is started if the primary one
+has not produced a valid result within half the SLO, and the first valid result
+wins. Without it, the fallback runs once the primary has failed or returned an
+invalid result. SOF_PARSE_STRATEGY forces one strategy (auto, rules, whole_document,
+page_parallel).
+"""
+import contextvars
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+STRATEGIES = ("rules", "whole_document", "page_parallel")
+STRATEGY = os.getenv("SOF_PARSE_STRATEGY", "auto")
+PARSE_WORKERS = int(os.getenv("SOF_PARSE_WORKERS", "4"))
+# Lets auto mode choose rules, trading the header and most vessel details for no model calls
+RULES_IN_AUTO = os.getenv("SOF_PARSE_RULES", "0") == "1"
+# 0 disables racing: the fallback only runs after the primary strategy has finished without a valid result
+RACE_SLO_SECONDS = float(os.getenv("SOF_PARSE_SLO_SECONDS", "0"))
+
+CHARS_PER_TOKEN = 4
+TOKENS_PER_EVENT = 50
+# gemini-1.5-flash returns at most 8192 output tokens; every call's budget is capped here.
+# Plans leave room for header and vessel info (OUTPUT_HEADROOM).
+MAX_OUTPUT_TOKENS = 8192
+OUTPUT_HEADROOM = 0.75
+WHOLE_DOCUMENT_MAX_PAGES = 4
+WHOLE_DOCUMENT_MAX_INPUT_TOKENS = 24000
+# Rules are trusted only for a real table whose rows they (nearly) all read, and only
+# when the vessel is labelled plainly enough for them to find
+RULES_MIN_ROWS = 5
+RULES_MIN_COVERAGE = 0.9
+# A result is valid when it has no failed pages and at least this share of the table rows as events
+MIN_EVENT_CAPTURE = 0.5
+
+# --- Table Row Detection ---
+_TIME = r"(?:[01]?\d|2[0-4])[.:][0-5]\d|(?:[01]\d|2[0-4])[0-5]\d"
+# A time or a time range ("2005", "20.05 hrs", "0800-1200"); the look-arounds keep
+# quantities, phone numbers and dates from reading as times
+TIME_PATTERN = re.compile(
+    rf"(?<![\d.,:-])({_TIME})(?:\s*-\s*({_TIME}))?(?:\s*(?:hrs|hours|h|lt)\b\.?)?(?![\d.,:])",
+    re.IGNORECASE,
+)
+MONTHS = "jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec"
+# A date with a year or a month name. "30.07" alone could be a time, so it only counts
+# as a date at the start of a row, followed by a day name or in the date column
+DATE_PATTERN = re.compile(
+    r"(?<![\d.])\b(?:\d{1,2}[./-]\d{1,2}[./-]\d{2,4}"
+    rf"|\d{{1,2}}(?:st|nd|rd|th)?\s+(?:{MONTHS})[a-z]*\.?,?\s*\d{{2,4}}"
+    rf"|(?:{MONTHS})[a-z]*\.?\s*\d{{1,2}}(?:st|nd|rd|th)?,?\s*\d{{4}})(?![\d])",
+    re.IGNORECASE,
+)
+SHORT_DATE_PATTERN = re.compile(r"^\s*(?:on\s+)?((?:0?[1-9]|[12]\d|3[01])[./](?:0?[1-9]|1[0-2]))(?![\d.:])", re.IGNORECASE)
+DATE_COLUMN_TOLERANCE = 3
+DAY_PATTERN = re.compile(
+    r"\(?\b(?:mon|tues?|wed|thu(?:rs?)?|fri|sat|sun)(?:day|sday|nesday|rsday|urday)?\b\)?\.?",
+    re.IGNORECASE,
+)
+# Words that carry no event meaning on their own ("03.08.19 at 01.00 LT")
+FILLER_WORDS = {"at", "on", "lt", "hrs", "hours", "from", "to", "till", "until", "and", "am", "pm", "local", "time"}
+VESSEL_PATTERN = re.compile(r"(?:name\s+of\s+vessel|vessel'?s?\s+name|^\s*vessel)\s*[:\-]\s*(.+)", re.IGNORECASE | re.MULTILINE)
+PORT_PATTERN = re.compile(r"(?:port\s+of\s+\w+|^\s*port)\s*[:\-]\s*(.+)", re.IGNORECASE | re.MULTILINE)
+COLUMN_GAP = re.compile(r"\s{3,}")
+WORD = re.compile(r"[A-Za-z]{3,}")
+DIGIT = re.compile(r"\d")
+SEPARATORS = re.compile(r"[\s|:@]+")
+
+
+def parse_row(line: str, date_column: Optional[int] = None) -> Tuple[Optional[str], Optional[str], List[str], str, int]:
+    """
+    Splits a time sheet line into (date, day, times, description, date column). The
+    description is what is left once dates, days, times and filler words are taken
+    out. A bare "dd.mm" is read as a date only when a day name follows it or it sits
+    in `date_column`, the column where earlier rows printed their date.
+    """
+    if not DIGIT.search(line):
+        # No date or time: only a continuation of the row above, or not part of the table
+        return None, None, [], _trim_filler(line), -1
+    rest = line
+    date_text, column = None, -1
+    date = DATE_PATTERN.search(rest)
+    if date:
+        date_text, column = date.group(0), date.start()
+        rest = DATE_PATTERN.sub(" ", rest)
+    else:
+        date = SHORT_DATE_PATTERN.search(rest)
+        if date and (DAY_PATTERN.match(rest[date.end():].lstrip())
+                     or (date_column is not None and abs(date.start(1) - date_column) <= DATE_COLUMN_TOLERANCE)):
+            date_text, column = date.group(1), date.start(1)
+            rest = " " * date.end() + rest[date.end():]
+    day = DAY_PATTERN.search(rest) if date_text else None
+    if day:
+        rest = rest[:day.start()] + " " + rest[day.end():]
+    times, pieces, position = [], [], 0
+    for match in TIME_PATTERN.finditer(rest):
+        times.extend(t for t in match.groups() if t)
+        pieces.append(rest[position:match.start()])
+        position = match.end()
+    if times:
+        pieces.append(rest[position:])
+        rest = " ".join(pieces)
+
+    date_text = date_text.strip(" ,") if date_text else None
+    day_text = day.group(0).strip("(). ") if day else None
+    return date_text, day_text, times, _trim_filler(rest), column
+
+
+def _trim_filler(text: str) -> str:
+    words = SEPARATORS.split(text.strip())
+    while words and words[0].lower().strip(".,-") in FILLER_WORDS:
+        words.pop(0)
+    while words and words[-1].lower().strip(".,-") in FILLER_WORDS:
+        words.pop()
+    return " ".join(words).strip(" -,;")
+
+
+def _has_words(description: str) -> bool:
+    return any(WORD.fullmatch(w) and w.lower() not in FILLER_WORDS for w in re.findall(r"[A-Za-z']+", description))
+
+
+def is_table_row(line: str) -> bool:
+    """A line with a time and something besides dates and times, i.e. a row of a time sheet."""
+    _, _, times, description, _ = parse_row(line)
+    return bool(times and description)
+
+
+def scan_page(page_text: str, state: Dict[str, Any]) -> Tuple[List[Dict[str, str]], int]:
+    """
+    Rule-based events for one page, and the number of table rows on it. `state` carries the current date, day and date
+    column across rows and pages, since time sheets only print the date on the first
+    row of a day. A row counts as an event when its description follows its first
+    time, as in a time sheet; a description to the left of the times is usually a
+    form label from another column. A text-only line indented under the previous
+    event continues its description.
+    """
+    events = []
+    table_rows = 0
+    last_event = None
+    for line in page_text.split("\n"):
+        if not line.strip():
+            continue
+        date, day, times, description, column = parse_row(line, state.get("date_column"))
+        if date:
+            state["date"], state["day"], state["date_column"] = date, day or "", column
+        if times and description:
+            table_rows += 1
+        if times and _has_words(description) and _description_follows_time(line, description):
+            last_event = {
+                "event": description,
+                "day": state.get("day") or "N/A",
+                "start_date": state.get("date") or "N/A",
+                "start_time": times[0],
+                "end_time": times[1] if len(times) > 1 else "N/A",
+            }
+            events.append(last_event)
+        elif not times and not date and last_event and _has_words(description) and line.startswith(" " * 20):
+            last_event["event"] += " " + description
+        else:
+            last_event = None
+    return events, table_rows
+
+
+def extract_page_events(page_text: str, state: Dict[str, Any]) -> List[Dict[str, str]]:
+    return scan_page(page_text, state)[0]
+
+
+def _description_follows_time(line: str, description: str) -> bool:
+    first_word = description.split()[0]
+    time = TIME_PATTERN.search(line)
+    return time is not None and line.find(first_word) >= time.end()
+
+
+def extract_vessel_info(page_text: str) -> Dict[str, str]:
+    """Vessel name and port when the first page labels them on the same line."""
+    info = {}
+    vessel = VESSEL_PATTERN.search(page_text)
+    if vessel:
+        info["name_of_vessel"] = COLUMN_GAP.split(vessel.group(1).strip())[0].strip(" \"'")
+    port = PORT_PATTERN.search(page_text)
+    if port:
+        info["port_of_loading_cargo"] = COLUMN_GAP.split(port.group(1).strip())[0].strip(" \"'")
+    return info
+
+
+def parse_with_rules(pages: Iterable[str]) -> Optional[Dict[str, Any]]:
+    """Rule-based extraction over the pages of a document; None if no events were found."""
+    state: Dict[str, Any] = {}
+    result: Dict[str, Any] = {"header": {}, "vessel_info": {}, "events": []}
+    for i, page_text in enumerate(pages):
+        if i == 0:
+            result["vessel_info"] = extract_vessel_info(page_text)
+        result["events"].extend(extract_page_events(page_text, state))
+    return result if result["events"] else None
+
+
+# --- Document Profile ---
+class DocumentProfile:
+    """What the planner knows about a document, gathered in one pass over its pages."""
+
+    def __init__(self):
+        self.page_count = 0
+        self.chars = 0
+        self.table_rows = 0
+        self.rule_events = 0
+        self.indicator_events = 0
+        self.vessel_found = False
+
+    @property
+    def input_tokens(self) -> int:
+        return self.chars // CHARS_PER_TOKEN
+
+    @property
+    def expected_events(self) -> int:
+        return max(self.table_rows, self.indicator_events)
+
+    @property
+    def output_tokens(self) -> int:
+        return self.expected_events * TOKENS_PER_EVENT
+
+    @property
+    def rule_coverage(self) -> float:
+        return self.rule_events / self.table_rows if self.table_rows else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "pages": self.page_count, "input_tokens": self.input_tokens, "table_rows": self.table_rows,
+            "rule_events": self.rule_events, "expected_events": self.expected_events,
+            "output_tokens": self.output_tokens,
+        }
+
+
+def profile_document(pages: Iterable[str], estimate_event_count: Callable[[str], int]) -> DocumentProfile:
+    """Profiles a document page by page; estimate_event_count is the parser's keyword estimate."""
+    profile = DocumentProfile()
+    state: Dict[str, Any] = {}
+    for page_text in pages:
+        profile.page_count += 1
+        if not page_text.strip():
+            continue
+        if profile.page_count == 1:
+            profile.vessel_found = "name_of_vessel" in extract_vessel_info(page_text)
+        profile.chars += len(page_text)
+        events, table_rows = scan_page(page_text, state)
+        profile.table_rows += table_rows
+        profile.rule_events += len(events)
+        profile.indicator_events += estimate_event_count(page_text)
+    return profile
+
+
+# --- Planning ---
+def plan(profile: DocumentProfile, forced: Optional[str] = None,
+         rules_in_auto: Optional[bool] = None) -> Tuple[str, Optional[str], str]:
+    """Returns (primary strategy, fallback strategy or None, reason)."""
+    forced = forced or STRATEGY
+    rules_in_auto = RULES_IN_AUTO if rules_in_auto is None else rules_in_auto
+    output_fits = profile.output_tokens <= MAX_OUTPUT_TOKENS * OUTPUT_HEADROOM
+    fits_one_call = (output_fits and profile.page_count <= WHOLE_DOCUMENT_MAX_PAGES
+                     and profile.input_tokens <= WHOLE_DOCUMENT_MAX_INPUT_TOKENS)
+    if fits_one_call:
+        model_strategy, model_fallback = "whole_document", "page_parallel"
+    else:
+        model_strategy, model_fallback = "page_parallel", "whole_document" if output_fits else None
+
+    if forced != "auto":
+        if forced not in STRATEGIES:
+            raise ValueError(f"Unknown parse strategy '{forced}'; choose from auto, {', '.join(STRATEGIES)}")
+        if forced == "rules":
+            return "rules", None, "forced by SOF_PARSE_STRATEGY"
+        fallback = "page_parallel" if forced == "whole_document" else "whole_document"
+        return forced, fallback, "forced by SOF_PARSE_STRATEGY"
+
+    if (rules_in_auto and profile.table_rows >= RULES_MIN_ROWS and profile.rule_coverage >= RULES_MIN_COVERAGE
+            and profile.vessel_found):
+        return "rules", model_strategy, f"rules read {profile.rule_events}/{profile.table_rows} table rows"
+    if fits_one_call:
+        return model_strategy, model_fallback, f"{profile.page_count} page(s), ~{profile.output_tokens} output tokens fit one call"
+    return model_strategy, model_fallback, f"{profile.page_count} page(s), ~{profile.output_tokens} output tokens need several calls"
+
+
+def is_valid(result: Optional[Dict[str, Any]], profile: DocumentProfile) -> bool:
+    """A complete-looking result: events found, no failed pages, and not far fewer events than table rows."""
+    if not isinstance(result, dict) or not result.get("events") or result.get("failed_pages"):
+        return False
+    return len(result["events"]) >= profile.table_rows * MIN_EVENT_CAPTURE
+
+
+# --- Page-Parallel Units ---
+def rows_per_unit() -> int:
+    return int(MAX_OUTPUT_TOKENS * OUTPUT_HEADROOM) // TOKENS_PER_EVENT
+
+
+def split_page(page_text: str, max_rows: Optional[int] = None) -> List[str]:
+    """Splits a page with more table rows than one response can hold at row boundaries."""
+    max_rows = max_rows or rows_per_unit()
+    if page_text.count("\n") < max_rows:
+        return [page_text]
+    chunks, current, rows = [], [], 0
+    for line in page_text.split("\n"):
+        if is_table_row(line):
+            if rows == max_rows:
+                chunks.append("\n".join(current))
+                current, rows = [], 0
+            rows += 1
+        current.append(line)
+    chunks.append("\n".join(current))
+    return chunks
+
+
+def run_units(pages: Iterable[str], parse_unit: Callable[[str, bool], Any], workers: Optional[int] = None) -> List[Tuple[int, Any]]:
+    """
+    Parses pages concurrently, at most `workers` at a time; a dense page becomes
+    several units. Pages are read as they are submitted, so only the pages in
+    flight are held in memory. Returns (page_index, parsed) pairs in page order.
+    """
+    workers = workers or PARSE_WORKERS
+    results: List[Tuple[int, Any]] = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="parse") as pool:
+        pending = []
+        for i, page_text in enumerate(pages):
+            if not page_text.strip():
+                continue
+            for j, unit in enumerate(split_page(page_text)):
+                # Copying the context keeps the calls in the caller's profile (see profiling.py)
+                pending.append((i, pool.submit(contextvars.copy_context().run, parse_unit, unit, i == 0 and j == 0)))
+            while len(pending) > workers * 2:
+                page_index, future = pending.pop(0)
+                results.append((page_index, future.result()))
+        for page_index, future in pending:
+            results.append((page_index, future.result()))
+    return results
+
+
+# --- Racing ---
+def race(primary: Callable[[], Any], fallback: Optional[Callable[[], Any]], accept: Callable[[Any], bool],
+         slo_seconds: Optional[float] = None) -> Tuple[Any, str]:
+    """
+    Runs primary; starts fallback if primary has no accepted result within half the
+    SLO, or as soon as primary finishes without one. Returns (result, winner) where
+    winner is "primary" or "fallback". The first accepted result wins; when neither
+    is accepted, primary's result is preferred if it returned anything. A strategy
+    that raises counts as not accepted, and the error is re-raised only when neither
+    returned anything. A losing call is left to finish in the background; its pages
+    still land in the parse cache. Without an SLO, fallback runs after primary.
+    """
+    slo_seconds = RACE_SLO_SECONDS if slo_seconds is None else slo_seconds
+    if fallback is None:
+        return primary(), "primary"
+    results: Dict[str, Any] = {}
+    errors: Dict[str, Exception] = {}
+
+    def settle(name: str, get_result: Callable[[], Any]) -> bool:
+        """Records one strategy's outcome; True if its result is accepted."""
+        try:
+            results[name] = get_result()
+        except Exception as e:
+            print(f"Parse strategy {name} failed: {e}")
+            errors[name] = e
+            return False
+        return accept(results[name])
+
+    def best() -> Tuple[Any, str]:
+        for name in ("primary", "fallback"):
+            if results.get(name):
+                return results[name], name
+        if errors:
+            raise errors.get("primary") or errors["fallback"]
+        return results.get("fallback"), "fallback"
+
+    if slo_seconds <= 0:
+        for name, strategy in (("primary", primary), ("fallback", fallback)):
+            if settle(name, strategy):
+                return results[name], name
+        return best()
+
+    pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="parse-race")
+    try:
+        futures = {pool.submit(contextvars.copy_context().run, primary): "primary"}
+        done, pending = wait(futures, timeout=slo_seconds / 2)
+        if done and settle("primary", next(iter(done)).result):
+            return results["primary"], "primary"
+        fallback_future = pool.submit(contextvars.copy_context().run, fallback)
+        futures[fallback_future] = "fallback"
+        pending = set(pending) | {fallback_future}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                if settle(name, future.result):
+                    return results[name], name
+        return best()
+    finally:
+        # Don't wait for the loser
+        pool.shutdown(wait=False)
@@ -3,7 +3,14 @@ import os
 import json
 import re
 import ast
-import google.generativeai as genai
+import tempfile
+import threading
+import page_cache
+import parse_strategy
+import profiling
+import prompt_builder
+import text_artifact
+from rate_limiter import GEMINI, BackendUnavailableError, CircuitOpenError
 from dotenv import load_dotenv
 from typing import Optional, Dict, List, Any
 
@@ -38,7 +45,7 @@ def get_sof_schema_for_prompt() -> str:
         }
       ]
     }
-    return json.dumps(schema, indent=2)
+    return prompt_builder.minify_json(schema)
 
 # --- Robust JSON Parsing and Cleaning (from your provided code) ---
 def find_balanced_json(text: str) -> Optional[str]:
@@ -113,63 +120,112 @@ def extract_json_from_model_response(raw_text: str) -> Optional[Any]:
     repaired = re.sub(r'}\s*{', '},{', repaired) # Fix missing comma between objects
     repaired = re.sub(r',\s*(?=[}\]])', '', repaired) # Remove other trailing commas
 
-    # Save debug files
-    with open('raw_model_response.txt', 'w', encoding='utf-8') as f:
-        f.write(raw_text)
-    with open('attempted_clean.json', 'w', encoding='utf-8') as f:
-        f.write(repaired)
-
     try:
         return json.loads(repaired)
     except json.JSONDecodeError as e:
         show_json_error_context(repaired, e)
-        print("Final parsing attempt failed after cleaning. Check 'attempted_clean.json'.")
+        debug_path = save_debug_response(raw_text, repaired)
+        print(f"Final parsing attempt failed after cleaning. Check '{debug_path}'.")
         return None
 
-# --- Single Page Document Handler ---
-def parse_single_page_sof(input_text: str) -> Optional[Any]:
-    """Handles single-page SOF documents with increased token limits and validation."""
-    schema_description = get_sof_schema_for_prompt()
-    
-    # Count approximate events in the text to determine token needs
-    event_indicators = ['Loading', 'Awaiting', 'Stevedore', 'P.O.B.', 'Passage', 'Arrived', 'First line', 'Accommodation', 'Inward', 'Initial', 'Master']
-    event_count = sum(input_text.count(indicator) for indicator in event_indicators)
-    
-    # Calculate dynamic token limit based on content size
-    base_tokens = 4096
-    additional_tokens = min(event_count * 50, 12288)  # Max 16K tokens
-    max_tokens = base_tokens + additional_tokens
-    
-    prompt = f"""
-    Analyze the following COMPLETE "Statement of Facts" document. This is a SINGLE-PAGE document containing ALL events from start to finish.
+def save_debug_response(raw_text: str, repaired: str) -> str:
+    """
+    Writes an unparseable response and its cleaned attempt to a new temp file and returns
+    its path; pages are parsed concurrently, so every failure gets a file of its own.
+    """
+    fd, path = tempfile.mkstemp(prefix="sof-model-response-", suffix=".txt")
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write("---- raw model response ----\n")
+        f.write(raw_text)
+        f.write("\n---- attempted clean ----\n")
+        f.write(repaired)
+    return path
+
+# --- Gemini Call ---
+# google.generativeai is imported on first use so that importing this module is cheap
+def configure_gemini(api_key: str):
+    """Configures the Gemini SDK with an API key."""
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
 
-    CRITICAL REQUIREMENTS:
-    1. Extract ALL header and vessel information
-    2. Extract EVERY SINGLE EVENT from the entire document - do not miss any events
-    3. Pay special attention to events at the end of the document
-    4. Ensure you capture events through the final completion and departure
-    5. Your response must be ONLY the JSON object, starting with `{{` and ending with `}}`
+# Running totals of Gemini usage for this process, read by the evaluation harness;
+# page-parallel parsing updates them from several threads
+usage_totals = {"calls": 0, "prompt_tokens": 0, "output_tokens": 0}
+usage_lock = threading.Lock()
+
+def reset_usage():
+    """Zeroes the running Gemini usage totals."""
+    with usage_lock:
+        for key in usage_totals:
+            usage_totals[key] = 0
+
+MODEL_NAME = 'gemini-1.5-flash-latest'
+
+def system_instruction() -> str:
+    return prompt_builder.shared_instructions(get_sof_schema_for_prompt())
+
+def generate_model_text(prompt: str, max_output_tokens: int) -> str:
+    """Sends a prompt to Gemini and returns the raw text of the response."""
+    import google.generativeai as genai
+    model = prompt_builder.get_model(MODEL_NAME, system_instruction())
+    generation_config = genai.types.GenerationConfig(max_output_tokens=max_output_tokens)
+    # Paced to the quota, retried on 429/5xx, and short-circuited while Gemini is degraded
+    response = GEMINI.call(model.generate_content, prompt, generation_config=generation_config)
+
+    usage = getattr(response, "usage_metadata", None)
+    with usage_lock:
+        usage_totals["calls"] += 1
+        if usage:
+            usage_totals["prompt_tokens"] += usage.prompt_token_count
+            usage_totals["output_tokens"] += usage.candidates_token_count
+    return response.text
+
+def generate_parsed(prompt: str, max_output_tokens: int) -> Optional[Any]:
+    """
+    Parsed JSON for a prompt. Pages whose prompt was parsed successfully before are
+    served from the page cache, so an amended document only sends its changed pages.
+    """
+    key = page_cache.prompt_key(MODEL_NAME, system_instruction(), prompt, max_output_tokens)
+    cached = page_cache.load_parsed(key)
+    if cached is not None:
+        print("Using cached parse result for unchanged page text.")
+        return cached
+
+    raw_text = generate_model_text(prompt, max_output_tokens)
+    print("Raw response received. Attempting to parse JSON...")
+    parsed_data = extract_json_from_model_response(raw_text)
+    if parsed_data:
+        page_cache.store_parsed(key, parsed_data)
+    return parsed_data
 
-    JSON Schema to follow:
-    {schema_description}
+# --- Single Page Document Handler ---
+EVENT_INDICATORS = ['Loading', 'Awaiting', 'Stevedore', 'P.O.B.', 'Passage', 'Arrived', 'First line', 'Accommodation', 'Inward', 'Initial', 'Master']
 
-    --- COMPLETE DOCUMENT TEXT START ---
-    {input_text}
-    --- COMPLETE DOCUMENT TEXT END ---
+def estimate_event_count(input_text: str) -> int:
+    """Counts approximate events in the text to determine token needs."""
+    return sum(input_text.count(indicator) for indicator in EVENT_INDICATORS)
 
-    IMPORTANT: This document contains approximately {event_count} events. Make sure to capture ALL of them, including the final events at the end.
+def single_page_token_budget(event_count: int, base_tokens: int = 4096, tokens_per_event: int = 50,
+                             max_tokens: int = parse_strategy.MAX_OUTPUT_TOKENS) -> int:
+    """Dynamic output token limit for a whole-document call, based on content size."""
+    max_tokens = min(max_tokens, parse_strategy.MAX_OUTPUT_TOKENS)
+    additional_tokens = min(event_count * tokens_per_event, max_tokens - base_tokens)
+    return base_tokens + additional_tokens
 
-    JSON Output:
+def parse_single_page_sof(input_text: str, max_tokens: Optional[int] = None) -> Optional[Any]:
     """
+    Handles single-page SOF documents with increased token limits and validation.
+    max_tokens overrides the budget from single_page_token_budget.
+    """
+    event_count = estimate_event_count(input_text)
+    if max_tokens is None:
+        max_tokens = single_page_token_budget(event_count)
+    
+    prompt = prompt_builder.build_document_prompt(input_text, event_count)
 
     print(f"Processing single-page document with ~{event_count} events using {max_tokens} max tokens...")
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        generation_config = genai.types.GenerationConfig(max_output_tokens=max_tokens)
-        response = model.generate_content(prompt, generation_config=generation_config)
-        
-        print("Raw response received. Attempting to parse JSON...")
-        parsed_data = extract_json_from_model_response(response.text)
+        parsed_data = generate_parsed(prompt, max_tokens)
         
         # Validation: Check if we captured a reasonable number of events
         if parsed_data and isinstance(parsed_data, dict):
@@ -182,64 +238,142 @@ def parse_single_page_sof(input_text: str) -> Optional[Any]:
                 print("Consider increasing token limit or splitting document.")
             
         return parsed_data
+    except (CircuitOpenError, BackendUnavailableError):
+        # Not a bad page: the backend is unavailable, so let the caller retry the document
+        raise
     except Exception as e:
         print(f"An error occurred during single-page API processing: {e}")
         return None
 
 # --- Gemini API Interaction ---
-def parse_sof_chunk(input_text: str, is_first_page: bool) -> Optional[Any]:
+def parse_sof_chunk(input_text: str, is_first_page: bool, max_output_tokens: int = parse_strategy.MAX_OUTPUT_TOKENS) -> Optional[Any]:
     """Sends a chunk of text (one page) to the Gemini API for parsing."""
-    if is_first_page:
-        schema_description = get_sof_schema_for_prompt()
-        prompt = f"""
-        Analyze the following text from the first page of a "Statement of Facts" document. Your task is to extract the information and structure it into a single, valid JSON object.
-
-        Adhere strictly to this JSON schema. Your entire response must be ONLY the JSON object, starting with `{{` and ending with `}}`. Do not include markdown or any other explanatory text.
-
-        - Extract all header and vessel information.
-        - Meticulously extract every event from THIS PAGE into the "events" list.
-
-        JSON Schema to follow:
-        {schema_description}
-
-        --- DOCUMENT TEXT START ---
-        {input_text}
-        --- DOCUMENT TEXT END ---
-
-        JSON Output:
-        """
-    else:
-        # For subsequent pages, we only need the events.
-        event_schema = [{"event": "...", "day": "...", "start_date": "...", "start_time": "...", "end_time": "..."}]
-        prompt = f"""
-        Analyze the following text from a subsequent page of a "Statement of Facts" document. Your task is to extract only the events and structure them into a valid JSON array of objects.
-
-        Your entire response must be ONLY the JSON array, starting with `[` and ending with `]`. Do not include any other text.
-
-        JSON Array of Events Schema to follow:
-        {json.dumps(event_schema, indent=2)}
-
-        --- DOCUMENT TEXT START ---
-        {input_text}
-        --- DOCUMENT TEXT END ---
-
-        JSON Array Output:
-        """
+    # Schemas and shared instructions travel in the system instruction (see prompt_builder)
+    prompt = prompt_builder.build_page_prompt(input_text, is_first_page)
 
     print(f"Sending {'first' if is_first_page else 'subsequent'} page to the Google Gemini API for parsing...")
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
         # Configure for potentially larger JSON output, even from a single page
-        generation_config = genai.types.GenerationConfig(max_output_tokens=8192)
-        response = model.generate_content(prompt, generation_config=generation_config)
-        
-        print("Raw response received. Attempting to parse JSON...")
-        return extract_json_from_model_response(response.text)
+        return generate_parsed(prompt, max_output_tokens)
+    except (CircuitOpenError, BackendUnavailableError):
+        # Not a bad page: the backend is unavailable, so let the caller retry the document
+        raise
     except Exception as e:
         print(f"An error occurred during API processing: {e}")
         return None
 
+# --- Page Merging ---
+def merge_page_results(page_results: List[tuple]) -> Dict[str, Any]:
+    """
+    Merges per-page parser output into one SOF document.
+    page_results is a list of (page_index, parsed_data) in page order; the first entry
+    for page 0 carries the header and vessel info, everything else is a plain event
+    list (a dense page split into several calls appears once per call). Pages that
+    could not be parsed are listed (1-based) under "failed_pages" so the gap is visible.
+    """
+    final_json = {}
+    all_events = []
+    failed_pages = []
+    seen_first = False
+
+    for i, parsed_data in page_results:
+        is_first = (i == 0 and not seen_first)
+        seen_first = seen_first or i == 0
+        if not parsed_data:
+            print(f"Warning: Failed to parse page {i + 1}; its events are missing from the result.")
+            if i + 1 not in failed_pages:
+                failed_pages.append(i + 1)
+            continue
+
+        if is_first and isinstance(parsed_data, dict):
+            final_json['header'] = parsed_data.get('header', {})
+            final_json['vessel_info'] = parsed_data.get('vessel_info', {})
+            page_events = parsed_data.get('events', [])
+            if isinstance(page_events, list):
+                all_events.extend(page_events)
+        elif not is_first and isinstance(parsed_data, list):
+            all_events.extend(parsed_data)
+        else:
+            print(f"Warning: Parsed data for page {i + 1} has an unexpected format; its events are missing from the result.")
+            if i + 1 not in failed_pages:
+                failed_pages.append(i + 1)
+
+    final_json['events'] = all_events
+    if failed_pages:
+        final_json['failed_pages'] = failed_pages
+    return final_json
+
+# --- Parse Strategies (see parse_strategy.py) ---
+def parse_whole_document(input_file: str, profile: parse_strategy.DocumentProfile) -> Optional[Dict[str, Any]]:
+    """One call for the whole document, budgeted for the table rows the profile found."""
+    sof_text = text_artifact.PAGE_BREAK.decode("utf-8").join(text_artifact.iter_pages(input_file))
+    max_tokens = single_page_token_budget(profile.expected_events)
+    parsed_data = parse_single_page_sof(sof_text, max_tokens=max_tokens)
+    return parsed_data if isinstance(parsed_data, dict) else None
+
+def parse_page_unit(page_text: str, is_first_page: bool) -> Optional[Any]:
+    """One page (or part of a dense page), retried once on a bad response."""
+    parsed_data = parse_sof_chunk(page_text, is_first_page=is_first_page)
+    if not parsed_data:
+        # Malformed or truncated model output is usually not repeated on a second try
+        print("Retrying page once...")
+        parsed_data = parse_sof_chunk(page_text, is_first_page=is_first_page)
+    return parsed_data
+
+def parse_pages_in_parallel(input_file: str) -> Dict[str, Any]:
+    """Concurrent calls per page, merged in page order."""
+    return merge_page_results(parse_strategy.run_units(text_artifact.iter_pages(input_file), parse_page_unit))
+
+def run_strategy(strategy: str, input_file: str, profile: parse_strategy.DocumentProfile) -> Optional[Dict[str, Any]]:
+    print(f"Parsing with strategy '{strategy}'...")
+    if strategy == "rules":
+        return parse_strategy.parse_with_rules(text_artifact.iter_pages(input_file))
+    if strategy == "whole_document":
+        return parse_whole_document(input_file, profile)
+    return parse_pages_in_parallel(input_file)
+
 # --- Main Execution Logic ---
+def parse_sof_file(input_file: str, output_file: str) -> Optional[Dict[str, Any]]:
+    """
+    Reads, plans, parses and merges one OCR text file and writes the SOF JSON.
+    Returns the parsed document, or None if nothing could be extracted.
+    Gemini must already be configured (see configure_gemini).
+    """
+    if not os.path.exists(input_file):
+        print(f"Error: Input file not found at '{input_file}'")
+        return None
+
+    # Pages are read one at a time through the artifact's page index (see text_artifact.py),
+    # so memory does not grow with the length of the bundle
+    print(f"Reading and profiling SOF text from '{input_file}'...")
+    with profiling.stage("parse.plan"):
+        profile = parse_strategy.profile_document(text_artifact.iter_pages(input_file), estimate_event_count)
+    print(f"Document split into {profile.page_count} pages.")
+    if not profile.chars:
+        print("Error: The input file is empty.")
+        return None
+
+    primary, fallback, reason = parse_strategy.plan(profile)
+    print(f"Parse plan: {primary}{f' (fallback {fallback})' if fallback else ''}, because {reason}.")
+    final_json, winner = parse_strategy.race(
+        lambda: run_strategy(primary, input_file, profile),
+        (lambda: run_strategy(fallback, input_file, profile)) if fallback else None,
+        accept=lambda result: parse_strategy.is_valid(result, profile),
+    )
+    if winner == "fallback":
+        print(f"Using the result of the fallback strategy '{fallback}'.")
+
+    if final_json and (final_json.get('header') or final_json.get('vessel_info') or final_json.get('events')):
+        all_events = final_json.get('events', [])
+        print(f"\nSuccessfully parsed {len(all_events)} events across {profile.page_count} page(s). Writing to '{output_file}'...")
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(final_json, f, indent=2)
+        print("JSON file created successfully.")
+        return final_json
+
+    print("Failed to generate structured data after processing all pages.")
+    return None
+
 def main():
     """Main function to read, chunk, parse, and merge SOF data."""
     load_dotenv()
@@ -253,76 +387,9 @@ def main():
     if not api_key:
         print("Error: Google API key not found. Please create a .env file and add: GOOGLE_API_KEY='your_key_here'")
         return
-    genai.configure(api_key=api_key)
-
-    if not os.path.exists(args.input_file):
-        print(f"Error: Input file not found at '{args.input_file}'")
-        return
+    configure_gemini(api_key)
 
-    print(f"Reading and splitting SOF text from '{args.input_file}'...")
-    with open(args.input_file, "r", encoding="utf-8") as f:
-        sof_text = f.read()
-
-    if not sof_text.strip():
-        print("Error: The input file is empty.")
-        return
-
-    pages = sof_text.split('--- Page Break ---')
-    print(f"Document split into {len(pages)} pages.")
-
-    # Check if this is a single-page document (no page breaks found)
-    is_single_page = len(pages) == 1 and '--- Page Break ---' not in sof_text
-    
-    if is_single_page:
-        print("Detected single-page document. Using specialized single-page parser...")
-        parsed_data = parse_single_page_sof(sof_text)
-        
-        if parsed_data and isinstance(parsed_data, dict):
-            final_json = parsed_data
-            all_events = parsed_data.get('events', [])
-            print(f"Single-page parsing completed. Captured {len(all_events)} events.")
-        else:
-            print("Failed to parse single-page document.")
-            return
-    else:
-        # Multi-page document processing
-        final_json = {}
-        all_events = []
-
-        for i, page_text in enumerate(pages):
-            if not page_text.strip():
-                continue
-            
-            print(f"\n--- Processing Page {i + 1} ---")
-            is_first = (i == 0)
-            parsed_data = parse_sof_chunk(page_text, is_first_page=is_first)
-
-            if not parsed_data:
-                print(f"Warning: Failed to parse page {i + 1}. Skipping.")
-                continue
-
-            if is_first and isinstance(parsed_data, dict):
-                final_json['header'] = parsed_data.get('header', {})
-                final_json['vessel_info'] = parsed_data.get('vessel_info', {})
-                page_events = parsed_data.get('events', [])
-                if isinstance(page_events, list):
-                    all_events.extend(page_events)
-            elif not is_first and isinstance(parsed_data, list):
-                all_events.extend(parsed_data)
-            else:
-                print(f"Warning: Parsed data for page {i + 1} has an unexpected format. Skipping.")
-
-        final_json['events'] = all_events
-
-    if final_json.get('header') or final_json.get('vessel_info') or final_json.get('events'):
-        page_count = 1 if is_single_page else len(pages)
-        print(f"\nSuccessfully parsed {len(all_events)} events across {page_count} page(s). Writing to '{args.output_file}'...")
-        with open(args.output_file, "w", encoding="utf-8") as f:
-            json.dump(final_json, f, indent=2)
-        print("JSON file created successfully.")
-    else:
-        print("Failed to generate structured data after processing all pages.")
+    parse_sof_file(args.input_file, args.output_file)
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,297 @@
+"""
+Opt-in request profiling: wall-clock stage breakdowns and sampled stacks.
+
+A profiled request or job records how long each stage took (OCR, parse, the Document
+AI operation, Gemini calls, quota waits and retry back-off) and, every
+SOF_PROFILE_INTERVAL_MS, samples the Python stacks of the threads working on it. The
+breakdown is returned with the response. Profiles that took at least
+SOF_PROFILE_SLOW_SECONDS are saved under SOF_PROFILE_DIR as collapsed stacks
+(<name>.folded, for flamegraph.pl or speedscope) next to the breakdown (<name>.json);
+only the newest SOF_PROFILE_MAX_FILES are kept.
+
+Profiling is off unless a request sends "X-SOF-Profile: 1" or is picked by
+SOF_PROFILE_SAMPLE_RATE (a fraction of requests and worker jobs). Unprofiled requests
+only pay for a context variable lookup per stage.
+
+Stages are timed with `with profiling.stage("name"):` anywhere below a profiled call,
+including in threads started through run_in_threadpool or parse_strategy's pools,
+which copy the context. Stages nest (ocr holds gcs_upload and document_ai, parse holds
+gemini), so each one reports its parent and its self time: the wall-clock time in which
+none of its child stages was running, i.e. our own code and anything not staged
+separately. The profile's unstaged_seconds is the same for the request as a whole. Stacks are only sampled from worker threads, never from the
+event loop, which serves other requests at the same time.
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+SAMPLE_RATE = float(os.getenv("SOF_PROFILE_SAMPLE_RATE", "0"))
+SLOW_SECONDS = float(os.getenv("SOF_PROFILE_SLOW_SECONDS", "30"))
+INTERVAL_SECONDS = float(os.getenv("SOF_PROFILE_INTERVAL_MS", "10")) / 1000
+PROFILE_DIR = os.getenv("SOF_PROFILE_DIR", os.path.join(os.getenv("SOF_DATA_DIR", "sof_data"), "profiles"))
+MAX_FILES = int(os.getenv("SOF_PROFILE_MAX_FILES", "50"))
+HEADER = "X-SOF-Profile"
+MAX_STACK_DEPTH = 64
+
+_current: contextvars.ContextVar = contextvars.ContextVar("sof_profile", default=None)
+_span: contextvars.ContextVar = contextvars.ContextVar("sof_profile_span", default=None)
+
+
+def requested(header_value: Optional[str] = None) -> bool:
+    """Whether to profile: the header asks for it, or the request falls in the sample."""
+    if header_value is not None:
+        return header_value.strip().lower() in ("1", "true", "yes", "on")
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+class _Span:
+    """One running stage (or a whole profile), collecting the intervals of the stages nested in it."""
+
+    def __init__(self, name: Optional[str], started: float):
+        self.name = name
+        self.started = started
+        self.lock = threading.Lock()
+        # Children can run in other threads, and overlap each other
+        self.children: List[Tuple[float, float]] = []
+
+    def add_child(self, started: float, ended: float):
+        with self.lock:
+            self.children.append((started, ended))
+
+    def self_seconds(self, ended: float) -> float:
+        """Time up to `ended` in which no child was running."""
+        with self.lock:
+            intervals = sorted(self.children)
+        covered, reach = 0.0, self.started
+        for start, end in intervals:
+            start, end = max(start, reach), min(end, ended)
+            if end > start:
+                covered += end - start
+                reach = end
+        return max(ended - self.started - covered, 0.0)
+
+
+class Profile:
+    """Stage timings and stack samples for one request or job."""
+
+    def __init__(self, name: str):
+        self.name = name
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name)[:40]
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{safe_name}-{uuid.uuid4().hex[:6]}"
+        self.started = time.perf_counter()
+        self.total_seconds: Optional[float] = None
+        self.root = _Span(None, self.started)
+        self.lock = threading.Lock()
+        # name -> [seconds, calls, self seconds, parent stage name or None]
+        self.stages: Dict[str, list] = {}
+        self.threads: Counter = Counter()
+        self.stacks: Counter = Counter()
+        self.flamegraph: Optional[str] = None
+
+    def record(self, stage_name: str, seconds: float, self_seconds: Optional[float] = None,
+               parent: Optional[str] = None):
+        with self.lock:
+            totals = self.stages.setdefault(stage_name, [0.0, 0, 0.0, parent])
+            totals[0] += seconds
+            totals[1] += 1
+            totals[2] += seconds if self_seconds is None else self_seconds
+
+    def enter_thread(self):
+        with self.lock:
+            self.threads[threading.get_ident()] += 1
+
+    def exit_thread(self):
+        with self.lock:
+            ident = threading.get_ident()
+            self.threads[ident] -= 1
+            if self.threads[ident] <= 0:
+                del self.threads[ident]
+
+    def sample(self, frames: Dict[int, Any]):
+        with self.lock:
+            idents = list(self.threads)
+        for ident in idents:
+            frame = frames.get(ident)
+            if frame is not None:
+                self.stacks[_fold(frame)] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = self.total_seconds if self.total_seconds is not None else time.perf_counter() - self.started
+        with self.lock:
+            stages = {
+                name: {"seconds": round(seconds, 3), "self_seconds": round(self_seconds, 3), "calls": calls,
+                       "parent": parent}
+                for name, (seconds, calls, self_seconds, parent) in sorted(self.stages.items(), key=lambda item: -item[1][0])
+            }
+        return {
+            "id": self.id,
+            "total_seconds": round(elapsed, 3),
+            "unstaged_seconds": round(self.root.self_seconds(self.started + elapsed), 3),
+            "stages": stages,
+            "samples": sum(self.stacks.values()),
+            "flamegraph": self.flamegraph,
+        }
+
+    def server_timing(self) -> str:
+        """
+        The stage breakdown as a Server-Timing header, so browser dev tools show it too.
+        Each entry's duration is the stage's self time, so nested stages are not counted
+        twice; the description holds its parent and time including children.
+        """
+        summary = self.summary()
+        entries = []
+        for name, stage_summary in summary["stages"].items():
+            nesting = f"in {stage_summary['parent']}, " if stage_summary["parent"] else ""
+            entries.append(f'{name.replace(".", "-")};desc="{nesting}{stage_summary["seconds"] * 1000:.1f}ms with children";'
+                           f'dur={stage_summary["self_seconds"] * 1000:.1f}')
+        return ", ".join(entries + [f"unstaged;dur={summary['unstaged_seconds'] * 1000:.1f}",
+                                    f"total;dur={summary['total_seconds'] * 1000:.1f}"])
+
+
+def _fold(frame) -> str:
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler:
+    """One background thread sampling the stacks of every active profile's threads."""
+
+    def __init__(self, interval: float = INTERVAL_SECONDS):
+        self.interval = interval
+        self.profiles = set()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, profile: Profile):
+        with self.condition:
+            self.profiles.add(profile)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def remove(self, profile: Profile):
+        with self.condition:
+            self.profiles.discard(profile)
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self.condition:
+                while not self.profiles:
+                    self.condition.wait()
+                profiles = list(self.profiles)
+            frames = sys._current_frames()
+            frames.pop(me, None)
+            for profile in profiles:
+                profile.sample(frames)
+            del frames
+            time.sleep(self.interval)
+
+
+SAMPLER = Sampler()
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times a stage of the current profile (if any) and samples this thread meanwhile."""
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    sampled = not _in_event_loop()
+    if sampled:
+        current.enter_thread()
+    parent = _span.get() or current.root
+    span = _Span(name, time.perf_counter())
+    token = _span.set(span)
+    try:
+        yield
+    finally:
+        ended = time.perf_counter()
+        _span.reset(token)
+        current.record(name, ended - span.started, span.self_seconds(ended), parent.name)
+        parent.add_child(span.started, ended)
+        if sampled:
+            current.exit_thread()
+
+
+def in_stage(name: str, fn):
+    """fn wrapped in stage(name), for handing to a thread pool."""
+    def staged(*args, **kwargs):
+        with stage(name):
+            return fn(*args, **kwargs)
+    return staged
+
+
+@contextlib.contextmanager
+def profile(name: str, enabled: bool) -> Iterator[Optional[Profile]]:
+    """
+    Profiles the enclosed call when enabled (yields None otherwise). Slow profiles are
+    saved to PROFILE_DIR on exit, whether the call succeeded or not.
+    """
+    if not enabled:
+        yield None
+        return
+    current = Profile(name)
+    token = _current.set(current)
+    span_token = _span.set(current.root)
+    SAMPLER.add(current)
+    try:
+        yield current
+    finally:
+        SAMPLER.remove(current)
+        _span.reset(span_token)
+        _current.reset(token)
+        current.total_seconds = time.perf_counter() - current.started
+        if current.total_seconds >= SLOW_SECONDS:
+            try:
+                save(current)
+            except OSError as e:
+                print(f"Warning: could not save profile {current.id}: {e}")
+
+
+def save(current: Profile, profile_dir: Optional[str] = None) -> str:
+    """Writes a profile's collapsed stacks and breakdown, then prunes the oldest profiles."""
+    directory = profile_dir or PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, current.id)
+    with open(base + ".folded", "w", encoding="utf-8") as f:
+        for stack, count in current.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    current.flamegraph = base + ".folded"
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump(current.summary(), f, indent=2)
+    prune(directory)
+    return current.flamegraph
+
+
+def prune(directory: str, max_files: int = MAX_FILES):
+    """Deletes all but the newest max_files profiles."""
+    names = sorted(name[:-len(".folded")] for name in os.listdir(directory) if name.endswith(".folded"))
+    for name in names[:max(len(names) - max_files, 0)]:
+        for extension in (".folded", ".json"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(directory, name + extension))
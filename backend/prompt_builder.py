@@ -0,0 +1,112 @@
+"""
+Compact prompt construction for the Gemini SOF parser.
+
+Layout-reconstructed OCR text pads columns with long runs of spaces, and every
+call used to repeat the full instructions and a pretty-printed schema. Here the
+padding is collapsed into column delimiters and the instructions and schema that
+are the same for every page are sent once as the model's system instruction.
+
+The shared instructions are far below the 32K-token minimum Gemini accepts for
+cached content, so they are not context-cached; they are billed with every call.
+"""
+import json
+import os
+import re
+from typing import Any, Dict, Tuple
+
+COLUMN_DELIMITER = " | "
+PAGE_BREAK = "--- Page Break ---"
+
+# Set SOF_COMPACT_TEXT=0 to send the OCR text with its original padding
+COMPACT_TEXT = os.getenv("SOF_COMPACT_TEXT", "1") != "0"
+
+EVENT_SCHEMA = [{"event": "...", "day": "...", "start_date": "...", "start_time": "...", "end_time": "..."}]
+
+_models: Dict[Tuple[str, str], Any] = {}
+
+
+def minify_json(value: Any) -> str:
+    """JSON without indentation or spaces after separators."""
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def compact_layout_text(text: str, min_gap: int = 3) -> str:
+    """
+    Collapses the column padding produced by layout reconstruction.
+    Gaps of `min_gap` or more spaces become COLUMN_DELIMITER, a line indented into a
+    later column (relative to the page's left margin) starts with "| ", and runs of
+    blank lines collapse to one.
+    """
+    gap = re.compile(" {%d,}" % min_gap)
+    compacted_pages = []
+    for page in text.split(PAGE_BREAK):
+        lines = [line.rstrip() for line in page.split("\n")]
+        margin = min((len(line) - len(line.lstrip(" ")) for line in lines if line), default=0)
+        compacted = []
+        for line in lines:
+            if not line:
+                if compacted and compacted[-1] != "":
+                    compacted.append("")
+                continue
+            body = line.lstrip(" ")
+            indent = len(line) - len(body) - margin
+            body = gap.sub(COLUMN_DELIMITER, body)
+            if indent >= min_gap:
+                body = COLUMN_DELIMITER.lstrip() + body
+            compacted.append(body)
+        compacted_pages.append("\n".join(compacted).strip("\n"))
+    return f"\n{PAGE_BREAK}\n".join(compacted_pages)
+
+
+def prepare_text(text: str) -> str:
+    """The OCR text as it is embedded in prompts."""
+    return compact_layout_text(text) if COMPACT_TEXT else text
+
+
+def shared_instructions(schema_json: str) -> str:
+    """Instructions and schemas common to every call, sent as the system instruction."""
+    column_note = (
+        f'Table columns in the text are separated by "{COLUMN_DELIMITER.strip()}"; a line starting with '
+        f'"{COLUMN_DELIMITER.strip()}" continues a column of the row above.\n'
+        if COMPACT_TEXT else ""
+    )
+    return (
+        'You extract structured data from OCR text of maritime "Statement of Facts" (SOF) documents.\n'
+        + column_note +
+        "Respond with ONLY valid JSON: no markdown fences and no explanatory text.\n"
+        "Extract every event, one object per row, keeping dates and times as written.\n"
+        f"Full document schema (example values): {schema_json}\n"
+        f"Event list schema for continuation pages: {minify_json(EVENT_SCHEMA)}"
+    )
+
+
+def build_document_prompt(text: str, event_count: int) -> str:
+    """Prompt for a whole document parsed in a single call."""
+    return (
+        "Parse this COMPLETE SOF document into one JSON object following the full document schema. "
+        "Extract ALL header and vessel information and EVERY event through final completion and departure; "
+        f"the document contains approximately {event_count} events.\n"
+        f"--- DOCUMENT START ---\n{prepare_text(text)}\n--- DOCUMENT END ---"
+    )
+
+
+def build_page_prompt(text: str, is_first_page: bool) -> str:
+    """Prompt for one page of a multi-page document."""
+    if is_first_page:
+        task = ("First page of an SOF. Return one JSON object following the full document schema with the "
+                "header, vessel information and every event on THIS PAGE.")
+    else:
+        task = "Continuation page of an SOF. Return ONLY a JSON array of the events on this page."
+    return f"{task}\n--- PAGE START ---\n{prepare_text(text)}\n--- PAGE END ---"
+
+
+def get_model(model_name: str, system_instruction: str):
+    """Returns a GenerativeModel carrying the shared instructions, reused across calls."""
+    import google.generativeai as genai
+
+    key = (model_name, system_instruction)
+    model = _models.get(key)
+    if model is None:
+        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+        _models[key] = model
+    return model
@@ -0,0 +1,229 @@
+"""
+Client-side rate limiting, retries and circuit breaking for Gemini and Document AI.
+
+Every call to a Google backend goes through a ServiceGuard, which:
+  - paces requests with a token bucket sized to our quota (SOF_GEMINI_RPM, SOF_DOCAI_RPM),
+    halving the rate when the backend answers 429 and creeping back up on success;
+  - retries 429 and 5xx errors with exponential back-off and full jitter;
+  - opens a circuit breaker after repeated failed calls (each one a call that ran
+    out of retries on 5xx or timeouts) so callers fail fast with CircuitOpenError
+    instead of piling onto a degraded backend. Queue workers put the job back and
+    wait for the breaker to close (see worker.py). A 429 means the backend is up and
+    we are too fast, so it only slows the token bucket and never counts as a failure.
+
+Limits are per process; with several workers, divide the quota between them.
+"""
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import profiling
+
+# HTTP status codes worth retrying; google.api_core exceptions expose them as `.code`
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """The backend is marked degraded; retry after `retry_after` seconds."""
+
+    def __init__(self, service: str, retry_after: float):
+        super().__init__(f"{service} circuit is open; retry in {retry_after:.0f}s")
+        self.service = service
+        self.retry_after = retry_after
+
+
+class BackendUnavailableError(Exception):
+    """A call kept failing with retryable errors until the attempts ran out."""
+
+
+def status_code(exc: BaseException) -> Optional[int]:
+    """HTTP status of a Google API error, if it has one."""
+    code = getattr(exc, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Quota, server-side and timeout errors are retried; client errors are not."""
+    if isinstance(exc, TimeoutError):  # includes concurrent.futures.TimeoutError on Python 3.11+
+        return True
+    if type(exc).__name__ in ("TimeoutError", "DeadlineExceeded", "RetryError"):
+        return True
+    return status_code(exc) in RETRYABLE_STATUS_CODES
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. `rate` tokens are added per second up to `capacity`;
+    acquire() blocks until a token is available. The rate adapts between
+    `min_rate` and the configured ceiling when slow_down()/speed_up() are called.
+    """
+
+    def __init__(self, rate: float, capacity: float, min_rate: Optional[float] = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 8
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Takes one token, waiting for it if needed; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def slow_down(self):
+        """Multiplicative decrease after a quota error."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def speed_up(self):
+        """Additive increase after a success, back towards the quota ceiling."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after `failure_threshold` consecutive failures; open -> half-open
+    after `reset_timeout` seconds, when one trial call is let through; a successful
+    trial closes the circuit, a failed one opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        """Seconds until an open circuit lets a trial call through (0 when closed)."""
+        if self.state == "closed":
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def before_call(self):
+        """Raises CircuitOpenError unless the call may proceed."""
+        with self.lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self.trial_in_flight = False
+            if self.state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+            raise CircuitOpenError(self.name, self.retry_after())
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"Circuit for {self.name} opened after {self.failures} failure(s).")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+
+
+class ServiceGuard:
+    """Rate limiter, retry policy and circuit breaker for one backend."""
+
+    def __init__(self, name: str, requests_per_minute: float, burst: float, max_attempts: int = 6,
+                 base_delay: float = 1.0, max_delay: float = 60.0, failure_threshold: int = 5,
+                 reset_timeout: float = 60.0):
+        self.name = name
+        self.stage_name = name.lower().replace(" ", "_")  # "document_ai" in profiles
+        self.limiter = TokenBucket(requests_per_minute / 60.0, burst)
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Full-jitter exponential back-off for the given (1-based) attempt."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Runs fn under the guard. Non-retryable errors propagate unchanged;
+        retryable ones are retried and end in BackendUnavailableError. The breaker is
+        only consulted again mid-retry once other calls have opened it.
+        """
+        last_error = None
+        for attempt in range(1, self.max_attempts + 1):
+            if attempt == 1:
+                self.breaker.before_call()
+            elif self.breaker.state == "open":
+                raise CircuitOpenError(self.name, self.breaker.retry_after()) from last_error
+            with profiling.stage(f"{self.stage_name}.quota_wait"):
+                self.limiter.acquire()
+            try:
+                with profiling.stage(self.stage_name):
+                    result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    # The backend answered; the request itself was bad
+                    self.breaker.record_success()
+                    raise
+                last_error = e
+                if status_code(e) == 429:
+                    self.limiter.slow_down()
+                elif self.breaker.state == "half_open":
+                    # The trial call failed: reopen now rather than after its retries
+                    self.breaker.record_failure()
+                if attempt == self.max_attempts:
+                    break
+                delay = self.backoff_delay(attempt)
+                print(f"{self.name} call failed ({e}); retry {attempt}/{self.max_attempts - 1} in {delay:.1f}s")
+                with profiling.stage(f"{self.stage_name}.backoff"):
+                    time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            self.limiter.speed_up()
+            return result
+        if status_code(last_error) != 429:
+            self.breaker.record_failure()
+        raise BackendUnavailableError(f"{self.name} still failing after {self.max_attempts} attempts: {last_error}") from last_error
+
+
+# Shared guards, sized to the project's quotas
+GEMINI = ServiceGuard(
+    "Gemini",
+    requests_per_minute=float(os.getenv("SOF_GEMINI_RPM", "60")),
+    burst=float(os.getenv("SOF_GEMINI_BURST", "5")),
+)
+DOCUMENT_AI = ServiceGuard(
+    "Document AI",
+    requests_per_minute=float(os.getenv("SOF_DOCAI_RPM", "10")),
+    burst=float(os.getenv("SOF_DOCAI_BURST", "2")),
+    max_attempts=3,
+    base_delay=5.0,
+)
@@ -0,0 +1,157 @@
+"""
+Compressed, cacheable extraction result responses.
+
+/convert-pdf/, /extract, /api/extract-events and GET /jobs/{doc_hash} send results as
+compact JSON with a weak ETag naming the document and the result schema:
+W/"sof-<SCHEMA_VERSION>-<doc_hash>" (or a hash of the data when the result is not
+stored under a document hash). A client that sends the ETag of its cached result in
+If-None-Match gets 304 Not Modified when the result is unchanged. Bump SCHEMA_VERSION
+whenever the shape or meaning of parsed results changes, so cached results expire.
+
+With "X-SOF-Delta: 1", a client caching an earlier stored result (an amended SOF, or
+the previous upload) gets the events as edits against that result instead of the
+full list, when that is smaller: "events_delta" is {"base": <ETag of the cached
+result>, "count": <number of events>, "ops": [[start, end, [events]], ...]}, each op
+replacing base events [start:end] with the given events, in order of start.
+
+Bodies of at least SOF_COMPRESS_MIN_BYTES are compressed with brotli (when the
+optional brotli package is installed) or gzip, whichever the client accepts.
+Responses vary on Accept-Encoding, If-None-Match and X-SOF-Delta and are marked
+private, so no shared cache hands one client's body or delta to another.
+"""
+import difflib
+import gzip
+import hashlib
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SCHEMA_VERSION = "1"
+COMPRESS_MIN_BYTES = int(os.getenv("SOF_COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("SOF_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("SOF_BROTLI_QUALITY", "5"))
+DELTA_HEADER = "X-SOF-Delta"
+# The body depends on the coding, the client's cached tag (a delta is sent against it) and
+# whether it asked for a delta; results are per user, so shared caches must not keep them
+VARY = f"Accept-Encoding, If-None-Match, {DELTA_HEADER}"
+CACHE_CONTROL = "private, no-cache"
+MEDIA_TYPE = "application/json"
+
+_TAG = re.compile(r'(?:W/)?"([^"]*)"')
+
+
+def _canonical(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def etag(doc_hash: Optional[str], data: Any) -> str:
+    """The result's ETag: its document hash, or failing that a hash of the data, with the schema version."""
+    key = doc_hash or hashlib.sha256(_canonical(data).encode("utf-8")).hexdigest()
+    return f'W/"sof-{SCHEMA_VERSION}-{key}"'
+
+
+def _tags(if_none_match: Optional[str]) -> List[str]:
+    return [match.group(0) for match in _TAG.finditer(if_none_match or "")]
+
+
+def matches(if_none_match: Optional[str], tag: str) -> bool:
+    """Whether If-None-Match names tag (weak comparison, so W/ prefixes are ignored)."""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = _TAG.match(tag).group(1)
+    return any(_TAG.match(candidate).group(1) == opaque for candidate in _tags(if_none_match))
+
+
+def base_documents(if_none_match: Optional[str]) -> List[Tuple[str, str]]:
+    """(ETag, doc_hash) of each current-schema document ETag in If-None-Match, candidates for a delta."""
+    prefix = f"sof-{SCHEMA_VERSION}-"
+    bases = []
+    for tag in _tags(if_none_match):
+        opaque = _TAG.match(tag).group(1)
+        if opaque.startswith(prefix):
+            bases.append((tag, opaque[len(prefix):]))
+    return bases
+
+
+def event_delta(base_events: List[Dict[str, Any]], events: List[Dict[str, Any]]) -> List[list]:
+    """Edits turning base_events into events, as [start, end, inserted events] ops."""
+    matcher = difflib.SequenceMatcher(
+        None, [_canonical(event) for event in base_events], [_canonical(event) for event in events], autojunk=False
+    )
+    return [[i1, i2, events[j1:j2]] for op, i1, i2, j1, j2 in matcher.get_opcodes() if op != "equal"]
+
+
+def apply_delta(base_events: List[Dict[str, Any]], ops: List[list]) -> List[Dict[str, Any]]:
+    """The event list an events_delta describes, given the base events it was computed against."""
+    events, position = [], 0
+    for start, end, inserted in ops:
+        events.extend(base_events[position:start])
+        events.extend(inserted)
+        position = end
+    events.extend(base_events[position:])
+    return events
+
+
+def delta_if_smaller(base_tag: str, base_events: List[Dict[str, Any]], events: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """An events_delta against base_events, or None when sending the full list is no larger."""
+    delta = {"base": base_tag, "count": len(events), "ops": event_delta(base_events, events)}
+    if len(_canonical(delta)) >= len(_canonical(events)):
+        return None
+    return delta
+
+
+def _quality(params: str) -> float:
+    """The q-value of an Accept-Encoding entry; 1 when it is missing or malformed (e.g. "q=.")."""
+    quality = re.search(r"q\s*=\s*([0-9.]+)", params)
+    if quality is None:
+        return 1.0
+    try:
+        return float(quality.group(1))
+    except ValueError:
+        return 1.0
+
+
+def _accepted(accept_encoding: str) -> set:
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding and _quality(params) != 0:
+            accepted.add(coding.strip())
+    return accepted
+
+
+def encode(body: bytes, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """body compressed with the best coding the client accepts, and that coding (None if sent as is)."""
+    if len(body) < COMPRESS_MIN_BYTES or not accept_encoding:
+        return body, None
+    accepted = _accepted(accept_encoding)
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if "gzip" in accepted or "*" in accepted:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), "gzip"
+    return body, None
+
+
+def respond(request: Request, content: Dict[str, Any], tag: str, headers: Optional[Dict[str, str]] = None) -> Response:
+    """A compact, compressed JSON response carrying tag, or 304 if the client already has it."""
+    headers = dict(headers or {}, ETag=tag, Vary=VARY)
+    headers.setdefault("Cache-Control", CACHE_CONTROL)
+    if matches(request.headers.get("if-none-match"), tag):
+        return Response(status_code=304, headers=headers)
+    body, coding = encode(
+        json.dumps(content, separators=(",", ":"), ensure_ascii=False).encode("utf-8"),
+        request.headers.get("accept-encoding"),
+    )
+    if coding is not None:
+        headers["Content-Encoding"] = coding
+    return Response(content=body, media_type=MEDIA_TYPE, headers=headers)
@@ -75,6 +75,9 @@ setup(
             "pytest-cov>=4.1.0",
             "httpx>=0.25.0",
         ],
+        "brotli": [
+            "brotli>=1.1.0",
+        ],
         "docs": [
             "mkdocs>=1.5.0",
             "mkdocs-material>=9.4.0",
@@ -124,7 +127,7 @@ setup(
     ],
     # Package discovery
     package_dir={"": "."},
-    py_modules=["main", "OCR_Script", "parser_script"],
+    py_modules=["main", "OCR_Script", "parser_script", "parse_strategy", "prompt_builder", "job_queue", "export_report", "near_duplicates", "profiling", "result_payloads", "worker", "rate_limiter", "page_cache", "text_artifact", "gcs_staging"],
     # Data files
     data_files=[
         ("config", ["goog_cred.json.example"]),
@@ -0,0 +1,118 @@
+"""
+OCR text artifacts with a page offset index.
+
+The OCR stage writes the layout-reconstructed text as one UTF-8 file with
+"--- Page Break ---" between pages, plus a sidecar index (<text file>.pages.json)
+holding the byte range of every page. Readers map the file with mmap and decode
+one page at a time through the index, so memory stays flat however many pages a
+bundle has. Text files without an index (or with a stale one) are indexed on first
+read by scanning the mapped file for page breaks.
+"""
+import json
+import mmap
+import os
+from typing import Iterator, List, Tuple
+
+PAGE_BREAK = b"--- Page Break ---"
+INDEX_SUFFIX = ".pages.json"
+
+
+def index_path(text_path: str) -> str:
+    return text_path + INDEX_SUFFIX
+
+
+def _fingerprint(text_path: str) -> Tuple[int, int]:
+    stat = os.stat(text_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def write_page_index(text_path: str, offsets: List[Tuple[int, int]]):
+    """Stores the byte range [start, end) of each page of text_path."""
+    size, mtime_ns = _fingerprint(text_path)
+    tmp_path = f"{index_path(text_path)}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"size": size, "mtime_ns": mtime_ns, "pages": offsets}, f)
+    os.replace(tmp_path, index_path(text_path))
+
+
+def build_page_index(text_path: str) -> List[Tuple[int, int]]:
+    """Scans the mapped file for page breaks and writes the index; pages match str.split(PAGE_BREAK)."""
+    offsets = []
+    size = os.path.getsize(text_path)
+    if size == 0:
+        offsets.append((0, 0))
+    else:
+        with open(text_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = 0
+            while True:
+                found = mapped.find(PAGE_BREAK, start)
+                if found == -1:
+                    offsets.append((start, size))
+                    break
+                offsets.append((start, found))
+                start = found + len(PAGE_BREAK)
+    write_page_index(text_path, offsets)
+    return offsets
+
+
+def load_page_index(text_path: str) -> List[Tuple[int, int]]:
+    """The page index of text_path, rebuilt if it is missing or older than the text."""
+    try:
+        with open(index_path(text_path), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if (index["size"], index["mtime_ns"]) == _fingerprint(text_path):
+            return [tuple(page) for page in index["pages"]]
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_page_index(text_path)
+
+
+def iter_pages(text_path: str) -> Iterator[str]:
+    """Yields the text of each page in order, decoding one page at a time from the mapped file."""
+    offsets = load_page_index(text_path)
+    if os.path.getsize(text_path) == 0:
+        yield ""
+        return
+    with open(text_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for start, end in offsets:
+            yield mapped[start:end].decode("utf-8")
+
+
+class PageWriter:
+    """Writes pages to a text artifact, recording the index as it goes."""
+
+    def __init__(self, text_path: str):
+        self.text_path = text_path
+        self.offsets: List[Tuple[int, int]] = []
+        self._file = open(text_path, "wb")
+        self._position = 0
+
+    def write_page(self, text: str, separator: str = "\n\n--- Page Break ---\n\n"):
+        """Appends one page, preceded by the separator unless it is the first page."""
+        if self.offsets:
+            data = separator.encode("utf-8")
+            marker = data.index(PAGE_BREAK)
+            # The previous page runs up to the page break marker
+            self.offsets[-1] = (self.offsets[-1][0], self._position + marker)
+            self._file.write(data)
+            self._position += len(data)
+            start = self._position - (len(data) - marker - len(PAGE_BREAK))
+        else:
+            start = 0
+        data = text.encode("utf-8")
+        self._file.write(data)
+        self._position += len(data)
+        self.offsets.append((start, self._position))
+
+    def close(self):
+        self._file.close()
+        write_page_index(self.text_path, self.offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
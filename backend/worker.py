@@ -0,0 +1,234 @@
+"""
+Stage worker for the shared job queue (see job_queue.py).
+
+Each stage scales on its own: start as many OCR or parse workers as the backlog
+needs, on the host holding the queue database and SOF_DATA_DIR (see job_queue.py
+for why the SQLite queue cannot be shared between machines).
+
+    python worker.py ocr                  # PDF -> layout-reconstructed text
+    python worker.py parse --threads 4    # text -> SOF JSON
+    python worker.py parse --once         # drain the queue and exit
+
+Jobs can be delivered more than once, so both handlers check for their output
+before doing any work and publish it with an atomic rename.
+
+While a stage's backend is rate limiting or down (its circuit breaker in
+rate_limiter.py is open), workers stop claiming and put interrupted jobs back
+without spending one of their attempts.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from dotenv import load_dotenv
+
+from job_queue import DEFAULT_LEASE_SECONDS, STAGES, JobQueue, artifact_path
+from rate_limiter import DOCUMENT_AI, GEMINI, CircuitOpenError
+import near_duplicates
+import profiling
+import text_artifact
+
+stop_requested = threading.Event()
+
+
+def handle_ocr(queue: JobQueue, job):
+    """Runs Document AI on the stored PDF and enqueues the parse stage."""
+    doc_hash = job["doc_hash"]
+    text_path = artifact_path("text", doc_hash, queue.data_dir)
+    if os.path.exists(text_path):
+        print(f"[ocr] {doc_hash[:12]}: text already exists, skipping OCR")
+    else:
+        import OCR_Script
+        tmp_path = f"{text_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        OCR_Script.process_pdf(
+            artifact_path("pdf", doc_hash, queue.data_dir),
+            OCR_Script.DEFAULT_BUCKET_NAME,
+            OCR_Script.DEFAULT_LOCATION,
+            OCR_Script.DEFAULT_PROCESSOR_ID,
+            tmp_path,
+        )
+        # Index first, so a reader never finds the text without its page index
+        os.replace(text_artifact.index_path(tmp_path), text_artifact.index_path(text_path))
+        os.replace(tmp_path, text_path)
+    queue.enqueue("parse", doc_hash)
+
+
+def find_earlier_result(queue: JobQueue, doc_hash: str, text_path: str):
+    """
+    Fingerprint, closest earlier document and its reusable result (see near_duplicates.py).
+    A failed check only costs the reuse: the document is then parsed as usual.
+    """
+    try:
+        fingerprint, match = near_duplicates.check(queue, doc_hash, text_path)
+        return fingerprint, match, near_duplicates.reusable_result(queue, match)
+    except Exception as e:
+        print(f"[parse] {doc_hash[:12]}: warning: near-duplicate check failed: {e}")
+        return None, None, None
+
+
+def register_fingerprint(queue: JobQueue, doc_hash: str, fingerprint, match, result, reused: bool = False):
+    """Adds a parsed document to the near-duplicate index; a failure only costs later duplicate checks."""
+    try:
+        near_duplicates.register(queue, doc_hash, fingerprint, match, result, reused=reused)
+    except Exception as e:
+        print(f"[parse] {doc_hash[:12]}: warning: could not record the result for duplicate checks: {e}")
+
+
+def handle_parse(queue: JobQueue, job):
+    """
+    Parses the OCR text with Gemini and stores the result on the document. A document
+    whose text matches an earlier one reuses that result instead (see near_duplicates.py).
+    The fingerprint is registered before the result is stored, so a done document is
+    never skipped on redelivery while it is missing from the index.
+    """
+    doc_hash = job["doc_hash"]
+    text_path = artifact_path("text", doc_hash, queue.data_dir)
+    document = queue.get_document(doc_hash)
+    if document and document["status"] == "done":
+        print(f"[parse] {doc_hash[:12]}: result already stored, skipping")
+        if near_duplicates.ENABLED and queue.get_fingerprint(doc_hash) is None:
+            # Stored while the index could not take it (its registration failed)
+            fingerprint, match, _ = find_earlier_result(queue, doc_hash, text_path)
+            if fingerprint is not None:
+                register_fingerprint(queue, doc_hash, fingerprint, match, document["result"])
+        return
+
+    fingerprint = match = None
+    if near_duplicates.ENABLED:
+        fingerprint, match, earlier_result = find_earlier_result(queue, doc_hash, text_path)
+        if earlier_result is not None:
+            print(f"[parse] {doc_hash[:12]}: same text as {match.doc_hash[:12]}, reusing its result")
+            register_fingerprint(queue, doc_hash, fingerprint, match, earlier_result, reused=True)
+            queue.store_result(doc_hash, earlier_result)
+            return
+
+    import parser_script
+    output_json = f"{text_path}.{os.getpid()}.{threading.get_ident()}.json"
+    try:
+        result = parser_script.parse_sof_file(text_path, output_json)
+    finally:
+        if os.path.exists(output_json):
+            os.remove(output_json)
+    if result is None:
+        raise RuntimeError("Parser produced no structured data")
+    if fingerprint is not None:
+        register_fingerprint(queue, doc_hash, fingerprint, match, result)
+    queue.store_result(doc_hash, result)
+
+
+HANDLERS = {"ocr": handle_ocr, "parse": handle_parse}
+GUARDS = {"ocr": DOCUMENT_AI, "parse": GEMINI}
+
+
+def keep_lease(queue: JobQueue, job, worker_id: str, lease_seconds: float, done: threading.Event):
+    """Extends the job's lease while the handler runs, so long OCR operations are not redelivered."""
+    while not done.wait(lease_seconds / 3):
+        if not queue.heartbeat(job["id"], worker_id, lease_seconds):
+            print(f"[{job['stage']}] lost the lease on job {job['id']}")
+            return
+
+
+def run_job(queue: JobQueue, job, worker_id: str, lease_seconds: float, retry_delay: float):
+    done = threading.Event()
+    keeper = threading.Thread(target=keep_lease, args=(queue, job, worker_id, lease_seconds, done), daemon=True)
+    keeper.start()
+    started = time.time()
+    try:
+        # SOF_PROFILE_SAMPLE_RATE picks jobs to profile; slow ones keep a flamegraph (see profiling.py)
+        with profiling.profile(f"{job['stage']}-{job['doc_hash'][:12]}", profiling.requested()) as current:
+            with profiling.stage(job["stage"]):
+                HANDLERS[job["stage"]](queue, job)
+        if not queue.complete(job):
+            # Another worker claimed the job after our lease ran out; the handlers are
+            # idempotent, so it finds this worker's output and finishes the job.
+            print(f"[{job['stage']}] {job['doc_hash'][:12]} finished after its lease was lost; left to the new holder")
+            return
+        print(f"[{job['stage']}] {job['doc_hash'][:12]} done in {time.time() - started:.1f}s (attempt {job['attempts']})")
+        if current is not None:
+            print(f"[{job['stage']}] {job['doc_hash'][:12]} profile: {json.dumps(current.summary())}")
+    except CircuitOpenError as e:
+        if queue.release(job, delay=e.retry_after, reason=str(e)):
+            print(f"[{job['stage']}] {job['doc_hash'][:12]} put back: {e}")
+        else:
+            print(f"[{job['stage']}] {job['doc_hash'][:12]} interrupted after its lease was lost: {e}")
+    except Exception as e:
+        traceback.print_exc()
+        if queue.fail(job, str(e), retry_delay=retry_delay * job["attempts"]):
+            print(f"[{job['stage']}] {job['doc_hash'][:12]} failed on attempt {job['attempts']}: {e}")
+        else:
+            print(f"[{job['stage']}] {job['doc_hash'][:12]} failed after its lease was lost, left to the new holder: {e}")
+    finally:
+        done.set()
+        keeper.join()
+
+
+def worker_loop(queue: JobQueue, stage: str, worker_id: str, args):
+    breaker = GUARDS[stage].breaker
+    while not stop_requested.is_set():
+        if breaker.state == "open" and breaker.retry_after() > 0:
+            # Leave the queue alone until the breaker lets a trial call through
+            stop_requested.wait(min(breaker.retry_after(), args.poll_interval * 10))
+            continue
+        job = queue.claim(stage, worker_id, args.lease_seconds)
+        if job is None:
+            if args.once:
+                return
+            stop_requested.wait(args.poll_interval)
+            continue
+        run_job(queue, job, worker_id, args.lease_seconds, args.retry_delay)
+
+
+def main():
+    """Runs one or more worker threads for a stage until interrupted."""
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Process SOF jobs from the shared queue.")
+    parser.add_argument("stage", choices=STAGES, help="The pipeline stage this worker runs.")
+    parser.add_argument("--threads", type=int, default=1, help="Concurrent jobs in this process.")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to wait when the queue is empty.")
+    parser.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS)
+    parser.add_argument("--retry-delay", type=float, default=30.0, help="Base back-off before a failed job is retried.")
+    parser.add_argument("--once", action="store_true", help="Exit when no job is runnable.")
+    args = parser.parse_args()
+
+    if args.stage == "parse":
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            print("Error: Google API key not found. Please create a .env file and add: GOOGLE_API_KEY='your_key_here'")
+            return
+        import parser_script
+        parser_script.configure_gemini(api_key)
+
+    signal.signal(signal.SIGTERM, lambda *_: stop_requested.set())
+
+    queue = JobQueue()
+    worker_base = f"{socket.gethostname()}-{os.getpid()}"
+    threads = [
+        threading.Thread(target=worker_loop, args=(queue, args.stage, f"{worker_base}-{n}", args), name=f"{args.stage}-{n}")
+        for n in range(args.threads)
+    ]
+    print(f"Starting {args.threads} {args.stage} worker thread(s) on queue '{queue.db_path}'...")
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        print("Stopping after the current jobs finish...")
+        stop_requested.set()
+        for thread in threads:
+            thread.join()
+
+    if args.stage == "ocr":
+        import gcs_staging
+        gcs_staging.REAPER.drain()
+
+
+if __name__ == "__main__":
+    main()
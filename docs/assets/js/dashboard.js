@@ -152,34 +152,39 @@ class DashboardAPI {
                 await this.uploadFileForProcessing();
             }
 
-            // Call the extract-events API
-            const response = await fetch(`${this.baseURL}/api/extract-events`, {
+            // Call the extract-events API (answers 304 when the cached result is still current)
+            const { response, result: data, notModified } = await ResultCache.fetchResult(`${this.baseURL}/api/extract-events`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 }
             });
 
-            if (!response.ok) {
+            if (!data) {
                 const errorData = await response.json().catch(() => ({ error: 'Unknown error' }));
                 throw new Error(errorData.error || `HTTP ${response.status}`);
             }
 
-            const data = await response.json();
-
-            if (data.success) {
+            if (notModified) {
+                this.showMessage('Events are up to date! Redirecting to results...', 'success');
+                setTimeout(() => {
+                    window.location.href = 'extraction-results.html';
+                }, 1000);
+            } else if (data.success) {
                 // Store ALL events data in sessionStorage for extraction-results.html
                 sessionStorage.setItem('extractionResults', JSON.stringify(data));
                 
                 // Also store in localStorage as backup
-                localStorage.setItem('extractionResult', JSON.stringify({
+                ResultCache.save({
                     message: data.message,
                     filename: data.filename,
+                    doc_hash: data.doc_hash,
+                    etag: data.etag,
                     data: {
                         events: data.events,
                         vessel_info: data.vessel_info
                     }
-                }));
+                });
 
                 this.showMessage('Events extracted successfully! Redirecting to results...', 'success');
 
@@ -212,17 +217,18 @@ class DashboardAPI {
         const formData = new FormData();
         formData.append('pdf', this.currentFile);
 
-        const response = await fetch(`${this.baseURL}/convert-pdf/`, {
+        const { response, result } = await ResultCache.fetchResult(`${this.baseURL}/convert-pdf/`, {
             method: 'POST',
             body: formData
         });
 
-        if (!response.ok) {
+        if (!result) {
             const text = await response.text();
             throw new Error(text || 'File upload failed');
         }
 
-        return await response.json();
+        ResultCache.save(result);
+        return result;
     }
 
     // Document upload (existing method - kept unchanged)
@@ -244,23 +250,22 @@ class DashboardAPI {
 
             console.log('FormData created, sending to:', `${this.baseURL}/extract`);
             
-            const response = await fetch(`${this.baseURL}/extract`, {
+            const { response, result } = await ResultCache.fetchResult(`${this.baseURL}/extract`, {
                 method: 'POST',
                 body: formData
             });
 
             console.log('Response received:', response.status, response.statusText);
 
-            if (!response.ok) {
+            if (!result) {
                 const text = await response.text();
                 throw new Error(text || 'Extraction failed');
             }
 
-            const result = await response.json();
             console.log('Upload successful, result:', result);
             
             // Persist extraction result for results page
-            localStorage.setItem('extractionResult', JSON.stringify(result));
+            ResultCache.save(result);
 
             this.showMessage('Extraction successful! Opening results…', 'success');
 
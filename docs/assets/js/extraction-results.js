@@ -264,7 +264,7 @@ class ExtractionResults {
             
             console.log('Sending PDF to backend:', pdfFile.name);
             
-            const response = await fetch(`${this.baseURL}/convert-pdf/`, {
+            const { response, result } = await ResultCache.fetchResult(`${this.baseURL}/convert-pdf/`, {
                 method: 'POST',
                 body: formData
             });
@@ -272,19 +272,18 @@ class ExtractionResults {
             console.log('Backend response status:', response.status);
             console.log('Backend response headers:', response.headers);
             
-            if (!response.ok) {
+            if (!result) {
                 const errorText = await response.text();
                 console.error('Backend error response:', errorText);
                 throw new Error(`HTTP error! status: ${response.status}, message: ${errorText}`);
             }
             
-            const result = await response.json();
             console.log('Backend result:', result);
             
             this.hideLoading();
             
             // Store the result and render it
-            localStorage.setItem('extractionResult', JSON.stringify(result));
+            ResultCache.save(result);
             this.renderFromBackendResult(result);
             
             return result;
@@ -0,0 +1,85 @@
+// Result cache - keeps the latest extraction result in localStorage and revalidates it with the backend
+// The backend tags results with an ETag: sending it back answers 304 when nothing changed, and with
+// X-SOF-Delta the events of an amended document arrive as edits against the cached ones.
+const ResultCache = {
+    storageKey: 'extractionResult',
+
+    load() {
+        const raw = localStorage.getItem(this.storageKey);
+        if (!raw) return null;
+        try {
+            return JSON.parse(raw);
+        } catch (e) {
+            localStorage.removeItem(this.storageKey);
+            return null;
+        }
+    },
+
+    save(result) {
+        localStorage.setItem(this.storageKey, JSON.stringify(result));
+    },
+
+    // Replaces base[start:end] with the given events for each [start, end, events] op
+    applyEventDelta(baseEvents, delta) {
+        const events = [];
+        let position = 0;
+        delta.ops.forEach(([start, end, inserted]) => {
+            events.push(...baseEvents.slice(position, start), ...inserted);
+            position = end;
+        });
+        events.push(...baseEvents.slice(position));
+        return events;
+    },
+
+    // The full events of a result stored under docHash, fetched with a GET so nothing is re-uploaded
+    async fetchStoredEvents(url, docHash) {
+        if (!docHash) return null;
+        const response = await fetch(new URL(`/jobs/${encodeURIComponent(docHash)}`, url));
+        if (!response.ok) return null;
+        const stored = await response.json();
+        return stored.data && Array.isArray(stored.data.events) ? stored.data.events : null;
+    },
+
+    // fetch() that revalidates the cached result. Resolves to { response, result, notModified };
+    // result has the full events (also when sent as a delta) and its etag, and is null on errors.
+    async fetchResult(url, options = {}) {
+        const cached = this.load();
+        const headers = new Headers(options.headers || {});
+        if (cached && cached.etag) {
+            headers.set('If-None-Match', cached.etag);
+            headers.set('X-SOF-Delta', '1');
+        }
+
+        const response = await fetch(url, { ...options, headers });
+        if (response.status === 304 && cached) {
+            return { response, result: cached, notModified: true };
+        }
+        if (!response.ok) {
+            return { response, result: null, notModified: false };
+        }
+
+        const result = await response.json();
+        if (result.events_delta) {
+            const delta = result.events_delta;
+            const baseEvents = (cached && cached.data && cached.data.events) || [];
+            let events = cached && delta.base === cached.etag ? this.applyEventDelta(baseEvents, delta) : null;
+            if (!events || events.length !== delta.count) {
+                // Not against our cached result after all. Repeating the request would upload the
+                // PDF and run OCR and parsing again, so read the stored result by its hash instead
+                localStorage.removeItem(this.storageKey);
+                events = await this.fetchStoredEvents(url, result.doc_hash);
+                if (!events) {
+                    return { response, result: null, notModified: false };
+                }
+            }
+            if (result.data) {
+                result.data.events = events;
+            } else {
+                result.events = events;
+            }
+            delete result.events_delta;
+        }
+        result.etag = response.headers.get('ETag');
+        return { response, result, notModified: false };
+    }
+};